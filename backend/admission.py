@@ -0,0 +1,228 @@
+import ipaddress
+import math
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import orjson
+from starlette.datastructures import Headers
+
+from metrics import registry
+
+# Methods that only read; everything else under /api counts as a write
+READ_METHODS = ("GET", "HEAD", "OPTIONS")
+
+# Liveness, readiness and scrapes must answer even under overload
+EXEMPT_PATHS = ("/api/health/", "/metrics")
+
+# Event streams stay open for the whole session; they are rate limited when
+# opened but not counted against the concurrency caps
+LONG_LIVED_PATHS = ("/api/live",)
+
+admission_rejections = registry.counter(
+    "admission_rejections_total", "Requests turned away before reaching a route", ("reason", "kind"))
+admission_in_flight = registry.gauge(
+    "admission_in_flight_requests", "Admitted requests not yet finished", ("kind",))
+admission_write_limit = registry.gauge(
+    "admission_write_concurrency_limit", "Current adaptive limit on concurrent writes")
+
+
+class TokenBucket:
+    """rate tokens per second, holding at most burst; refilled lazily on each take."""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, now: float) -> float:
+        """Take one token; 0 when granted, else seconds until one is available."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """One token bucket per client, route and kind of request (read or write).
+
+    Buckets live in an LRU bounded by max_clients; an evicted client simply
+    starts again from a full bucket.
+    """
+
+    def __init__(self, limits: Dict[str, Tuple[float, float]], max_clients: int = 10_000):
+        self.limits = limits
+        self.max_clients = max_clients
+        self.buckets: "OrderedDict[Tuple[str, str, str], TokenBucket]" = OrderedDict()
+
+    def check(self, client: str, kind: str, route: str = "") -> float:
+        """0 if the request may proceed, else the seconds to wait."""
+        rate, burst = self.limits[kind]
+        if rate <= 0:
+            return 0.0
+        key = (client, route, kind)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(rate, burst)
+            while len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        return bucket.take(time.monotonic())
+
+
+class LoadShedder:
+    """Caps concurrent requests, adapting the write cap to backend pressure.
+
+    Mongo operations in flight and event-loop lag are sampled on every
+    admission. While either is above its threshold the write limit is cut
+    by a quarter, at most once per adjust_interval; while both are below,
+    it grows back by one per interval (AIMD). Writes beyond the limit are
+    shed. Reads, mostly served from the catalog cache, are only shed once
+    max_reads are already in flight.
+    """
+
+    def __init__(self, mongo_in_flight: Callable[[], int], loop_lag: Callable[[], float],
+                 max_reads: int = 512, max_writes: int = 64, min_writes: int = 4,
+                 max_mongo_in_flight: int = 200, max_loop_lag: float = 0.2,
+                 adjust_interval: float = 0.1):
+        self.mongo_in_flight = mongo_in_flight
+        self.loop_lag = loop_lag
+        self.max_reads = max_reads
+        self.max_writes = max_writes
+        self.min_writes = min_writes
+        self.max_mongo_in_flight = max_mongo_in_flight
+        self.max_loop_lag = max_loop_lag
+        self.adjust_interval = adjust_interval
+        self.write_limit = max_writes
+        self.in_flight = {"read": 0, "write": 0}
+        self.adjusted_at = 0.0
+        admission_write_limit.set(self.write_limit)
+
+    def overloaded(self) -> bool:
+        return self.mongo_in_flight() > self.max_mongo_in_flight or self.loop_lag() > self.max_loop_lag
+
+    def _adjust(self, now: float):
+        if now - self.adjusted_at < self.adjust_interval:
+            return
+        self.adjusted_at = now
+        if self.overloaded():
+            self.write_limit = max(self.min_writes, math.floor(self.write_limit * 0.75))
+        elif self.write_limit < self.max_writes:
+            self.write_limit += 1
+        admission_write_limit.set(self.write_limit)
+
+    def admit(self, kind: str) -> Optional[str]:
+        """Count the request in and return None, or the reason it is shed."""
+        self._adjust(time.monotonic())
+        limit = self.write_limit if kind == "write" else self.max_reads
+        if self.in_flight[kind] >= limit:
+            return "overloaded" if kind == "write" and self.write_limit < self.max_writes else "concurrency"
+        self.in_flight[kind] += 1
+        admission_in_flight.set(self.in_flight[kind], kind)
+        return None
+
+    def release(self, kind: str):
+        self.in_flight[kind] -= 1
+        admission_in_flight.set(self.in_flight[kind], kind)
+
+
+def parse_networks(networks: Iterable[str]) -> List[ipaddress._BaseNetwork]:
+    """Addresses or CIDR ranges, e.g. of the proxies in front of the server."""
+    return [ipaddress.ip_network(network.strip(), strict=False) for network in networks if network.strip()]
+
+
+def _trusted(address: str, proxies: List[ipaddress._BaseNetwork]) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in proxies)
+
+
+def client_key(scope, trusted_proxies: List[ipaddress._BaseNetwork] = ()) -> str:
+    """Address to rate limit by: the peer, or the client our proxies saw.
+
+    Each proxy appends the address it received the request from to
+    X-Forwarded-For, so the header is read only when the peer is one of
+    trusted_proxies, and from the right: the first hop that is not a
+    trusted proxy was appended by one and cannot be forged by the client.
+    """
+    client = scope.get("client")
+    peer = client[0] if client else "-"
+    if not _trusted(peer, trusted_proxies):
+        return peer
+    forwarded = Headers(scope=scope).get("x-forwarded-for")
+    if not forwarded:
+        return peer
+    hops = [hop.strip() for hop in forwarded.split(",")]
+    for hop in reversed(hops):
+        if not _trusted(hop, trusted_proxies):
+            return hop
+    return hops[0]
+
+
+def route_key(path: str) -> str:
+    """The API resource a path belongs to, e.g. /api/cart for /api/cart/{item_id}.
+
+    Ids in paths would otherwise give each one its own bucket.
+    """
+    return "/".join(path.split("/", 3)[:3])
+
+
+class AdmissionMiddleware:
+    """ASGI middleware answering 429 or 503 up front instead of queueing.
+
+    Requests over their client's rate for the route get 429, and requests over the
+    concurrency limits get 503, both with a Retry-After header and without
+    touching Mongo.
+    """
+
+    def __init__(self, app, rate_limiter: Optional[RateLimiter] = None,
+                 load_shedder: Optional[LoadShedder] = None, trusted_proxies: Iterable[str] = ()):
+        self.app = app
+        self.rate_limiter = rate_limiter
+        self.load_shedder = load_shedder
+        self.trusted_proxies = parse_networks(trusted_proxies)
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "")
+        if scope["type"] != "http" or not path.startswith("/api/") or path.startswith(EXEMPT_PATHS):
+            return await self.app(scope, receive, send)
+
+        kind = "read" if scope["method"] in READ_METHODS else "write"
+        if self.rate_limiter is not None:
+            wait = self.rate_limiter.check(client_key(scope, self.trusted_proxies), kind, route_key(path))
+            if wait:
+                admission_rejections.inc("rate_limited", kind)
+                return await reject(send, 429, "Too many requests", wait)
+
+        if self.load_shedder is None or path.startswith(LONG_LIVED_PATHS):
+            return await self.app(scope, receive, send)
+        reason = self.load_shedder.admit(kind)
+        if reason is not None:
+            admission_rejections.inc(reason, kind)
+            return await reject(send, 503, "Server overloaded, retry shortly", 1.0)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.load_shedder.release(kind)
+
+
+async def reject(send, status: int, detail: str, retry_after: float):
+    body = orjson.dumps({"detail": detail})
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,315 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+from pymongo import ReadPreference
+
+from metrics import registry
+
+DAY_SECONDS = 86_400
+
+# Quantiles reported by the price distribution
+PRICE_QUANTILES = (0.25, 0.5, 0.75)
+
+snapshot_duration = registry.gauge(
+    "analytics_snapshot_duration_seconds", "Time taken by the last analytics snapshot")
+snapshot_rows = registry.gauge(
+    "analytics_snapshot_rows", "Rows in the current analytics snapshot", ("table",))
+
+
+class Dictionary:
+    """Integer codes for the distinct values of a column, in first-seen order."""
+
+    def __init__(self):
+        self.values: List = []
+        self.codes: Dict = {}
+
+    def code(self, value) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+async def read_columns(documents: AsyncIterator[dict], extract: Callable[[dict], Iterable[tuple]],
+                       dtypes: Sequence, batch_size: int) -> List[np.ndarray]:
+    """Columns of the rows extracted from each document, built one batch at a time.
+
+    Rows are held as Python tuples for one batch only; every batch becomes
+    one typed array per column, and the chunks are joined at the end.
+    """
+    chunks: List[List[np.ndarray]] = [[] for _ in dtypes]
+    rows: List[tuple] = []
+
+    def flush():
+        for column, values in enumerate(zip(*rows)):
+            chunks[column].append(np.array(values, dtype=dtypes[column]))
+        rows.clear()
+
+    async for document in documents:
+        rows.extend(extract(document))
+        if len(rows) >= batch_size:
+            flush()
+            # Let requests through between batches
+            await asyncio.sleep(0)
+    if rows:
+        flush()
+    return [np.concatenate(column) if column else np.empty(0, dtype) for column, dtype in zip(chunks, dtypes)]
+
+
+def _epoch(value) -> float:
+    if value is None:
+        return 0.0
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        # Mongo dates come back naive, in UTC
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def _segments(keys: np.ndarray, count: int) -> np.ndarray:
+    """Start of each key's run in sorted keys, plus the end."""
+    return np.searchsorted(keys, np.arange(count + 1))
+
+
+class Snapshot:
+    """Columnar copy of products, cart lines and orders, with vectorized queries.
+
+    Strings are dictionary-encoded, so every group-by is a bincount over
+    integer codes: O(rows) in compiled code, with no per-row Python. Prices
+    are also kept sorted by condition and by (category, condition), so
+    quantiles read straight out of contiguous segments.
+    """
+
+    def __init__(self, taken_at: float, categories: List[str], conditions: List[str],
+                 products: List[np.ndarray], lines: List[np.ndarray], orders: List[np.ndarray],
+                 items: List[np.ndarray], carts: int):
+        self.taken_at = taken_at
+        self.categories = categories
+        self.conditions = conditions
+        self.product_category, self.product_condition, self.product_price, self.product_stock = products
+        self.line_cart, self.line_product, self.line_quantity, self.line_added_at = lines
+        self.order_cart, self.order_created_at, self.order_total = orders
+        self.item_category, self.item_quantity, self.item_revenue, self.item_created_at = items
+        self.carts = carts
+        self.duration = 0.0
+
+        # Prices per condition and per (category, condition), ascending
+        by_condition = np.lexsort((self.product_price, self.product_condition))
+        self.prices_by_condition = self.product_price[by_condition]
+        self.condition_segments = _segments(self.product_condition[by_condition], len(conditions))
+        pair = self.product_category.astype(np.int64) * len(conditions) + self.product_condition
+        by_pair = np.lexsort((self.product_price, pair))
+        self.prices_by_pair = self.product_price[by_pair]
+        self.pair_segments = _segments(pair[by_pair], len(categories) * len(conditions))
+        self.product_value = self.product_price * self.product_stock
+
+        # Last activity of each cart, for carts that still hold lines
+        self.cart_active_at = np.full(carts, -np.inf)
+        np.maximum.at(self.cart_active_at, self.line_cart, self.line_added_at)
+        self.line_active_at = self.cart_active_at[self.line_cart]
+        # -1 for lines of products no longer in the catalog
+        self.line_category = np.where(self.line_product >= 0, self.product_category[self.line_product], -1)
+
+    def rows(self) -> Dict[str, int]:
+        return {"products": len(self.product_price), "cart_lines": len(self.line_cart),
+                "orders": len(self.order_cart), "order_items": len(self.item_category)}
+
+    def memory_bytes(self) -> int:
+        return sum(value.nbytes for value in vars(self).values() if isinstance(value, np.ndarray))
+
+    def info(self) -> dict:
+        return {"taken_at": datetime.fromtimestamp(self.taken_at, timezone.utc).isoformat(),
+                "duration_seconds": round(self.duration, 3), "rows": self.rows(),
+                "memory_bytes": self.memory_bytes()}
+
+    def stock_value(self) -> dict:
+        count = len(self.categories)
+        category = self.product_category
+        products = np.bincount(category, minlength=count)
+        units = np.bincount(category, weights=self.product_stock, minlength=count)
+        value = np.bincount(category, weights=self.product_value, minlength=count)
+        sold_out = np.bincount(category, weights=self.product_stock <= 0, minlength=count)
+        rows = [
+            {"category": self.categories[code], "products": int(products[code]), "units": int(units[code]),
+             "stock_value": round(float(value[code]), 2), "out_of_stock": int(sold_out[code])}
+            for code in np.argsort(-value, kind="stable") if products[code]
+        ]
+        return {"categories": rows, "total": {
+            "products": int(products.sum()), "units": int(units.sum()),
+            "stock_value": round(float(value.sum()), 2), "out_of_stock": int(sold_out.sum())}}
+
+    def price_distribution(self, bins: int, category: Optional[str] = None) -> Optional[dict]:
+        """Price summary and histogram per condition; None for an unknown category."""
+        conditions = len(self.conditions)
+        if category is None:
+            prices, segments = self.prices_by_condition, self.condition_segments
+        else:
+            if category not in self.categories:
+                return None
+            code = self.categories.index(category)
+            segments = self.pair_segments[code * conditions:(code + 1) * conditions + 1]
+            prices = self.prices_by_pair
+        prices = prices[segments[0]:segments[-1]]
+        edges = np.histogram_bin_edges(prices, bins) if len(prices) else np.zeros(bins + 1)
+
+        rows = []
+        for code in range(conditions):
+            segment = prices[segments[code] - segments[0]:segments[code + 1] - segments[0]]
+            if not len(segment):
+                continue
+            # Segments are sorted: a bin's count is the gap between its edges' positions
+            bounds = np.concatenate(([0], np.searchsorted(segment, edges[1:-1]), [len(segment)]))
+            quantiles = {f"p{round(q * 100)}": round(float(segment[int(q * (len(segment) - 1))]), 2)
+                         for q in PRICE_QUANTILES}
+            rows.append({"condition": self.conditions[code], "products": len(segment),
+                         "min": round(float(segment[0]), 2), "max": round(float(segment[-1]), 2),
+                         "mean": round(float(segment.mean()), 2), **quantiles,
+                         "histogram": np.diff(bounds).tolist()})
+        return {"category": category, "bin_edges": np.round(edges, 2).tolist(), "conditions": rows}
+
+    def cart_conversion(self, days: int) -> dict:
+        """Carts active in the last days, today included, against those of them that placed an order."""
+        since = (self.taken_at // DAY_SECONDS - days + 1) * DAY_SECONDS
+        recent = self.order_created_at >= since
+        ordered = np.zeros(self.carts, dtype=bool)
+        ordered[self.order_cart[recent]] = True
+        active = ordered | (self.cart_active_at >= since)
+        carts, converted = int(active.sum()), int(ordered.sum())
+
+        count = len(self.categories)
+        open_lines = (self.line_active_at >= since) & (self.line_category >= 0)
+        in_carts = np.bincount(self.line_category[open_lines],
+                               weights=self.line_quantity[open_lines], minlength=count)
+        sold_items = self.item_created_at >= since
+        sold = np.bincount(self.item_category[sold_items], weights=self.item_quantity[sold_items], minlength=count)
+        revenue = np.bincount(self.item_category[sold_items], weights=self.item_revenue[sold_items], minlength=count)
+
+        day = ((self.order_created_at[recent] - since) // DAY_SECONDS).astype(np.int64)
+        daily_orders = np.bincount(day, minlength=days)[:days]
+        daily_revenue = np.bincount(day, weights=self.order_total[recent], minlength=days)[:days]
+        return {
+            "days": days,
+            "carts": carts,
+            "converted": converted,
+            "conversion_rate": round(converted / carts, 4) if carts else 0.0,
+            "orders": int(recent.sum()),
+            "revenue": round(float(self.order_total[recent].sum()), 2),
+            "categories": [
+                {"category": self.categories[code], "units_in_open_carts": int(in_carts[code]),
+                 "units_sold": int(sold[code]), "revenue": round(float(revenue[code]), 2)}
+                for code in range(count) if in_carts[code] or sold[code]
+            ],
+            "daily": [
+                {"date": datetime.fromtimestamp(since + index * DAY_SECONDS, timezone.utc).date().isoformat(),
+                 "orders": int(daily_orders[index]), "revenue": round(float(daily_revenue[index]), 2)}
+                for index in range(days)
+            ],
+        }
+
+
+async def take_snapshot(products: AsyncIterator[dict], lines: AsyncIterator[dict],
+                        orders: AsyncIterator[dict], batch_size: int) -> Snapshot:
+    """Stream the three sources into columns, then index them off the event loop."""
+    taken_at = time.time()
+    categories, conditions, product_ids, cart_ids = Dictionary(), Dictionary(), Dictionary(), Dictionary()
+
+    def product_row(product):
+        product_ids.code(product["id"])
+        yield (categories.code(product.get("category")), conditions.code(product.get("condition")),
+               product.get("price") or 0.0, product.get("stock") or 0)
+
+    def line_row(line):
+        yield (cart_ids.code(line["cart_id"]), product_ids.codes.get(line["product_id"], -1),
+               line.get("quantity", 0), _epoch(line.get("added_at")))
+
+    order_items: List[tuple] = []
+
+    def order_row(order):
+        created_at = _epoch(order.get("created_at"))
+        for item in order.get("items", ()):
+            order_items.append((categories.code(item.get("category")), item["quantity"],
+                                item.get("subtotal", 0.0), created_at))
+        yield cart_ids.code(order.get("cart_id")), created_at, order.get("total", 0.0)
+
+    product_columns = await read_columns(products, product_row, (np.int64, np.int64, np.float64, np.int64),
+                                         batch_size)
+    line_columns = await read_columns(lines, line_row, (np.int64, np.int64, np.int64, np.float64), batch_size)
+    order_columns = await read_columns(orders, order_row, (np.int64, np.float64, np.float64), batch_size)
+    item_columns = await read_columns(_iterate(order_items), lambda item: (item,),
+                                      (np.int64, np.int64, np.float64, np.float64), batch_size)
+    return await asyncio.to_thread(
+        Snapshot, taken_at, categories.values, conditions.values, product_columns, line_columns,
+        order_columns, item_columns, len(cart_ids.values))
+
+
+async def _iterate(values: Iterable) -> AsyncIterator:
+    for value in values:
+        yield value
+
+
+class Analytics:
+    """Periodic columnar snapshots of the catalog, carts and orders for dashboards.
+
+    Every refresh_interval the collections are scanned once, in batches,
+    with only the fields the reports use, preferring secondaries; the API
+    never queries Mongo for analytics. Queries read the latest snapshot,
+    which is immutable and replaced whole, so a refresh never blocks them.
+    """
+
+    def __init__(self, refresh_interval: float = 300.0, batch_size: int = 10_000):
+        self.refresh_interval = refresh_interval
+        self.batch_size = batch_size
+        self.db = None
+        self.snapshot: Optional[Snapshot] = None
+        self.refreshing = False
+        self.failures = 0
+        self.last_error: Optional[str] = None
+
+    def collection(self, name: str):
+        return self.db.get_collection(name, read_preference=ReadPreference.SECONDARY_PREFERRED)
+
+    def scan(self, name: str, fields: Sequence[str]) -> AsyncIterator[dict]:
+        projection = {"_id": 0, **{field: 1 for field in fields}}
+        return self.collection(name).find({}, projection, batch_size=self.batch_size)
+
+    async def refresh(self) -> Snapshot:
+        started = time.perf_counter()
+        self.refreshing = True
+        try:
+            snapshot = await take_snapshot(
+                self.scan("products", ("id", "category", "condition", "price", "stock")),
+                self.scan("cart", ("cart_id", "product_id", "quantity", "added_at")),
+                self.scan("orders", ("cart_id", "created_at", "total", "items.category",
+                                     "items.quantity", "items.subtotal")),
+                self.batch_size,
+            )
+        finally:
+            self.refreshing = False
+        snapshot.duration = time.perf_counter() - started
+        self.snapshot = snapshot
+        snapshot_duration.set(snapshot.duration)
+        for table, rows in snapshot.rows().items():
+            snapshot_rows.set(rows, table)
+        return snapshot
+
+    async def run(self):
+        while True:
+            try:
+                await self.refresh()
+                self.last_error = None
+            except Exception as e:
+                # Bad rows fail a refresh as surely as Mongo does; the last
+                # snapshot keeps being served and the next refresh may succeed
+                self.failures += 1
+                self.last_error = repr(e)
+                print(f"Analytics snapshot failed, retrying: {e!r}")
+            await asyncio.sleep(self.refresh_interval)
+
+    def stats(self) -> dict:
+        return {"refreshing": self.refreshing, "failures": self.failures, "last_error": self.last_error,
+                "snapshot": self.snapshot.info() if self.snapshot else None}
@@ -0,0 +1,374 @@
+import asyncio
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, NamedTuple, Optional
+
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+from models import Product
+from repository import CartRepository, ProductRepository
+
+# Error codes for an index whose name or key exists with other options
+INDEX_CONFLICT_CODES = (85, 86)
+
+# Failed steps are retried after this delay, doubling up to the maximum
+RETRY_DELAY_SECONDS = 1.0
+MAX_RETRY_DELAY_SECONDS = 60.0
+
+
+class IndexSpec(NamedTuple):
+    collection: str
+    name: str
+    keys: list
+    options: dict = {}
+
+
+def required_indexes(cart_ttl_seconds: int, job_retention_seconds: int = 7 * 24 * 3600) -> List[IndexSpec]:
+    """Every index the application relies on, by collection."""
+    return [
+        # get, get_stock and cart joins look products up by id
+        IndexSpec("products", "product_id", [("id", 1)], {"unique": True}),
+        # Keyset listings, per category and across the catalog
+        IndexSpec("products", "category_listing", [("category", 1), ("created_at", -1), ("id", -1)]),
+        IndexSpec("products", "listing", [("created_at", -1), ("id", -1)]),
+        # Price-ordered listings and price ranges, per category, per console
+        # and across the catalog; descending orders walk them backwards
+        IndexSpec("products", "category_price", [("category", 1), ("price", 1), ("id", 1)]),
+        IndexSpec("products", "console_price", [("console", 1), ("price", 1), ("id", 1)]),
+        IndexSpec("products", "price_listing", [("price", 1), ("id", 1)]),
+        # Search fallback while the in-process index builds
+        IndexSpec("products", "product_text", [("name", "text"), ("brand", "text"), ("description", "text")], {
+            "weights": {"name": 3, "brand": 2, "description": 1},
+            "default_language": "french",
+        }),
+        # Every cart query is scoped by cart_id; one line per product
+        IndexSpec("cart", "cart_lines", [("cart_id", 1), ("product_id", 1)], {"unique": True}),
+        # Abandoned cart lines expire without a cron job
+        IndexSpec("cart", "cart_expiry", [("added_at", 1)], {"expireAfterSeconds": cart_ttl_seconds}),
+        # One stock hold per cart and product
+        IndexSpec("reservations", "reservation_lines", [("cart_id", 1), ("product_id", 1)], {"unique": True}),
+        # Expired holds are swept back into stock by the application, not by a TTL index
+        IndexSpec("reservations", "reservation_expiry", [("expires_at", 1)]),
+        IndexSpec("orders", "order_id", [("id", 1)], {"unique": True}),
+        IndexSpec("invoices", "invoice_order", [("order_id", 1)], {"unique": True}),
+        # Workers claim due jobs oldest first; finished jobs expire, failed ones stay
+        IndexSpec("jobs", "job_claim", [("status", 1), ("run_at", 1)]),
+        IndexSpec("jobs", "job_id", [("id", 1)], {"unique": True}),
+        IndexSpec("jobs", "job_expiry", [("finished_at", 1)], {"expireAfterSeconds": job_retention_seconds}),
+    ]
+
+
+def create_product(name: str, category: str, price: float, description: str,
+                   image_url: str, condition: str = "Très bon état",
+                   console: str = None, brand: str = None, stock: int = 1) -> dict:
+    return Product(
+        id=str(uuid.uuid4()),
+        name=name,
+        category=category,
+        price=price,
+        description=description,
+        image_url=image_url,
+        condition=condition,
+        console=console,
+        brand=brand,
+        stock=stock,
+        created_at=datetime.now().isoformat(),
+    ).model_dump()
+
+
+def sample_products() -> List[dict]:
+    return [
+        # Consoles
+        create_product(
+            "PlayStation 5",
+            "consoles",
+            450.00,
+            "Console PlayStation 5 d'occasion en excellent état. Inclut la manette DualSense.",
+            "https://images.unsplash.com/photo-1507457379470-08b800bebc67",
+            "Excellent état",
+            "PlayStation 5",
+            "Sony",
+            2
+        ),
+        create_product(
+            "Xbox One X",
+            "consoles", 
+            320.00,
+            "Console Xbox One X d'occasion. Parfait pour jouer en 4K.",
+            "https://images.unsplash.com/photo-1571126770292-d50130a36459",
+            "Bon état",
+            "Xbox One",
+            "Microsoft",
+            1
+        ),
+        create_product(
+            "PlayStation 1 Retro",
+            "consoles",
+            85.00,
+            "Console PlayStation 1 vintage avec manette d'origine. Parfait pour les nostalgiques.",
+            "https://images.unsplash.com/photo-1531390658120-e06b58d826ea",
+            "Bon état",
+            "PlayStation 1",
+            "Sony",
+            1
+        ),
+        
+        # Manettes
+        create_product(
+            "Manette Xbox Series X",
+            "manettes",
+            45.00,
+            "Manette sans fil Xbox Series X en très bon état. Compatible avec PC et Xbox.",
+            "https://images.unsplash.com/photo-1629917629391-47d9209b7c19",
+            "Très bon état",
+            "Xbox Series X",
+            "Microsoft",
+            3
+        ),
+        create_product(
+            "Manette DualSense PS5",
+            "manettes",
+            55.00,
+            "Manette DualSense officielle PlayStation 5 avec retour haptique.",
+            "https://images.unsplash.com/photo-1571716846319-21f2bf095516",
+            "Excellent état",
+            "PlayStation 5",
+            "Sony",
+            2
+        ),
+        create_product(
+            "Manette PlayStation 4",
+            "manettes",
+            35.00,
+            "Manette DualShock 4 pour PlayStation 4. Fonctionne parfaitement.",
+            "https://images.pexels.com/photos/32713615/pexels-photo-32713615.jpeg",
+            "Bon état",
+            "PlayStation 4",
+            "Sony",
+            4
+        ),
+        
+        # Casques
+        create_product(
+            "Casque Gaming Pro",
+            "casques",
+            89.00,
+            "Casque gaming haute qualité avec microphone détachable. Son surround 7.1.",
+            "https://images.unsplash.com/photo-1677086813101-496781a0f327",
+            "Très bon état",
+            None,
+            "Gaming Pro",
+            2
+        ),
+        create_product(
+            "Casque Gaming RGB",
+            "casques",
+            65.00,
+            "Casque gaming avec éclairage RGB et son immersif. Compatible toutes plateformes.",
+            "https://images.unsplash.com/photo-1600186279172-fdbaefd74383",
+            "Bon état",
+            None,
+            "RGB Gaming",
+            1
+        ),
+        
+        # Claviers
+        create_product(
+            "Clavier Mécanique RGB",
+            "claviers",
+            75.00,
+            "Clavier mécanique gaming avec switches Blue et rétroéclairage RGB personnalisable.",
+            "https://images.unsplash.com/photo-1612198188060-c7c2a3b66eae",
+            "Très bon état",
+            None,
+            "Mechanical Pro",
+            2
+        ),
+        create_product(
+            "Clavier Gaming Compact",
+            "claviers",
+            55.00,
+            "Clavier gaming compact 60% avec éclairage RGB. Parfait pour l'esport.",
+            "https://images.unsplash.com/photo-1631449061775-c79df03a44f6",
+            "Excellent état",
+            None,
+            "Compact Gaming",
+            1
+        ),
+        
+        # Souris
+        create_product(
+            "Souris Gaming RGB",
+            "souris",
+            42.00,
+            "Souris gaming haute précision avec capteur optique 12000 DPI et éclairage RGB.",
+            "https://images.unsplash.com/photo-1628832307345-7404b47f1751",
+            "Très bon état",
+            None,
+            "Gaming RGB",
+            3
+        ),
+        create_product(
+            "Souris Esport Pro",
+            "souris",
+            38.00,
+            "Souris gaming professionnelle utilisée par les joueurs esport. Très légère.",
+            "https://images.pexels.com/photos/2115256/pexels-photo-2115256.jpeg",
+            "Bon état",
+            None,
+            "Esport Pro",
+            2
+        ),
+        
+        # Jeux vidéo
+        create_product(
+            "Call of Duty Modern Warfare",
+            "jeux",
+            35.00,
+            "Jeu Call of Duty Modern Warfare pour PlayStation 4. Excellent état.",
+            "https://images.pexels.com/photos/8307628/pexels-photo-8307628.jpeg",
+            "Excellent état",
+            "PlayStation 4",
+            "Activision",
+            1
+        ),
+    ]
+
+
+class Bootstrap:
+    """Brings the database to the state the application expects.
+
+    Seeds the sample catalog into an empty database when asked to, removes
+    legacy data, then creates missing indexes one at a time, unique ones
+    first. It runs as a background task: the server answers requests while
+    indexes build (Mongo 4.2+ builds never hold an exclusive collection
+    lock), and status() backs the readiness probe, which waits for the
+    unique indexes alone: writes rely on their duplicate key errors, so
+    until they exist concurrent cart adds could create duplicate lines.
+    A failed step is reported by status() and retried with backoff, so a
+    transient Mongo error at boot does not need a restart; failed index
+    builds are retried once the others have been tried. Every step is
+    idempotent, so every replica runs it on each boot.
+    """
+
+    def __init__(self, products: ProductRepository, carts: CartRepository,
+                 cart_ttl_seconds: int, seed_sample_data: bool = False,
+                 retry_delay: float = RETRY_DELAY_SECONDS, max_retry_delay: float = MAX_RETRY_DELAY_SECONDS):
+        self.products = products
+        self.carts = carts
+        self.seed_sample_data = seed_sample_data
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.indexes = required_indexes(cart_ttl_seconds)
+        self.index_status: Dict[str, str] = {spec.name: "pending" for spec in self.indexes}
+        self.seeded: Optional[int] = None
+        self.error: Optional[str] = None
+        self.retries = 0
+        self.done = asyncio.Event()
+
+    @property
+    def db(self):
+        return self.products.collection.database
+
+    async def run(self):
+        await self.retry("seed", self.seed)
+        await self.retry("migrate", self.migrate)
+        pending = sorted(self.indexes, key=lambda spec: not spec.options.get("unique"))
+        delay = self.retry_delay
+        while True:
+            for spec in pending:
+                await self.ensure_index(spec)
+            pending = [spec for spec in pending if self.index_status[spec.name] != "ready"]
+            if not pending:
+                break
+            self.retries += 1
+            print(f"Index builds failed, retrying in {delay:g}s: {', '.join(spec.name for spec in pending)}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_retry_delay)
+        self.done.set()
+
+    async def retry(self, step: str, run):
+        """Run a step until it succeeds; while it fails, error reports why."""
+        delay = self.retry_delay
+        while True:
+            try:
+                await run()
+                self.error = None
+                return
+            except Exception as e:
+                self.error = f"{step}: {e}"
+                self.retries += 1
+                print(f"Bootstrap {step} failed, retrying in {delay:g}s: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_retry_delay)
+
+    async def claim(self, task: str, lease_seconds: int = 300) -> bool:
+        """Claim a one-off task for this worker; False when another worker holds it.
+
+        The filter only matches a lapsed claim, so while one is held the
+        upsert collides with the existing _id and fails.
+        """
+        now = datetime.now(timezone.utc)
+        try:
+            await self.db.bootstrap.update_one(
+                {"_id": task, "claimed_at": {"$lt": now - timedelta(seconds=lease_seconds)}},
+                {"$set": {"claimed_at": now, "pid": os.getpid()}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            return False
+        return True
+
+    async def seed(self):
+        # estimated_document_count reads collection metadata instead of scanning
+        if not self.seed_sample_data or await self.products.collection.estimated_document_count() > 0:
+            return
+        # Every worker boots at once; only one of them seeds
+        if await self.claim("seed_sample_data"):
+            products = sample_products()
+            try:
+                await self.products.insert_many(products)
+            except Exception:
+                # Let the retry, here or in another worker, claim it again
+                await self.db.bootstrap.delete_one({"_id": "seed_sample_data"})
+                raise
+            self.seeded = len(products)
+            print("Sample products inserted successfully!")
+
+    async def migrate(self):
+        # Lines from the single shared cart predate cart ids
+        await self.carts.collection.delete_many({"cart_id": {"$exists": False}})
+
+    async def ensure_index(self, spec: IndexSpec):
+        collection = self.db[spec.collection]
+        self.index_status[spec.name] = "building"
+        try:
+            try:
+                await collection.create_index(spec.keys, name=spec.name, **spec.options)
+            except OperationFailure as e:
+                if e.code not in INDEX_CONFLICT_CODES:
+                    raise
+                # Same name with other keys or options, e.g. a changed cart TTL
+                await collection.drop_index(spec.name)
+                await collection.create_index(spec.keys, name=spec.name, **spec.options)
+            self.index_status[spec.name] = "ready"
+        except Exception as e:
+            # A failed build (say, duplicate ids blocking the unique index)
+            # is reported by the probe and retried after the other builds
+            self.index_status[spec.name] = f"failed: {e}"
+
+    def status(self) -> dict:
+        return {
+            "done": self.done.is_set(),
+            "error": self.error,
+            "retries": self.retries,
+            "seeded": self.seeded,
+            "indexes": dict(self.index_status),
+            "indexes_ready": all(status == "ready" for status in self.index_status.values()),
+            "unique_indexes_ready": self.unique_indexes_ready(),
+        }
+
+    def unique_indexes_ready(self) -> bool:
+        """Whether every unique index is built; a failed one is retried, and waited on."""
+        return all(self.index_status[spec.name] == "ready" for spec in self.indexes if spec.options.get("unique"))
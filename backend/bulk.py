@@ -0,0 +1,178 @@
+import codecs
+import csv
+import io
+import json
+from typing import AsyncIterable, AsyncIterator, Iterable, List, Optional, Tuple
+
+from pydantic import ValidationError
+
+from models import ProductIn
+
+# Columns written by the CSV export and expected by the CSV import
+CSV_COLUMNS = list(ProductIn.model_fields) + ["created_at"]
+
+# A parsed row: its 1-based position in the feed and either a dict or an error
+Row = Tuple[int, Optional[dict], Optional[str]]
+
+
+async def iter_lines(chunks: AsyncIterable[bytes]) -> AsyncIterator[str]:
+    """Decode a byte stream into lines without buffering more than one line."""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = ""
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending.rstrip("\r")
+
+
+async def parse_ndjson(chunks: AsyncIterable[bytes]) -> AsyncIterator[Row]:
+    row = 0
+    async for line in iter_lines(chunks):
+        if not line.strip():
+            continue
+        row += 1
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield row, None, f"Invalid JSON: {e}"
+            continue
+        if not isinstance(record, dict):
+            yield row, None, "Expected a JSON object"
+            continue
+        yield row, record, None
+
+
+async def parse_csv(chunks: AsyncIterable[bytes]) -> AsyncIterator[Row]:
+    header = None
+    row = 0
+    record = ""
+    async for line in iter_lines(chunks):
+        # A quoted field may span lines; wait until its quotes are balanced
+        record = f"{record}\n{line}" if record else line
+        if record.count('"') % 2:
+            continue
+        text, record = record, ""
+        if not text.strip():
+            continue
+        values = next(csv.reader([text]))
+        if header is None:
+            header = [column.strip() for column in values]
+            continue
+        row += 1
+        if len(values) != len(header):
+            yield row, None, f"Expected {len(header)} columns, got {len(values)}"
+            continue
+        # Empty cells mean "not set", so optional fields fall back to defaults
+        yield row, {column: value for column, value in zip(header, values) if value != ""}, None
+    if record:
+        yield row + 1, None, "Unterminated quoted field"
+
+
+def validate(record: dict) -> Tuple[Optional[dict], Optional[str]]:
+    try:
+        return ProductIn.model_validate(record).model_dump(), None
+    except ValidationError as e:
+        return None, "; ".join(
+            f"{'.'.join(str(part) for part in error['loc']) or 'row'}: {error['msg']}"
+            for error in e.errors()
+        )
+
+
+def encode_ndjson(products: Iterable[dict]) -> bytes:
+    return "".join(
+        json.dumps(product, ensure_ascii=False, separators=(",", ":")) + "\n"
+        for product in products
+    ).encode("utf-8")
+
+
+def encode_csv(products: Iterable[dict], header: bool = False) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=CSV_COLUMNS, extrasaction="ignore")
+    if header:
+        writer.writeheader()
+    writer.writerows(products)
+    return buffer.getvalue().encode("utf-8")
+
+
+async def export_batches(products: AsyncIterable[dict], fmt: str, batch_size: int) -> AsyncIterator[bytes]:
+    """Encode products a batch at a time as they come off the cursor."""
+    batch: List[dict] = []
+    first = True
+    async for product in products:
+        batch.append(product)
+        if len(batch) >= batch_size:
+            yield encode_csv(batch, header=first) if fmt == "csv" else encode_ndjson(batch)
+            batch = []
+            first = False
+    if batch or (first and fmt == "csv"):
+        yield encode_csv(batch, header=first) if fmt == "csv" else encode_ndjson(batch)
+
+
+class ImportReport:
+    """Counters and a bounded list of per-row errors for one import."""
+
+    def __init__(self, max_errors: int):
+        self.max_errors = max_errors
+        self.rows = 0
+        self.inserted = 0
+        # Rows for existing products, and those of them that changed anything
+        self.matched = 0
+        self.updated = 0
+        self.failed = 0
+        self.errors: List[dict] = []
+
+    def error(self, row: int, message: str):
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({"row": row, "error": message})
+
+    def as_dict(self, elapsed: float) -> dict:
+        return {
+            "rows": self.rows,
+            "inserted": self.inserted,
+            "matched": self.matched,
+            "updated": self.updated,
+            "failed": self.failed,
+            "errors": self.errors,
+            "errors_truncated": self.failed > len(self.errors),
+            "elapsed_s": round(elapsed, 3),
+            "rows_per_second": round(self.rows / elapsed, 1) if elapsed else None,
+        }
+
+
+async def import_rows(rows: AsyncIterable[Row], write_batch, batch_size: int, report: ImportReport):
+    """Validate parsed rows and hand them to write_batch in fixed-size batches.
+
+    write_batch receives a list of products and returns (inserted, matched,
+    updated, [(index in batch, error)]). Only one batch is held at a time.
+    """
+    batch: List[dict] = []
+    positions: List[int] = []
+
+    async def flush():
+        inserted, matched, updated, errors = await write_batch(batch)
+        report.inserted += inserted
+        report.matched += matched
+        report.updated += updated
+        for index, message in errors:
+            report.error(positions[index], message)
+        batch.clear()
+        positions.clear()
+
+    async for row, record, error in rows:
+        report.rows += 1
+        if record is not None:
+            record, error = validate(record)
+        if error:
+            report.error(row, error)
+            continue
+        batch.append(record)
+        positions.append(row)
+        if len(batch) >= batch_size:
+            await flush()
+    if batch:
+        await flush()
@@ -0,0 +1,141 @@
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Dict, FrozenSet, Hashable, Iterable, NamedTuple, Optional, Set
+
+
+class CachedResponse(NamedTuple):
+    body: bytes
+    etag: str
+    expires_at: float
+    product_ids: FrozenSet[str] = frozenset()
+
+
+def make_etag(body: bytes) -> str:
+    """Weak ETag of a body.
+
+    Compression changes the bytes sent but not the representation, and a
+    304 has no body from which to tell whether the 200 was compressed, so
+    the validator is weak whatever the encoding and the same on both.
+    """
+    return 'W/"%s"' % hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against an ETag."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = (tag.strip() for tag in if_none_match.split(","))
+    opaque = etag.removeprefix("W/")
+    return any(tag.removeprefix("W/") == opaque for tag in candidates)
+
+
+# In the product ids of a response: it shows the stock of products it
+# cannot name, so a stock change to any product drops it
+ANY_PRODUCT = "*"
+
+
+class ResponseCache:
+    """Size-bounded LRU of encoded responses with a TTL per entry.
+
+    Every write to the underlying data bumps the version and drops all
+    entries; a response produced under an older version is not stored, so a
+    read racing a write cannot repopulate the cache with stale data.
+
+    Stock changes, one per cart reservation, are far more frequent than
+    other writes, so they only drop the responses showing the stock of the
+    products concerned: each entry is stored with those product ids, and a
+    response read before a stock change to one of them is not stored.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 60.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries: "OrderedDict[Hashable, CachedResponse]" = OrderedDict()
+        # Product id to the keys of the entries showing its stock
+        self.showing: Dict[str, Set[Hashable]] = {}
+        self.version = 0
+        # Version of the last write dropping everything, and of the last
+        # stock change of each product since then
+        self.flushed_at = 0
+        self.stock_changed_at: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.stock_invalidations = 0
+
+    def get(self, key: Hashable) -> Optional[CachedResponse]:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry.expires_at <= time.monotonic():
+            self._drop(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def set(self, key: Hashable, body: bytes, version: int,
+            product_ids: Iterable[str] = ()) -> CachedResponse:
+        """Store a response read under version; product_ids are those whose stock it shows."""
+        product_ids = frozenset(product_ids)
+        entry = CachedResponse(body, make_etag(body), time.monotonic() + self.ttl_seconds, product_ids)
+        if self.max_entries <= 0 or self.flushed_at > version or any(
+                self.stock_changed_at.get(product_id, 0) > version for product_id in product_ids):
+            return entry
+        if key in self.entries:
+            self._drop(key)
+        self.entries[key] = entry
+        for product_id in product_ids:
+            self.showing.setdefault(product_id, set()).add(key)
+        while len(self.entries) > self.max_entries:
+            self._drop(next(iter(self.entries)))
+            self.evictions += 1
+        return entry
+
+    def _drop(self, key: Hashable):
+        entry = self.entries.pop(key)
+        for product_id in entry.product_ids:
+            keys = self.showing[product_id]
+            keys.discard(key)
+            if not keys:
+                del self.showing[product_id]
+
+    def invalidate(self):
+        self.version += 1
+        self.flushed_at = self.version
+        self.invalidations += 1
+        self.entries.clear()
+        self.showing.clear()
+        self.stock_changed_at.clear()
+
+    def on_products_changed(self, changed: Iterable[dict], removed_ids: Iterable[str] = ()):
+        self.invalidate()
+
+    def on_stock_changed(self, product_ids: Iterable[str]):
+        self.version += 1
+        for product_id in (*product_ids, ANY_PRODUCT):
+            self.stock_changed_at[product_id] = self.version
+            for key in list(self.showing.get(product_id, ())):
+                self._drop(key)
+                self.stock_invalidations += 1
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "version": self.version,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+            "stock_invalidations": self.stock_invalidations,
+        }
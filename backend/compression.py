@@ -0,0 +1,160 @@
+import zlib
+from collections import OrderedDict
+from typing import Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+# Content types worth compressing; images and archives are already compressed
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/", "image/svg+xml")
+
+# Long-lived event streams: a compressor per connection costs more memory
+# than their small, sparse frames save
+UNCOMPRESSED_TYPES = ("text/event-stream",)
+
+
+def negotiate(accept_encoding: str) -> Optional[str]:
+    """Preferred supported encoding for an Accept-Encoding header, br over gzip on ties."""
+    weights = {}
+    for part in accept_encoding.lower().split(","):
+        coding, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        weights[coding.strip()] = q
+    wildcard = weights.get("*", 0.0)
+    candidates = ["br", "gzip"] if brotli is not None else ["gzip"]
+    best, best_q = None, 0.0
+    for coding in candidates:
+        q = weights.get(coding, wildcard)
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+class StreamCompressor:
+    """Incremental gzip or brotli, flushing after every chunk so batches go out as produced."""
+
+    def __init__(self, encoding: str, gzip_level: int, brotli_quality: int):
+        self.encoding = encoding
+        if encoding == "br":
+            self.compressor = brotli.Compressor(quality=brotli_quality)
+        else:
+            self.compressor = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        if self.encoding == "br":
+            return self.compressor.process(data) + self.compressor.flush()
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        if self.encoding == "br":
+            return self.compressor.finish()
+        return self.compressor.flush(zlib.Z_FINISH)
+
+
+def compress(body: bytes, encoding: str, gzip_level: int, brotli_quality: int) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=brotli_quality)
+    compressor = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)
+    return compressor.compress(body) + compressor.flush()
+
+
+class CompressionMiddleware:
+    """ASGI middleware compressing responses with brotli (when installed) or gzip.
+
+    Whole bodies below minimum_size are sent as is. Streamed bodies are
+    compressed chunk by chunk. Compressed bodies of responses carrying an
+    ETag are kept in a small LRU keyed by (ETag, encoding), so cached
+    catalog responses are compressed once rather than on every request.
+    """
+
+    def __init__(self, app, minimum_size: int = 1024, gzip_level: int = 6,
+                 brotli_quality: int = 4, cache_entries: int = 256):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.cache_entries = cache_entries
+        self.compressed: "OrderedDict[tuple, bytes]" = OrderedDict()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        encoding = negotiate(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            return await self.app(scope, receive, send)
+
+        start = None
+        compressor = None
+
+        async def send_compressed(message):
+            nonlocal start, compressor
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                return await send(message)
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start is not None:
+                initial, start = start, None
+                headers = MutableHeaders(raw=initial.setdefault("headers", []))
+                if not self.compressible(initial["status"], headers) or (
+                        not more_body and len(body) < self.minimum_size):
+                    await send(initial)
+                    return await send(message)
+                headers["Content-Encoding"] = encoding
+                headers.add_vary_header("Accept-Encoding")
+                etag = headers.get("etag")
+                if etag and not etag.startswith("W/"):
+                    # The encoded body differs byte for byte from the identity one. A
+                    # 304 goes out as is, so routes answering If-None-Match on
+                    # compressible bodies send weak ETags themselves (see make_etag)
+                    headers["ETag"] = f"W/{etag}"
+                if more_body:
+                    del headers["Content-Length"]
+                    compressor = StreamCompressor(encoding, self.gzip_level, self.brotli_quality)
+                else:
+                    body = self.compress_whole(body, encoding, etag)
+                    headers["Content-Length"] = str(len(body))
+                    await send(initial)
+                    return await send({"type": "http.response.body", "body": body})
+                await send(initial)
+
+            if compressor is None:
+                return await send(message)
+            data = compressor.compress(body) if body else b""
+            if not more_body:
+                data += compressor.finish()
+            await send({"type": "http.response.body", "body": data, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
+
+    def compressible(self, status: int, headers: MutableHeaders) -> bool:
+        if status < 200 or status in (204, 304) or "content-encoding" in headers:
+            return False
+        content_type = headers.get("content-type", "")
+        return content_type.startswith(COMPRESSIBLE_TYPES) and not content_type.startswith(UNCOMPRESSED_TYPES)
+
+    def compress_whole(self, body: bytes, encoding: str, etag: Optional[str]) -> bytes:
+        key = (etag, encoding)
+        if etag:
+            compressed = self.compressed.get(key)
+            if compressed is not None:
+                self.compressed.move_to_end(key)
+                return compressed
+        compressed = compress(body, encoding, self.gzip_level, self.brotli_quality)
+        if etag and self.cache_entries > 0:
+            self.compressed[key] = compressed
+            while len(self.compressed) > self.cache_entries:
+                self.compressed.popitem(last=False)
+        return compressed
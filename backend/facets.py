@@ -0,0 +1,107 @@
+import bisect
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Dimensions counted by value
+FACET_FIELDS = ("category", "brand", "console", "condition")
+
+# Lower bounds of the price buckets; the last bucket is open-ended
+PRICE_BUCKETS = [0, 25, 50, 100, 200, 500]
+
+
+def price_bucket(price) -> Optional[int]:
+    """Lower bound of the bucket a price falls in."""
+    if price is None or price < PRICE_BUCKETS[0]:
+        return None
+    return PRICE_BUCKETS[bisect.bisect_right(PRICE_BUCKETS, price) - 1]
+
+
+def facet_pipeline(query: dict) -> List[dict]:
+    """One $facet aggregation counting every dimension for the matching products."""
+    facets = {
+        field: [
+            {"$match": {field: {"$ne": None}}},
+            {"$group": {"_id": f"${field}", "count": {"$sum": 1}}},
+        ]
+        for field in FACET_FIELDS
+    }
+    facets["price"] = [{"$bucket": {
+        "groupBy": "$price",
+        "boundaries": PRICE_BUCKETS,
+        "default": PRICE_BUCKETS[-1],
+        "output": {"count": {"$sum": 1}},
+    }}]
+    facets["total"] = [{"$count": "count"}]
+    return [{"$match": query}, {"$facet": facets}]
+
+
+def format_facets(value_counts: Dict[str, Dict], price_counts: Dict[int, int], total: int) -> dict:
+    facets = {
+        field: [
+            {"value": value, "count": count}
+            for value, count in sorted(value_counts[field].items(), key=lambda item: (-item[1], str(item[0])))
+            if count > 0
+        ]
+        for field in FACET_FIELDS
+    }
+    facets["price"] = [
+        {"min": low, "max": high, "count": price_counts.get(low, 0)}
+        for low, high in zip(PRICE_BUCKETS, PRICE_BUCKETS[1:] + [None])
+    ]
+    return {"facets": facets, "total": total}
+
+
+def format_aggregation(result: dict) -> dict:
+    """Shape the output of facet_pipeline like FacetSummary.as_dict."""
+    value_counts = {
+        field: {bucket["_id"]: bucket["count"] for bucket in result[field]}
+        for field in FACET_FIELDS
+    }
+    price_counts = {bucket["_id"]: bucket["count"] for bucket in result["price"]}
+    total = result["total"][0]["count"] if result["total"] else 0
+    return format_facets(value_counts, price_counts, total)
+
+
+class FacetSummary:
+    """Facet counts over the whole catalog, maintained on every product write.
+
+    Serves the unfiltered facet view and the category list without a
+    round-trip to Mongo.
+    """
+
+    def __init__(self):
+        self.products: Dict[str, Tuple] = {}
+        self.counts: Dict[str, Counter] = {field: Counter() for field in FACET_FIELDS}
+        self.prices: Counter = Counter()
+        self.ready = False
+
+    def _apply(self, values: Tuple, delta: int):
+        *fields, price = values
+        for field, value in zip(FACET_FIELDS, fields):
+            if value is not None:
+                self.counts[field][value] += delta
+        if price is not None:
+            self.prices[price] += delta
+
+    def add(self, product: dict):
+        self.remove(product["id"])
+        values = tuple(product.get(field) for field in FACET_FIELDS) + (price_bucket(product.get("price")),)
+        self.products[product["id"]] = values
+        self._apply(values, 1)
+
+    def remove(self, product_id: str):
+        values = self.products.pop(product_id, None)
+        if values is not None:
+            self._apply(values, -1)
+
+    def on_products_changed(self, changed: Iterable[dict], removed_ids: Iterable[str] = ()):
+        for product in changed:
+            self.add(product)
+        for product_id in removed_ids:
+            self.remove(product_id)
+
+    def categories(self) -> List[str]:
+        return sorted(value for value, count in self.counts["category"].items() if count > 0)
+
+    def as_dict(self) -> dict:
+        return format_facets(self.counts, self.prices, len(self.products))
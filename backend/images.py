@@ -0,0 +1,518 @@
+import asyncio
+import hashlib
+import http.client
+import io
+import ipaddress
+import math
+import multiprocessing
+import os
+import re
+import socket
+import time
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # no variants: products keep serving their image_url
+    Image = None
+
+from pymongo import ReturnDocument
+
+from jobs import JobQueue
+from metrics import registry
+from repository import ProductRepository
+
+# Variant formats, best first, and their media types
+MEDIA_TYPES = {"avif": "image/avif", "webp": "image/webp"}
+
+# Encoder settings beyond quality: AVIF's default speed takes over three
+# times as long for files about 1% smaller
+ENCODER_OPTIONS = {"avif": {"speed": 8}}
+
+# Sources are keyed by the SHA-256 of their bytes
+KEY_RE = re.compile(r"^[0-9a-f]{64}$")
+VARIANT_RE = re.compile(r"^(\d+)\.([a-z]+)$")
+
+# EXIF tag for how the camera was held
+EXIF_ORIENTATION = 0x0112
+
+# Widest variant used as src, for clients without srcset
+DEFAULT_WIDTH = 640
+
+# Eviction frees space down to this share of the cache bound, so it runs rarely
+LOW_WATERMARK = 0.9
+
+# Source widths remembered, so requests for widths a source has no variant
+# of are answered without a render
+MAX_SOURCE_WIDTHS = 100_000
+
+image_renders = registry.counter("image_variants_rendered_total", "Image variants rendered, by format", ("format",))
+image_render_duration = registry.histogram(
+    "image_render_seconds", "Time to render the variants of one image in the process pool")
+image_cache_bytes = registry.gauge("image_cache_bytes", "Bytes of image variants on disk, as last counted")
+image_cache_evictions = registry.counter("image_cache_evictions_total", "Image variants evicted from disk")
+
+
+class ImageError(ValueError):
+    """The source is not an image that can be read, or is too large."""
+
+
+def _write(path: str, data: bytes):
+    """Write through a temporary file, so readers never see a partial image."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as f:
+        f.write(data)
+    os.replace(temporary, path)
+
+
+def variant_widths(widths: Sequence[int], width: int) -> List[int]:
+    """Widths rendered for a source this wide: those it covers, or the smallest."""
+    return [target for target in widths if target <= width] or [min(widths)]
+
+
+def render(source: str, directory: str, widths: Sequence[int], formats: Sequence[str],
+           quality: Dict[str, int], max_pixels: int,
+           only: Optional[Tuple[int, str]] = None) -> Tuple[int, int, List[Tuple[int, str, str, int]]]:
+    """Resize a source to each width and encode it in each format; runs in the process pool.
+
+    Widths above the source's are skipped, unless all are, in which case
+    the smallest is rendered. Variants already on disk are not rendered
+    again, and with only, just that (width, format) is. The decoding does
+    not depend on only, so a variant rendered again has the same bytes.
+    Returns the source's size and the (width, format, path, bytes) of
+    every variant.
+    """
+    Image.MAX_IMAGE_PIXELS = max_pixels
+    try:
+        with Image.open(source) as image:
+            # Phones store rotation in EXIF rather than in the pixels
+            rotated = image.getexif().get(EXIF_ORIENTATION, 1) >= 5
+            width, height = image.size[::-1] if rotated else image.size
+            targets = variant_widths(widths, width)
+            # JPEGs decode straight at a fraction of their size
+            scale = max(targets) / width
+            image.draft("RGB", (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+            image = ImageOps.exif_transpose(image)
+            image = image.convert("RGBA" if image.has_transparency_data else "RGB")
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ImageError(f"Unreadable image: {e}") from None
+
+    variants = []
+    for target in targets:
+        resized = None
+        for fmt in formats:
+            if only is not None and (target, fmt) != only:
+                continue
+            path = os.path.join(directory, f"{target}.{fmt}")
+            if not os.path.exists(path):
+                if resized is None:
+                    size = (target, max(1, round(image.height * target / image.width)))
+                    resized = image.resize(size, Image.LANCZOS, reducing_gap=2.0)
+                buffer = io.BytesIO()
+                resized.save(buffer, fmt.upper(), quality=quality.get(fmt, 75), **ENCODER_OPTIONS.get(fmt, {}))
+                _write(path, buffer.getvalue())
+            variants.append((target, fmt, path, os.path.getsize(path)))
+    return width, height, variants
+
+
+class ImageStore:
+    """Content-addressed product images and their resized variants on disk.
+
+    A source is stored once under the SHA-256 of its bytes, however many
+    products or URLs share it, and each variant is derived from its source
+    alone, so a variant URL never changes meaning and is served as
+    immutable. Sources are kept. Variants are a cache bounded by max_bytes:
+    past it, those served least recently are deleted, and rendered again
+    from their source when next requested.
+
+    Each worker orders the variants it has written or served; eviction
+    rescans the directory, so files written by other workers count too,
+    oldest first. Decoding, resizing and encoding run in a process pool,
+    never on the event loop or in the API workers.
+    """
+
+    def __init__(self, directory: str, widths: Sequence[int] = (160, 320, 640, 1280),
+                 formats: Sequence[str] = ("avif", "webp"), quality: Optional[Dict[str, int]] = None,
+                 max_bytes: int = 2 * 2 ** 30, processes: int = 2, max_pixels: int = 64_000_000,
+                 base_url: str = "/api/images"):
+        self.directory = directory
+        self.widths = sorted(widths)
+        self.formats = [fmt for fmt in formats if fmt in MEDIA_TYPES and Image is not None and features.check(fmt)]
+        self.quality = quality or {"avif": 55, "webp": 80}
+        self.max_bytes = max_bytes
+        self.processes = processes
+        self.max_pixels = max_pixels
+        self.base_url = base_url
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.entries: "OrderedDict[str, int]" = OrderedDict()
+        self.total = 0
+        self.rendering: Dict[tuple, asyncio.Future] = {}
+        self.source_widths: "OrderedDict[str, int]" = OrderedDict()
+        self.evicting = False
+        self.renders = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.formats)
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        if self.executor is None:
+            # spawn: forking a process running the event loop and Motor's threads is unsafe
+            self.executor = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context("spawn"))
+        return self.executor
+
+    def source_path(self, key: str) -> str:
+        return os.path.join(self.directory, "sources", key[:2], key)
+
+    def variant_directory(self, key: str) -> str:
+        return os.path.join(self.directory, "variants", key[:2], key)
+
+    def url(self, key: str, width: int, fmt: str) -> str:
+        return f"{self.base_url}/{key}/{width}.{fmt}"
+
+    async def ingest(self, data: bytes) -> dict:
+        """Store a source image and render all its variants; the product's image field for it."""
+        key = hashlib.sha256(data).hexdigest()
+        path = self.source_path(key)
+        if not os.path.exists(path):
+            await asyncio.to_thread(_write, path, data)
+        width, height, variants = await self.render(key)
+        return self.describe(key, width, height, sorted({variant[0] for variant in variants}))
+
+    def describe(self, key: str, width: int, height: int, widths: List[int]) -> dict:
+        """Image fields for a product: src for plain <img>, a srcset per media type for <picture>."""
+        default = max([w for w in widths if w <= DEFAULT_WIDTH] or widths)
+        return {
+            "key": key,
+            "width": width,
+            "height": height,
+            "widths": widths,
+            "src": self.url(key, default, self.formats[-1]),
+            "srcset": {
+                MEDIA_TYPES[fmt]: ", ".join(f"{self.url(key, w, fmt)} {w}w" for w in widths)
+                for fmt in self.formats
+            },
+        }
+
+    async def render(self, key: str, only: Optional[Tuple[int, str]] = None):
+        """Render variants in the pool; concurrent requests for the same ones share a render."""
+        flight = (key, only)
+        future = self.rendering.get(flight)
+        if future is not None:
+            return await asyncio.shield(future)
+        started = time.perf_counter()
+        future = asyncio.get_running_loop().run_in_executor(
+            self.pool, render, self.source_path(key), self.variant_directory(key), self.widths, self.formats,
+            self.quality, self.max_pixels, only)
+        self.rendering[flight] = future
+        try:
+            width, height, variants = await asyncio.shield(future)
+        finally:
+            del self.rendering[flight]
+        image_render_duration.observe(time.perf_counter() - started)
+        self.source_widths[key] = width
+        self.source_widths.move_to_end(key)
+        if len(self.source_widths) > MAX_SOURCE_WIDTHS:
+            self.source_widths.popitem(last=False)
+        for _, fmt, path, size in variants:
+            if path not in self.entries:
+                self.renders += 1
+                image_renders.inc(fmt)
+            self.add(path, size)
+        return width, height, variants
+
+    async def read(self, key: str, width: int, fmt: str) -> Optional[bytes]:
+        """A variant's bytes, rendered from its source if evicted; None if it has no such variant."""
+        source_width = self.source_widths.get(key)
+        if source_width is not None and width not in variant_widths(self.widths, source_width):
+            return None
+        path = os.path.join(self.variant_directory(key), f"{width}.{fmt}")
+        try:
+            data = await asyncio.to_thread(_read, path)
+        except FileNotFoundError:
+            if not os.path.exists(self.source_path(key)):
+                return None
+            # Renders nothing for a width the source is too small for, and
+            # remembers the source's width so the next request skips the render
+            _, _, variants = await self.render(key, (width, fmt))
+            if not variants:
+                return None
+            try:
+                data = await asyncio.to_thread(_read, path)
+            except FileNotFoundError:
+                # Evicted again before it could be read
+                return None
+        if path in self.entries:
+            self.entries.move_to_end(path)
+        else:
+            self.add(path, len(data))
+        return data
+
+    def add(self, path: str, size: int):
+        if path in self.entries:
+            self.entries.move_to_end(path)
+            return
+        self.entries[path] = size
+        self.total += size
+        image_cache_bytes.set(self.total)
+        if self.total > self.max_bytes and not self.evicting:
+            self.evicting = True
+            asyncio.get_running_loop().create_task(self.evict())
+
+    async def load(self):
+        """Count the variants already on disk, oldest first."""
+        files = await asyncio.to_thread(_scan, os.path.join(self.directory, "variants"))
+        self.entries = OrderedDict((path, size) for path, (_, size) in sorted(files.items(), key=lambda f: f[1][0]))
+        self.total = sum(self.entries.values())
+        image_cache_bytes.set(self.total)
+
+    async def evict(self):
+        self.evicting = True
+        try:
+            files = await asyncio.to_thread(_scan, os.path.join(self.directory, "variants"))
+            # Other workers' variants by age, then this worker's least recently served first
+            order = sorted((path for path in files if path not in self.entries), key=lambda path: files[path][0])
+            order += [path for path in self.entries if path in files]
+            total = sum(size for _, size in files.values())
+            victims = []
+            for path in order:
+                if total <= self.max_bytes * LOW_WATERMARK:
+                    break
+                victims.append(path)
+                total -= files[path][1]
+            await asyncio.to_thread(_remove, victims)
+
+            evicted = set(victims)
+            entries = OrderedDict((path, files[path][1]) for path in order if path not in evicted)
+            # Variants added while scanning
+            for path, size in self.entries.items():
+                if path not in files:
+                    entries[path] = size
+            self.entries = entries
+            self.total = sum(entries.values())
+            self.evictions += len(victims)
+            image_cache_evictions.inc(amount=len(victims))
+            image_cache_bytes.set(self.total)
+        finally:
+            self.evicting = False
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        return {"enabled": self.enabled, "formats": self.formats, "widths": self.widths,
+                "variants": len(self.entries), "bytes": self.total, "max_bytes": self.max_bytes,
+                "rendered": self.renders, "evicted": self.evictions, "source_widths": len(self.source_widths)}
+
+
+def _read(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _scan(directory: str) -> Dict[str, Tuple[float, int]]:
+    """Modification time and size of every variant under directory."""
+    files = {}
+    for root, _, names in os.walk(directory):
+        for name in names:
+            if name.endswith(".tmp"):
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files[path] = (stat.st_mtime, stat.st_size)
+    return files
+
+
+def _remove(paths: List[str]):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _is_public(address: str) -> bool:
+    """Whether an IP address is on the public internet: not private, loopback, link-local or reserved."""
+    ip = ipaddress.ip_address(address.split("%")[0])
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def _connect_public(address: Tuple[str, int], timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+    """socket.create_connection to a host that resolves to public addresses only.
+
+    The connection is made to the addresses checked, not to the name, so a
+    DNS answer that changes in between cannot point it elsewhere.
+    """
+    host, port = address
+    resolved = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    for *_, sockaddr in resolved:
+        if not _is_public(sockaddr[0]):
+            raise ImageError(f"Image host {host} resolves to a non-public address: {sockaddr[0]}")
+    error = None
+    for family, kind, proto, _, sockaddr in resolved:
+        sock = socket.socket(family, kind, proto)
+        try:
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            return sock
+        except OSError as e:
+            sock.close()
+            error = e
+    raise error or OSError(f"No address for {host}")
+
+
+class _PublicHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _connect_public
+
+
+class _PublicHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _connect_public
+
+
+class _PublicHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, request):
+        return self.do_open(_PublicHTTPConnection, request)
+
+
+class _PublicHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, request):
+        return self.do_open(_PublicHTTPSConnection, request, context=self._context)
+
+
+class _CheckedRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """Follows a redirect only to a URL the first request could have had."""
+
+    def __init__(self, check):
+        self.check = check
+
+    def redirect_request(self, request, fp, code, msg, headers, url):
+        self.check(url)
+        return super().redirect_request(request, fp, code, msg, headers, url)
+
+
+class ProductImages:
+    """Keeps each product's image field in step with its image_url.
+
+    A product write whose image_url has no variants yet queues a job that
+    fetches the URL and ingests it, unless an upload was made for it; the job writes the image field only if
+    image_url is still the one fetched. With several workers each may
+    queue the job, and later runs find the image done and return. Sources
+    are fetched from file:// URLs under local_root, which is how tests and
+    imports from disk avoid the network, or over http(s) from hosts that
+    resolve to public addresses only, and are in allowed_hosts if it is
+    given; redirects are checked the same way. image_url comes from
+    product imports, so this keeps it from reaching internal services.
+    Fetches connect directly, never through a proxy.
+    """
+
+    def __init__(self, products: ProductRepository, store: ImageStore, jobs: JobQueue,
+                 max_source_bytes: int = 20 * 2 ** 20, fetch_timeout: float = 20.0,
+                 local_root: Optional[str] = None, allowed_hosts: Iterable[str] = ()):
+        self.products = products
+        self.store = store
+        self.jobs = jobs
+        self.max_source_bytes = max_source_bytes
+        self.fetch_timeout = fetch_timeout
+        self.local_root = os.path.realpath(local_root) if local_root else None
+        self.allowed_hosts = {host.lower() for host in allowed_hosts if host}
+        self.opener = urllib.request.build_opener(
+            urllib.request.ProxyHandler({}), _PublicHTTPHandler, _PublicHTTPSHandler,
+            _CheckedRedirectHandler(self.check_remote_url))
+        self.tasks: Set[asyncio.Task] = set()
+
+    def register(self, jobs: JobQueue):
+        jobs.register("product_image", self.ingest_url)
+
+    def on_products_changed(self, changed, removed_ids=()):
+        if not self.store.enabled or self.jobs.collection is None:
+            return
+        stale = [
+            product["id"] for product in changed
+            if product.get("image_url") and product["image_url"] != (product.get("image") or {}).get("source_url")
+        ]
+        if stale:
+            task = asyncio.get_running_loop().create_task(
+                self.jobs.enqueue(self.jobs.job("product_image", {"product_id": product_id}) for product_id in stale))
+            self.tasks.add(task)
+            task.add_done_callback(self._enqueued)
+
+    def _enqueued(self, task: asyncio.Task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Product image jobs not queued: {task.exception()}")
+
+    async def ingest_url(self, payload: dict):
+        product = await self.products.collection.find_one(
+            {"id": payload["product_id"]}, {"_id": 0, "image_url": 1, "image.source_url": 1})
+        if product is None or (product.get("image") or {}).get("source_url") == product["image_url"]:
+            return
+        data = await asyncio.to_thread(self.fetch, product["image_url"])
+        await self.attach(payload["product_id"], await self.store.ingest(data), product["image_url"])
+
+    def fetch(self, url: str) -> bytes:
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme == "file":
+            path = os.path.realpath(urllib.request.url2pathname(parsed.path))
+            if self.local_root is None or os.path.commonpath([path, self.local_root]) != self.local_root:
+                raise ImageError(f"Local image outside the image root: {url}")
+        else:
+            self.check_remote_url(url)
+        request = urllib.request.Request(url, headers={"User-Agent": "gaming-store-images"})
+        with self.opener.open(request, timeout=self.fetch_timeout) as response:
+            data = response.read(self.max_source_bytes + 1)
+        if len(data) > self.max_source_bytes:
+            raise ImageError(f"Image larger than {self.max_source_bytes} bytes: {url}")
+        return data
+
+    def check_remote_url(self, url: str):
+        """Reject URLs other than http(s) to an allowed host; addresses are checked on connecting."""
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme not in ("http", "https") or not parsed.hostname:
+            raise ImageError(f"Unsupported image URL: {url}")
+        if self.allowed_hosts and parsed.hostname.lower() not in self.allowed_hosts:
+            raise ImageError(f"Image host not allowed: {url}")
+
+    async def upload(self, product_id: str, data: bytes) -> Optional[dict]:
+        """Replace a product's image with uploaded bytes; None for an unknown product.
+
+        image_url keeps the original URL, so exports re-import as they are
+        and a new image_url still replaces the upload; the image field is
+        marked as made from it, so the upload is not fetched over.
+        """
+        image = await self.store.ingest(data)
+        while True:
+            product = await self.products.collection.find_one({"id": product_id}, {"_id": 0, "image_url": 1})
+            if product is None:
+                return None
+            attached = await self.attach(product_id, {**image, "uploaded": True}, product["image_url"])
+            if attached is not None:
+                return attached
+
+    async def attach(self, product_id: str, image: dict, url: str) -> Optional[dict]:
+        # Another write may have changed the URL while this one was fetched
+        product = await self.products.collection.find_one_and_update(
+            {"id": product_id, "image_url": url}, {"$set": {"image": {**image, "source_url": url}}}, {"_id": 0},
+            return_document=ReturnDocument.AFTER)
+        if product is not None:
+            self.products.notify([product])
+        return product
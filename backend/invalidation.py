@@ -0,0 +1,271 @@
+import asyncio
+import json
+import os
+import socket
+from typing import Callable, Dict, Iterable, List, Optional
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from repository import ProductRepository
+
+# Product ids per datagram; well below the default unix socket buffer
+MAX_IDS_PER_MESSAGE = 1000
+
+# Fields written by reservations, releases and orders; updates touching
+# nothing else are stock-only changes
+STOCK_FIELDS = {"stock", "version"}
+
+# Errors for a resume token the oplog no longer holds: InvalidResumeToken,
+# ChangeStreamFatalError and ChangeStreamHistoryLost
+HISTORY_LOST_CODES = (260, 280, 286)
+
+# Products notified at a time when resyncing after lost events
+RESYNC_BATCH_SIZE = 1000
+
+
+class SocketBroadcast:
+    """Relays product writes between worker processes on one host.
+
+    Each worker binds a unix datagram socket in a shared directory. A write
+    in one worker sends the touched product ids to every other socket there.
+    The receiving workers reload those products from Mongo and replay them
+    through ProductRepository.notify, so their search index, facets and
+    caches stay in sync. Stock-only changes are replayed as they are,
+    through notify_stock, without a reload. Sockets left behind by dead workers are removed
+    when a send to them is refused.
+    """
+
+    def __init__(self, repository: ProductRepository, directory: str):
+        self.repository = repository
+        self.directory = directory
+        self.path = os.path.join(directory, f"{os.getpid()}.sock")
+        self.sock: Optional[socket.socket] = None
+        self.replaying = False
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.sock.bind(self.path)
+        asyncio.get_running_loop().add_reader(self.sock.fileno(), self._readable)
+        self.repository.add_listener(self.on_products_changed)
+        self.repository.add_stock_listener(self.on_stock_changed)
+
+    def stop(self):
+        if self.sock is None:
+            return
+        asyncio.get_running_loop().remove_reader(self.sock.fileno())
+        self.sock.close()
+        self.sock = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def peers(self) -> List[str]:
+        return [
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory)
+            if name.endswith(".sock") and os.path.join(self.directory, name) != self.path
+        ]
+
+    def on_products_changed(self, changed: Iterable[dict], removed_ids: Iterable[str] = ()):
+        # Writes replayed from another worker were already broadcast by it
+        if self.replaying or self.sock is None:
+            return
+        changed_ids = [product["id"] for product in changed if "id" in product]
+        removed_ids = list(removed_ids)
+        # An empty write still invalidates the caches of the other workers
+        for start in range(0, max(len(changed_ids), len(removed_ids), 1), MAX_IDS_PER_MESSAGE):
+            self._send(json.dumps({
+                "changed": changed_ids[start:start + MAX_IDS_PER_MESSAGE],
+                "removed": removed_ids[start:start + MAX_IDS_PER_MESSAGE],
+            }).encode())
+
+    def on_stock_changed(self, product_ids: List[str]):
+        if self.replaying or self.sock is None:
+            return
+        for start in range(0, len(product_ids), MAX_IDS_PER_MESSAGE):
+            self._send(json.dumps({"stock": product_ids[start:start + MAX_IDS_PER_MESSAGE]}).encode())
+
+    def _send(self, payload: bytes):
+        for peer in self.peers():
+            try:
+                self.sock.sendto(payload, peer)
+                self.sent += 1
+            except (ConnectionRefusedError, FileNotFoundError):
+                try:
+                    os.unlink(peer)
+                except FileNotFoundError:
+                    pass
+            except BlockingIOError:
+                # The peer is not draining its socket; its caches still expire by TTL
+                self.dropped += 1
+
+    def _readable(self):
+        while True:
+            try:
+                payload = self.sock.recv(65536)
+            except BlockingIOError:
+                return
+            self.received += 1
+            message = json.loads(payload)
+            if "stock" in message:
+                self.replay_stock(message["stock"])
+            else:
+                asyncio.create_task(self.replay(message["changed"], message["removed"]))
+
+    async def replay(self, changed_ids: List[str], removed_ids: List[str]):
+        products = []
+        if changed_ids:
+            products = [product async for product in self.repository.iter_all(query={"id": {"$in": changed_ids}})]
+        found = {product["id"] for product in products}
+        removed_ids = removed_ids + [product_id for product_id in changed_ids if product_id not in found]
+        self.replaying = True
+        try:
+            self.repository.notify(products, removed_ids)
+        finally:
+            self.replaying = False
+
+    def replay_stock(self, product_ids: List[str]):
+        self.replaying = True
+        try:
+            self.repository.notify_stock(product_ids)
+        finally:
+            self.replaying = False
+
+    def stats(self) -> dict:
+        return {"channel": "socket", "peers": len(self.peers()), "sent": self.sent,
+                "received": self.received, "dropped": self.dropped}
+
+
+class ChangeStreamFeed:
+    """Dispatches Mongo change stream events to this worker, across hosts too.
+
+    Needs a replica set or sharded cluster. A single database-level stream
+    per worker covers the products collection and every collection with a
+    handler. With sync_products, product changes are replayed through
+    ProductRepository.notify, and updates of stock alone through
+    notify_stock, as SocketBroadcast does: every worker, including the
+    writer, sees each change; listeners are idempotent, so the writer's
+    second notification costs only a redundant update. Deletions carry
+    only the Mongo _id, so they invalidate the caches without removing the
+    product from the search index and facets. After an interruption the
+    stream resumes from the last event seen. If the oplog no longer holds
+    that event, the stream starts afresh and the worker resyncs: every
+    product is notified again, and resync handlers are called. A handler
+    that raises is logged and does not stop the feed.
+    """
+
+    def __init__(self, repository: ProductRepository, sync_products: bool = True):
+        self.repository = repository
+        self.sync_products = sync_products
+        self.handlers: Dict[str, List[Callable[[dict], None]]] = {}
+        self.resync_handlers: List[Callable[[], None]] = []
+        self.task: Optional[asyncio.Task] = None
+        self.resume_token = None
+        self.history_lost = False
+        self.received = 0
+        self.resyncs = 0
+        self.handler_failures = 0
+
+    def add_handler(self, collection: str, handler: Callable[[dict], None]):
+        """Call handler with each change event on collection; register before start."""
+        self.handlers.setdefault(collection, []).append(handler)
+
+    def add_resync_handler(self, handler: Callable[[], None]):
+        """Call handler when change events were lost and views must be rebuilt; register before start."""
+        self.resync_handlers.append(handler)
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def run(self):
+        products = self.repository.collection.name
+        pipeline = [
+            {"$match": {"ns.coll": {"$in": sorted({products, *self.handlers})}}},
+            {"$project": {"operationType": 1, "ns": 1, "documentKey": 1, "fullDocument": 1,
+                          "updateDescription.updatedFields": 1, "updateDescription.removedFields": 1}},
+        ]
+        database = self.repository.collection.database
+        while True:
+            try:
+                async with database.watch(pipeline, full_document="updateLookup",
+                                          resume_after=self.resume_token) as stream:
+                    if self.history_lost:
+                        # After opening the stream, so no change can slip in between
+                        await self.resync()
+                        self.history_lost = False
+                    async for change in stream:
+                        self.received += 1
+                        self.resume_token = stream.resume_token
+                        collection = change["ns"]["coll"]
+                        if collection == products and self.sync_products:
+                            self.dispatch(self.replay, change)
+                        for handler in self.handlers.get(collection, ()):
+                            self.dispatch(handler, change)
+            except OperationFailure as e:
+                if e.code not in HISTORY_LOST_CODES:
+                    print(f"Change stream interrupted, resuming: {e}")
+                else:
+                    print(f"Change stream history lost, resyncing: {e}")
+                    self.resume_token = None
+                    self.history_lost = True
+                await asyncio.sleep(1)
+            except PyMongoError as e:
+                print(f"Change stream interrupted, resuming: {e}")
+                await asyncio.sleep(1)
+
+    def dispatch(self, handler: Callable, *args):
+        try:
+            handler(*args)
+        except Exception as e:
+            self.handler_failures += 1
+            print(f"Change stream handler {getattr(handler, '__qualname__', handler)} failed: {e!r}")
+
+    async def resync(self):
+        self.resyncs += 1
+        if self.sync_products:
+            batch = []
+            async for product in self.repository.iter_all():
+                batch.append(product)
+                if len(batch) == RESYNC_BATCH_SIZE:
+                    self.dispatch(self.repository.notify, batch)
+                    batch = []
+            # Even an empty catalog invalidates the caches
+            self.dispatch(self.repository.notify, batch)
+        for handler in self.resync_handlers:
+            self.dispatch(handler)
+
+    def replay(self, change: dict):
+        product = change.get("fullDocument")
+        update = change.get("updateDescription") or {}
+        if (product is not None and change["operationType"] == "update" and not update.get("removedFields")
+                and set(update.get("updatedFields") or ()) <= STOCK_FIELDS):
+            # Search and facets ignore stock: only what shows it is told
+            self.repository.notify_stock([product["id"]])
+        elif product is not None:
+            product = {key: value for key, value in product.items() if key != "_id"}
+            self.repository.notify([product])
+        else:
+            self.repository.notify([])
+
+    def stats(self) -> dict:
+        return {"channel": "changestream", "received": self.received, "resyncs": self.resyncs,
+                "handler_failures": self.handler_failures}
+
+
+async def supports_change_streams(db) -> bool:
+    try:
+        hello = await db.command("hello")
+    except Exception:
+        # Unreachable, or a server or stand-in predating hello
+        return False
+    return "setName" in hello or hello.get("msg") == "isdbgrid"
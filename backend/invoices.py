@@ -0,0 +1,78 @@
+from typing import List
+
+# A4 in points, and the layout of the single invoice page
+PAGE_WIDTH, PAGE_HEIGHT = 595, 842
+MARGIN = 56
+LINE_HEIGHT = 16
+MAX_NAME_LENGTH = 48
+
+
+def _text(value) -> str:
+    """A PDF string literal; the standard fonts cover Latin-1 only."""
+    text = str(value).encode("latin-1", "replace").decode("latin-1")
+    return "(" + text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") + ")"
+
+
+def _price(amount: float) -> str:
+    return f"{amount:,.2f} EUR".replace(",", " ").replace(".", ",")
+
+
+def _content(order: dict) -> bytes:
+    operations: List[str] = []
+    y = PAGE_HEIGHT - MARGIN
+
+    def line(x: float, text, size: int = 10, font: str = "F1"):
+        operations.append(f"BT /{font} {size} Tf {x} {y} Td {_text(text)} Tj ET")
+
+    line(MARGIN, "Gaming Store", 18, "F2")
+    y -= 2 * LINE_HEIGHT
+    line(MARGIN, f"Facture {order['id']}", 12, "F2")
+    y -= LINE_HEIGHT
+    line(MARGIN, f"Date : {order['created_at'][:10]}")
+    y -= LINE_HEIGHT
+    customer = order["customer"]
+    line(MARGIN, f"Client : {customer.get('name') or ''} <{customer['email']}>")
+    y -= 2 * LINE_HEIGHT
+
+    columns = (MARGIN, 340, 400, 480)
+    for x, title in zip(columns, ("Article", "Qté", "Prix", "Total")):
+        line(x, title, 10, "F2")
+    y -= LINE_HEIGHT
+    for item in order["items"]:
+        name = item["name"] if len(item["name"]) <= MAX_NAME_LENGTH else item["name"][:MAX_NAME_LENGTH - 3] + "..."
+        for x, value in zip(columns, (name, item["quantity"], _price(item["price"]), _price(item["subtotal"]))):
+            line(x, value)
+        y -= LINE_HEIGHT
+    y -= LINE_HEIGHT
+    line(columns[2], "Total TTC", 11, "F2")
+    line(columns[3], _price(order["total"]), 11, "F2")
+    return "\n".join(operations).encode("latin-1")
+
+
+def render_invoice(order: dict) -> bytes:
+    """A one-page PDF invoice for an order, written without a PDF library.
+
+    Orders are not paginated: past about 40 lines, the last ones fall off
+    the bottom of the page.
+    """
+    content = _content(order)
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] "
+        f"/Resources << /Font << /F1 4 0 R /F2 5 0 R >> >> /Contents 6 0 R >>".encode(),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>",
+        b"<< /Length " + str(len(content)).encode() + b" >>\nstream\n" + content + b"\nendstream",
+    ]
+    pdf = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref = len(pdf)
+    pdf += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for offset in offsets:
+        pdf += f"{offset:010d} 00000 n \n".encode()
+    pdf += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return bytes(pdf)
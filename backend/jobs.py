@@ -0,0 +1,191 @@
+import asyncio
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+
+from metrics import registry
+
+JobHandler = Callable[[dict], Awaitable[None]]
+
+job_outcomes = registry.counter(
+    "jobs_total", "Background job runs by type and outcome", ("type", "outcome"))
+job_duration = registry.histogram(
+    "job_duration_seconds", "Time spent running a background job", ("type",))
+jobs_running = registry.gauge("jobs_running", "Background jobs running in this worker", ("queue",))
+jobs_backlog = registry.gauge("jobs_backlog", "Jobs queued and due, as last counted", ("queue",))
+
+
+class JobQueue:
+    """Background jobs persisted in Mongo and run by a pool of asyncio workers.
+
+    A job is a document inserted with the write that causes it, in the same
+    transaction when there is one, so it is neither lost nor run for a
+    write that did not commit. Workers claim due jobs one at a time with
+    find_one_and_update, so every process can run a pool against the same
+    collection. A claim is a lease: a job whose worker died is claimed
+    again once locked_until passes, so handlers must be idempotent. Failed
+    runs are retried with exponential backoff up to max_attempts, then the
+    job is left as failed for an operator.
+
+    Workers only claim a job when they are free, so a slow handler holds
+    jobs in Mongo rather than in memory; producers check saturated() and
+    refuse new work once max_backlog jobs are waiting. A queue claims and
+    counts only the job types it has handlers for, so several queues can
+    share one collection with their own workers and backlogs.
+    """
+
+    def __init__(self, collection: Optional[AsyncIOMotorCollection] = None, concurrency: int = 4,
+                 max_attempts: int = 5, retry_delay: float = 2.0, lease_seconds: float = 60.0,
+                 poll_interval: float = 1.0, max_backlog: int = 10_000, name: str = "default"):
+        self.collection = collection
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.max_backlog = max_backlog
+        self.name = name
+        self.handlers: Dict[str, JobHandler] = {}
+        self.tasks: List[asyncio.Task] = []
+        self.wakeup = asyncio.Event()
+        self.backlog = 0
+        self.running = 0
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+
+    def register(self, job_type: str, handler: JobHandler):
+        self.handlers[job_type] = handler
+
+    @staticmethod
+    def job(job_type: str, payload: dict) -> dict:
+        """A new job document, to be inserted by enqueue."""
+        now = datetime.now(timezone.utc)
+        return {
+            "id": str(uuid.uuid4()),
+            "type": job_type,
+            "payload": payload,
+            "status": "queued",
+            "attempts": 0,
+            "run_at": now,
+            "created_at": now,
+        }
+
+    async def enqueue(self, jobs: Iterable[dict], session=None):
+        """Insert jobs; inside a transaction, call wake() once it commits."""
+        jobs = list(jobs)
+        if jobs:
+            await self.collection.insert_many(jobs, session=session)
+            if session is None:
+                self.wake()
+
+    def wake(self):
+        self.wakeup.set()
+
+    def saturated(self) -> bool:
+        return self.backlog >= self.max_backlog
+
+    async def claim(self) -> Optional[dict]:
+        now = datetime.now(timezone.utc)
+        return await self.collection.find_one_and_update(
+            {"type": {"$in": sorted(self.handlers)}, "$or": [
+                {"status": "queued", "run_at": {"$lte": now}},
+                # Leases of workers that died mid-job
+                {"status": "running", "locked_until": {"$lte": now}},
+            ]},
+            {"$set": {"status": "running", "locked_until": now + timedelta(seconds=self.lease_seconds)},
+             "$inc": {"attempts": 1}},
+            sort=[("run_at", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def run(self, job: dict):
+        handler = self.handlers.get(job["type"])
+        started = time.perf_counter()
+        self.running += 1
+        jobs_running.set(self.running, self.name)
+        try:
+            if handler is None:
+                raise LookupError(f"No handler for job type {job['type']}")
+            await handler(job["payload"])
+        except Exception as e:
+            await self.fail(job, e)
+        else:
+            await self.collection.update_one(
+                {"id": job["id"]},
+                {"$set": {"status": "done", "finished_at": datetime.now(timezone.utc)},
+                 "$unset": {"locked_until": ""}},
+            )
+            self.completed += 1
+            job_outcomes.inc(job["type"], "done")
+        finally:
+            self.running -= 1
+            jobs_running.set(self.running, self.name)
+            job_duration.observe(time.perf_counter() - started, job["type"])
+
+    async def fail(self, job: dict, error: Exception):
+        update = {"last_error": f"{type(error).__name__}: {error}"}
+        if job["attempts"] >= self.max_attempts:
+            update["status"] = "failed"
+            self.failed += 1
+            outcome = "failed"
+        else:
+            delay = self.retry_delay * 2 ** (job["attempts"] - 1)
+            update["status"] = "queued"
+            update["run_at"] = datetime.now(timezone.utc) + timedelta(seconds=delay)
+            self.retried += 1
+            outcome = "retried"
+        await self.collection.update_one({"id": job["id"]}, {"$set": update, "$unset": {"locked_until": ""}})
+        job_outcomes.inc(job["type"], outcome)
+        print(f"Job {job['type']} {job['id']} {outcome} after attempt {job['attempts']}: {update['last_error']}")
+
+    async def worker(self):
+        while True:
+            # Cleared before claiming, so a wake() during the claim is not lost
+            self.wakeup.clear()
+            try:
+                job = await self.claim()
+            except PyMongoError as e:
+                print(f"Job claim failed, retrying: {e}")
+                job = None
+            if job is not None:
+                try:
+                    await self.run(job)
+                except PyMongoError as e:
+                    # The outcome was not recorded; the job runs again when its lease lapses
+                    print(f"Job {job['id']} outcome not recorded: {e}")
+                continue
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def count_backlog(self):
+        while True:
+            try:
+                self.backlog = await self.collection.count_documents(
+                    {"type": {"$in": sorted(self.handlers)}, "status": "queued",
+                     "run_at": {"$lte": datetime.now(timezone.utc)}})
+                jobs_backlog.set(self.backlog, self.name)
+            except PyMongoError as e:
+                print(f"Job backlog count failed, retrying: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.concurrency)]
+        self.tasks.append(asyncio.create_task(self.count_backlog()))
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def stats(self) -> dict:
+        return {"workers": self.concurrency, "running": self.running, "backlog": self.backlog,
+                "completed": self.completed, "retried": self.retried, "failed": self.failed}
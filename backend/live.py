@@ -0,0 +1,227 @@
+import asyncio
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Set
+
+import orjson
+
+from invalidation import ChangeStreamFeed
+from repository import PRODUCT_FIELDS, CartRepository, ProductRepository
+
+# Frames buffered per connection before it is judged too slow to keep up
+QUEUE_SIZE = 256
+
+# Writes touching more products than this send one resync instead of deltas
+MAX_DELTAS_PER_WRITE = 100
+
+# Cart line fields sent to clients
+LINE_FIELDS = ("id", "product_id", "quantity")
+
+
+def sse_frame(event: str, data) -> bytes:
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
+
+# Tells the client to refetch what it shows; the stream ends after it
+RESYNC = sse_frame("resync", {})
+
+
+def compact_line(line: dict) -> dict:
+    return {field: line.get(field) for field in LINE_FIELDS}
+
+
+class Subscription:
+    """One event stream connection, following the catalog and optionally a cart."""
+
+    __slots__ = ("queue", "cart_id", "closed")
+
+    def __init__(self, cart_id: Optional[str]):
+        self.queue: asyncio.Queue = asyncio.Queue(QUEUE_SIZE)
+        self.cart_id = cart_id
+        self.closed = False
+
+    def push(self, frame: Optional[bytes]) -> bool:
+        """Queue a frame; False if this overflowed the queue and closed the stream."""
+        if self.closed:
+            return True
+        try:
+            self.queue.put_nowait(frame)
+            return True
+        except asyncio.QueueFull:
+            # Drop the backlog of a slow reader and end its stream; it
+            # reconnects and refetches instead
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC)
+            self.closed = True
+            return False
+
+
+class LiveHub:
+    """Fans compact catalog and cart deltas out to server-sent event streams.
+
+    Each event is encoded once and queued, as shared bytes, to every
+    connection that follows it: all of them for product changes, those of
+    one cart for line changes. Events come either from the worker's change
+    stream (watch), which sees writes from every worker and host, or from
+    the repositories' listeners in this process (listen), when the
+    deployment has no change streams.
+    """
+
+    def __init__(self):
+        self.subscribers: Set[Subscription] = set()
+        self.carts: Dict[str, Set[Subscription]] = {}
+        # Mongo _id of each line of the followed carts: change stream
+        # deletes carry nothing else
+        self.line_ids: Dict[Any, tuple] = {}
+        self.products: Optional[ProductRepository] = None
+        self.pending_stock: Set[str] = set()
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self, cart_id: Optional[str] = None) -> Subscription:
+        subscription = Subscription(cart_id)
+        self.subscribers.add(subscription)
+        if cart_id is not None:
+            self.carts.setdefault(cart_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self.subscribers.discard(subscription)
+        cart_id = subscription.cart_id
+        followers = self.carts.get(cart_id)
+        if followers is not None:
+            followers.discard(subscription)
+            if not followers:
+                del self.carts[cart_id]
+                self.line_ids = {key: line for key, line in self.line_ids.items() if line[0] != cart_id}
+
+    def track_lines(self, cart_id: str, lines: Iterable[dict]):
+        if cart_id in self.carts:
+            for line in lines:
+                if "_id" in line:
+                    self.line_ids[line["_id"]] = (cart_id, line["id"])
+
+    def publish(self, event: str, data, cart_id: Optional[str] = None):
+        targets = self.subscribers if cart_id is None else self.carts.get(cart_id, ())
+        if not targets:
+            return
+        frame = sse_frame(event, data)
+        self.published += 1
+        for subscription in targets:
+            if not subscription.push(frame):
+                self.dropped += 1
+
+    async def stream(self, subscription: Subscription, snapshot: Optional[bytes],
+                     heartbeat: float) -> AsyncIterator[bytes]:
+        """The SSE body of one connection; unsubscribes when the client goes away."""
+        try:
+            yield b"retry: 3000\n\n"
+            if snapshot is not None:
+                yield snapshot
+            while True:
+                try:
+                    frame = await asyncio.wait_for(subscription.queue.get(), heartbeat)
+                except asyncio.TimeoutError:
+                    # Keeps proxies from closing an idle connection
+                    yield b": ping\n\n"
+                    continue
+                if frame is None:
+                    return
+                yield frame
+                if frame is RESYNC:
+                    return
+        finally:
+            self.unsubscribe(subscription)
+
+    def close(self):
+        for subscription in list(self.subscribers):
+            subscription.push(None)
+
+    def stats(self) -> dict:
+        return {"connections": len(self.subscribers), "carts": len(self.carts),
+                "published": self.published, "dropped": self.dropped}
+
+    # Events from the change stream
+
+    def watch(self, feed: ChangeStreamFeed, products_collection: str, cart_collection: str):
+        feed.add_handler(products_collection, self.on_product_change)
+        feed.add_handler(cart_collection, self.on_cart_change)
+        feed.add_resync_handler(self.on_resync)
+
+    def on_resync(self):
+        # Changes were lost: clients reload what they show
+        self.publish("resync", {})
+
+    def on_product_change(self, change: dict):
+        if not self.subscribers:
+            return
+        product = change.get("fullDocument")
+        if product is None:
+            # Deleted, and known by _id alone
+            return
+        if change["operationType"] == "update":
+            updated = change.get("updateDescription", {}).get("updatedFields", {})
+            changes = {field: value for field, value in updated.items() if field in PRODUCT_FIELDS}
+            if changes:
+                self.publish("product", {"id": product["id"], "changes": changes})
+        else:
+            self.publish("product", {"id": product["id"], "product": self.compact_product(product)})
+
+    def on_cart_change(self, change: dict):
+        if change["operationType"] == "delete":
+            line = self.line_ids.pop(change["documentKey"]["_id"], None)
+            if line is not None:
+                cart_id, line_id = line
+                self.publish("cart_line_removed", {"id": line_id}, cart_id)
+            return
+        line = change.get("fullDocument")
+        if line is None or line.get("cart_id") not in self.carts:
+            return
+        self.line_ids[line["_id"]] = (line["cart_id"], line["id"])
+        self.publish("cart_line", compact_line(line), line["cart_id"])
+
+    # Events from this process
+
+    def listen(self, products: ProductRepository, carts: CartRepository):
+        self.products = products
+        products.add_listener(self.on_products_changed)
+        products.add_stock_listener(self.on_stock_changed)
+        carts.add_listener(self.on_cart_changed)
+
+    def on_products_changed(self, changed: Iterable[dict], removed_ids: Iterable[str] = ()):
+        if not self.subscribers:
+            return
+        changed = list(changed)
+        removed_ids = list(removed_ids)
+        if len(changed) + len(removed_ids) > MAX_DELTAS_PER_WRITE:
+            self.publish("resync", {})
+            return
+        for product in changed:
+            if "id" in product:
+                self.publish("product", {"id": product["id"], "product": self.compact_product(product)})
+        for product_id in removed_ids:
+            self.publish("product_removed", {"id": product_id})
+
+    def on_stock_changed(self, product_ids: List[str]):
+        if not self.subscribers:
+            return
+        # Coalesce the stock changes of this loop iteration into one read
+        if not self.pending_stock:
+            asyncio.get_running_loop().create_task(self.publish_stock())
+        self.pending_stock.update(product_ids)
+
+    async def publish_stock(self):
+        await asyncio.sleep(0)
+        product_ids, self.pending_stock = list(self.pending_stock), set()
+        cursor = self.products.iter_all({"id": 1, "stock": 1}, query={"id": {"$in": product_ids}})
+        async for product in cursor:
+            self.publish("product", {"id": product["id"], "changes": {"stock": product.get("stock", 0)}})
+
+    def on_cart_changed(self, cart_id: str, line: dict, removed: bool):
+        if removed:
+            self.publish("cart_line_removed", {"id": line["id"]}, cart_id)
+        else:
+            self.publish("cart_line", compact_line(line), cart_id)
+
+    @staticmethod
+    def compact_product(product: dict) -> dict:
+        return {field: product[field] for field in PRODUCT_FIELDS if field in product}
@@ -0,0 +1,58 @@
+import asyncio
+from typing import Dict, Iterable, List, Optional
+
+from repository import ProductRepository
+
+
+class ProductLoader:
+    """Resolves many product ids with one $in query.
+
+    Ids already being fetched by a concurrent call are not queried again:
+    the call waits on the pending lookup instead (single-flight), so a burst
+    of clients rehydrating the same items costs one query.
+    """
+
+    def __init__(self, repository: ProductRepository):
+        self.repository = repository
+        self.in_flight: Dict[str, asyncio.Future] = {}
+        self.queries = 0
+        self.fetched = 0
+        self.coalesced = 0
+
+    async def load_many(self, ids: Iterable[str]) -> Dict[str, Optional[dict]]:
+        """Products by id, with None for ids that do not exist."""
+        ids = list(dict.fromkeys(ids))
+        waiting = {product_id: self.in_flight[product_id] for product_id in ids if product_id in self.in_flight}
+        to_fetch = [product_id for product_id in ids if product_id not in waiting]
+        self.coalesced += len(waiting)
+
+        results: Dict[str, Optional[dict]] = {}
+        if to_fetch:
+            loop = asyncio.get_running_loop()
+            futures = {product_id: loop.create_future() for product_id in to_fetch}
+            self.in_flight.update(futures)
+            try:
+                found = await self.repository.get_many(to_fetch)
+                self.queries += 1
+                self.fetched += len(to_fetch)
+                for product_id, future in futures.items():
+                    future.set_result(found.get(product_id))
+            except BaseException as e:
+                for future in futures.values():
+                    future.set_exception(e)
+                raise
+            finally:
+                for product_id in to_fetch:
+                    self.in_flight.pop(product_id, None)
+            results.update(found)
+        for product_id, future in waiting.items():
+            results[product_id] = await future
+        return {product_id: results.get(product_id) for product_id in ids}
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self.in_flight),
+            "queries": self.queries,
+            "fetched": self.fetched,
+            "coalesced": self.coalesced,
+        }
@@ -0,0 +1,302 @@
+import asyncio
+import bisect
+import contextvars
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from pymongo import monitoring
+
+# Latency buckets in seconds, from sub-millisecond cache hits to slow scans
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Mongo round-trips per request
+ROUNDTRIP_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1.0):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def set(self, value: float, *labels):
+        """Mirror a count kept elsewhere, such as the cache counters."""
+        with self.lock:
+            self.values[labels] = value
+
+    def render(self) -> List[str]:
+        with self.lock:
+            items = sorted(self.values.items())
+        return self.header() + [
+            f"{self.name}{_labels(self.label_names, labels)} {value}" for labels, value in items
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (last is +Inf), sum, count]
+        self.series: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        with self.lock:
+            items = sorted((labels, [list(s[0]), s[1], s[2]]) for labels, s in self.series.items())
+        lines = self.header()
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = 'le="%s"' % ("+Inf" if bound == float("inf") else repr(bound))
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, labels)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+        self.collectors: List[Callable[[], None]] = []
+
+    def counter(self, *args, **kwargs) -> Counter:
+        return self._register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs) -> Gauge:
+        return self._register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        return self._register(Histogram(*args, **kwargs))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Callable[[], None]):
+        """Run collector before each scrape, e.g. to copy counters into gauges."""
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self.collectors:
+            collector()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_request_duration = registry.histogram(
+    "http_request_duration_seconds", "HTTP request latency by route", ("method", "route", "status"))
+mongo_command_duration = registry.histogram(
+    "mongo_command_duration_seconds", "MongoDB command latency", ("collection", "command"))
+mongo_commands = registry.counter(
+    "mongo_commands_total", "MongoDB commands by outcome", ("collection", "command", "outcome"))
+mongo_roundtrips = registry.histogram(
+    "mongo_roundtrips_per_request", "MongoDB round-trips issued by one HTTP request", ("route",),
+    buckets=ROUNDTRIP_BUCKETS)
+n_plus_one_requests = registry.counter(
+    "mongo_n_plus_one_requests_total", "Requests whose round-trips exceeded the N+1 threshold", ("route",))
+mongo_inflight = registry.gauge(
+    "mongo_commands_in_flight", "MongoDB commands started and not yet finished")
+event_loop_lag = registry.histogram(
+    "event_loop_lag_seconds", "Delay of the event loop in waking a periodic task")
+event_loop_lag_current = registry.gauge(
+    "event_loop_lag_current_seconds", "Most recent event loop lag sample")
+
+
+class RequestStats:
+    """Timings gathered while serving one request."""
+
+    __slots__ = ("mongo_ops", "mongo_seconds", "spans")
+
+    def __init__(self):
+        self.mongo_ops = 0
+        self.mongo_seconds = 0.0
+        self.spans: Dict[str, float] = {}
+
+    def add_span(self, name: str, seconds: float):
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+
+current_request: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar(
+    "current_request", default=None)
+
+
+class span:
+    """Time a block of work into the current request's Server-Timing."""
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        stats = current_request.get()
+        if stats is not None:
+            stats.add_span(self.name, time.perf_counter() - self.started)
+
+
+def _collection(event: monitoring.CommandStartedEvent) -> str:
+    """Collection a command acts on: the value of its first key, when a string."""
+    value = event.command.get(event.command_name)
+    return value if isinstance(value, str) else "-"
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Records per-collection/per-command timings and attributes them to requests.
+
+    Motor runs pymongo on executor threads with a copy of the caller's
+    context, so current_request resolves to the request that issued the
+    command.
+    """
+
+    def __init__(self):
+        self.pending: Dict[Tuple, Tuple[str, Optional[RequestStats]]] = {}
+        self.lock = threading.Lock()
+
+    @property
+    def in_flight(self) -> int:
+        return len(self.pending)
+
+    def started(self, event):
+        with self.lock:
+            self.pending[(event.connection_id, event.request_id)] = (_collection(event), current_request.get())
+            mongo_inflight.set(len(self.pending))
+
+    def _finish(self, event, outcome: str):
+        seconds = event.duration_micros / 1e6
+        with self.lock:
+            collection, stats = self.pending.pop((event.connection_id, event.request_id), ("-", None))
+            mongo_inflight.set(len(self.pending))
+            # Commands of one request may finish concurrently on several threads
+            if stats is not None:
+                stats.mongo_ops += 1
+                stats.mongo_seconds += seconds
+        mongo_command_duration.observe(seconds, collection, event.command_name)
+        mongo_commands.inc(collection, event.command_name, outcome)
+
+    def succeeded(self, event):
+        self._finish(event, "success")
+
+    def failed(self, event):
+        self._finish(event, "failure")
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing each HTTP request and adding a Server-Timing header."""
+
+    def __init__(self, app, n_plus_one_threshold: int = 10):
+        self.app = app
+        self.n_plus_one_threshold = n_plus_one_threshold
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats()
+        token = current_request.set(stats)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                total = time.perf_counter() - started
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [
+                    (b"server-timing", server_timing(stats, total).encode("latin-1"))
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current_request.reset(token)
+            route = scope.get("route")
+            route_path = getattr(route, "path", "unmatched")
+            http_request_duration.observe(time.perf_counter() - started, scope["method"], route_path, status)
+            mongo_roundtrips.observe(stats.mongo_ops, route_path)
+            if stats.mongo_ops > self.n_plus_one_threshold:
+                n_plus_one_requests.inc(route_path)
+
+
+def server_timing(stats: RequestStats, total: float) -> str:
+    parts = [f'mongo;dur={stats.mongo_seconds * 1000:.2f};desc="{stats.mongo_ops} ops"']
+    for name, seconds in stats.spans.items():
+        parts.append(f"{name};dur={seconds * 1000:.2f}")
+    app_seconds = max(total - stats.mongo_seconds - sum(stats.spans.values()), 0.0)
+    parts.append(f"app;dur={app_seconds * 1000:.2f}")
+    parts.append(f"loop;dur={lag_monitor.last_lag * 1000:.2f}")
+    parts.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(parts)
+
+
+class LoopLagMonitor:
+    """Periodically measures how late the event loop wakes a sleeping task."""
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.last_lag = 0.0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.last_lag = max(loop.time() - started - self.interval, 0.0)
+            event_loop_lag.observe(self.last_lag)
+            event_loop_lag_current.set(self.last_lag)
+
+
+lag_monitor = LoopLagMonitor()
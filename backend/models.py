@@ -0,0 +1,83 @@
+from pydantic import BaseModel, EmailStr, Field
+from typing import Dict, List, Optional
+
+
+class ProductIn(BaseModel):
+    """A product as sent by clients and supplier feeds.
+
+    Mirrors the arguments of create_product: rows without an id get a new
+    one, rows with an id replace the existing product, all but its stock,
+    which is only set when the product is created.
+    """
+
+    id: Optional[str] = None
+    name: str = Field(min_length=1)
+    category: str = Field(min_length=1)
+    price: float = Field(ge=0)
+    description: str
+    image_url: str
+    condition: str = "Très bon état"
+    console: Optional[str] = None
+    brand: Optional[str] = None
+    stock: int = Field(1, ge=0)
+
+
+class ProductImage(BaseModel):
+    """Resized variants of a product's image, once image_url has been ingested."""
+
+    key: str
+    width: int
+    height: int
+    widths: List[int]
+    src: str
+    # Media type to a srcset of that type's variants, for <picture>
+    srcset: Dict[str, str]
+    # The image_url these variants were made from, or current when uploaded
+    source_url: str
+    # Made from an upload rather than fetched from source_url
+    uploaded: bool = False
+
+
+class Product(ProductIn):
+    """A stored product, as returned by the catalog endpoints."""
+
+    id: str
+    created_at: str
+    image: Optional[ProductImage] = None
+
+
+class CartLine(BaseModel):
+    id: str
+    product_id: str
+    quantity: int
+    added_at: str
+    product: Product
+
+
+class CartView(BaseModel):
+    items: List[CartLine]
+    total: float
+    count: int
+
+
+class CheckoutIn(BaseModel):
+    email: EmailStr
+    name: Optional[str] = Field(None, max_length=200)
+
+
+class OrderLine(BaseModel):
+    product_id: str
+    name: str
+    category: str
+    price: float
+    quantity: int
+    subtotal: float
+
+
+class Order(BaseModel):
+    id: str
+    customer: CheckoutIn
+    items: List[OrderLine]
+    total: float
+    status: str
+    created_at: str
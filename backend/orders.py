@@ -0,0 +1,274 @@
+import asyncio
+import smtplib
+import time
+import uuid
+from datetime import datetime, timezone
+from email.message import EmailMessage
+from typing import List, Optional, Tuple
+
+from bson import Binary
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from invoices import render_invoice
+from jobs import JobQueue
+from metrics import registry
+from repository import CartRepository, ProductRepository
+from reservations import ReservationRepository
+
+# Side effects of a placed order, run by the job queue after the commit
+ORDER_JOBS = ("order_confirmation_email", "order_invoice", "order_analytics")
+
+checkout_outcomes = registry.counter("checkouts_total", "Checkout attempts by outcome", ("outcome",))
+checkout_duration = registry.histogram(
+    "checkout_duration_seconds", "Time to place an order, side effects excluded", ("outcome",))
+
+
+class CheckoutError(Exception):
+    pass
+
+
+class EmptyCart(CheckoutError):
+    pass
+
+
+class OutOfStock(CheckoutError):
+    def __init__(self, unavailable: List[str]):
+        super().__init__(f"Not enough stock for {', '.join(unavailable)}")
+        self.unavailable = unavailable
+
+
+class OrderRepository:
+    """Turns carts into orders.
+
+    With transactions (replica sets and sharded clusters), checkout reads
+    the cart and its holds, moves stock by the difference in one
+    bulk_write, and deletes the holds and the cart, inserts the order and
+    queues its side-effect jobs, all in one transaction: either the order
+    exists with its stock taken and its jobs queued, or nothing happened.
+    Concurrent stock changes make the transaction conflict and retry.
+
+    Without transactions, the cart is first reserved all or nothing
+    through the reservation holds, then the same steps run one by one. The
+    holds are deleted before the order is inserted, so a process dying in
+    between loses those units instead of returning stock that was sold.
+    """
+
+    def __init__(self, products: ProductRepository, carts: CartRepository,
+                 reservations: ReservationRepository, jobs: JobQueue,
+                 collection: Optional[AsyncIOMotorCollection] = None):
+        self.products = products
+        self.carts = carts
+        self.reservations = reservations
+        self.jobs = jobs
+        self.collection = collection
+        self.transactions = False
+
+    async def checkout(self, cart_id: str, customer: dict) -> dict:
+        """Place an order for the whole cart; raises EmptyCart or OutOfStock."""
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            if self.transactions:
+                client = self.collection.database.client
+                async with await client.start_session() as session:
+                    order, lines, moved = await session.with_transaction(
+                        lambda session: self._place(cart_id, customer, session))
+            else:
+                lines = await self.carts.lines(cart_id)
+                if not lines:
+                    raise EmptyCart("Cart is empty")
+                reserved, unavailable = await self.reservations.reserve_cart(
+                    cart_id, {line["product_id"]: line["quantity"] for line in lines})
+                if not reserved:
+                    raise OutOfStock(unavailable)
+                order, lines, moved = await self._place(cart_id, customer, None)
+            outcome = "placed"
+        except EmptyCart:
+            outcome = "empty_cart"
+            raise
+        except OutOfStock:
+            outcome = "out_of_stock"
+            raise
+        finally:
+            checkout_outcomes.inc(outcome)
+            checkout_duration.observe(time.perf_counter() - started, outcome)
+
+        # Listeners only hear about committed writes
+        if moved:
+            self.products.notify_stock(moved)
+        for line in lines:
+            self.carts.notify(cart_id, line, removed=True)
+        self.jobs.wake()
+        return order
+
+    async def _place(self, cart_id: str, customer: dict, session) -> Tuple[dict, List[dict], List[str]]:
+        """The order, the cart lines it consumed and the ids whose stock moved."""
+        lines = await self.carts.collection.find(
+            {"cart_id": cart_id}, {"_id": 0, "cart_id": 0}, session=session).to_list(length=None)
+        if not lines:
+            raise EmptyCart("Cart is empty")
+        quantities = {line["product_id"]: line["quantity"] for line in lines}
+        products = {
+            product["id"]: product async for product in self.products.collection.find(
+                {"id": {"$in": list(quantities)}},
+                {"_id": 0, "id": 1, "name": 1, "category": 1, "price": 1, "stock": 1},
+                session=session,
+            )
+        }
+        held = {
+            hold["product_id"]: hold["quantity"] async for hold in self.reservations.collection.find(
+                {"cart_id": cart_id}, {"_id": 0, "product_id": 1, "quantity": 1}, session=session)
+        }
+        unavailable = [
+            product_id for product_id, quantity in sorted(quantities.items())
+            if product_id not in products or products[product_id].get("stock", 0) < quantity - held.get(product_id, 0)
+        ]
+        if unavailable:
+            raise OutOfStock(unavailable)
+
+        # Held units are already off the stock: take what is not held, and
+        # return holds beyond the cart's quantities
+        operations = []
+        moved = []
+        for product_id in sorted(set(quantities) | set(held)):
+            missing = quantities.get(product_id, 0) - held.get(product_id, 0)
+            if missing > 0:
+                operations.append(UpdateOne({"id": product_id, "stock": {"$gte": missing}},
+                                            {"$inc": {"stock": -missing, "version": 1}}))
+            elif missing < 0:
+                operations.append(UpdateOne({"id": product_id}, {"$inc": {"stock": -missing, "version": 1}}))
+            else:
+                continue
+            moved.append(product_id)
+        if operations:
+            result = await self.products.collection.bulk_write(operations, ordered=False, session=session)
+            if result.matched_count < len(operations):
+                raise OutOfStock(moved)
+        if held:
+            await self.reservations.collection.delete_many({"cart_id": cart_id}, session=session)
+
+        created_at = datetime.now(timezone.utc)
+        items = []
+        for line in lines:
+            product = products[line["product_id"]]
+            items.append({
+                "product_id": product["id"],
+                "name": product["name"],
+                "category": product["category"],
+                "price": product["price"],
+                "quantity": line["quantity"],
+                "subtotal": round(product["price"] * line["quantity"], 2),
+            })
+        order = {
+            "id": str(uuid.uuid4()),
+            "cart_id": cart_id,
+            "customer": customer,
+            "items": items,
+            "total": round(sum(item["subtotal"] for item in items), 2),
+            "status": "placed",
+            "created_at": created_at,
+        }
+        # insert_one adds _id to the dict it is given
+        await self.collection.insert_one(dict(order), session=session)
+        await self.jobs.enqueue((self.jobs.job(job_type, {"order_id": order["id"]}) for job_type in ORDER_JOBS),
+                                session=session)
+        await self.carts.collection.delete_many({"cart_id": cart_id}, session=session)
+        return order, lines, moved
+
+    async def get(self, order_id: str) -> Optional[dict]:
+        order = await self.collection.find_one({"id": order_id}, {"_id": 0, "cart_id": 0})
+        if order is not None:
+            # Mongo dates come back naive, in UTC
+            order["created_at"] = order["created_at"].replace(tzinfo=timezone.utc)
+        return order
+
+    async def invoice(self, order_id: str) -> Optional[bytes]:
+        """The order's PDF invoice, once its job has rendered it."""
+        invoice = await self.collection.database.invoices.find_one({"order_id": order_id}, {"_id": 0, "pdf": 1})
+        return bytes(invoice["pdf"]) if invoice else None
+
+
+class OrderJobs:
+    """Handlers for the side effects of an order; each is safe to run twice.
+
+    Without an SMTP host, confirmation emails are logged instead of sent.
+    """
+
+    def __init__(self, orders: OrderRepository, smtp_host: Optional[str] = None, smtp_port: int = 25,
+                 sender: str = "boutique@localhost"):
+        self.orders = orders
+        self.smtp_host = smtp_host
+        self.smtp_port = smtp_port
+        self.sender = sender
+
+    def register(self, jobs: JobQueue):
+        jobs.register("order_confirmation_email", self.send_confirmation)
+        jobs.register("order_invoice", self.store_invoice)
+        jobs.register("order_analytics", self.record_analytics)
+
+    @property
+    def db(self):
+        return self.orders.collection.database
+
+    async def order(self, payload: dict) -> dict:
+        order = await self.orders.get(payload["order_id"])
+        if order is None:
+            raise LookupError(f"Order {payload['order_id']} not found")
+        order["created_at"] = order["created_at"].isoformat()
+        return order
+
+    async def send_confirmation(self, payload: dict):
+        order = await self.order(payload)
+        if order.get("confirmation_sent_at"):
+            return
+        message = EmailMessage()
+        message["From"] = self.sender
+        message["To"] = order["customer"]["email"]
+        message["Subject"] = f"Confirmation de votre commande {order['id']}"
+        message.set_content("\n".join(
+            [f"Merci pour votre commande {order['id']} :", ""]
+            + [f"- {item['quantity']} x {item['name']} : {item['subtotal']:.2f} €" for item in order["items"]]
+            + ["", f"Total : {order['total']:.2f} €"]
+        ))
+        if self.smtp_host:
+            await asyncio.to_thread(self._send, message)
+        else:
+            print(f"Order confirmation for {order['id']} to {message['To']} not sent: no SMTP_HOST")
+        await self.orders.collection.update_one(
+            {"id": order["id"]}, {"$set": {"confirmation_sent_at": datetime.now(timezone.utc)}})
+
+    def _send(self, message: EmailMessage):
+        with smtplib.SMTP(self.smtp_host, self.smtp_port, timeout=30) as smtp:
+            smtp.send_message(message)
+
+    async def store_invoice(self, payload: dict):
+        order = await self.order(payload)
+        pdf = await asyncio.to_thread(render_invoice, order)
+        await self.db.invoices.update_one(
+            {"order_id": order["id"]},
+            {"$set": {"pdf": Binary(pdf), "created_at": datetime.now(timezone.utc)}},
+            upsert=True,
+        )
+
+    async def record_analytics(self, payload: dict):
+        order = await self.orders.get(payload["order_id"])
+        if order is None:
+            raise LookupError(f"Order {payload['order_id']} not found")
+        try:
+            # Keyed by order, so a second run inserts nothing
+            await self.db.analytics_events.insert_one({
+                "_id": f"order_placed:{order['id']}",
+                "type": "order_placed",
+                "order_id": order["id"],
+                "at": order["created_at"],
+                "total": order["total"],
+                "items": [
+                    {"product_id": item["product_id"], "category": item["category"],
+                     "quantity": item["quantity"], "revenue": item["subtotal"]}
+                    for item in order["items"]
+                ],
+            })
+        except DuplicateKeyError:
+            pass
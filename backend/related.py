@@ -0,0 +1,385 @@
+import asyncio
+import heapq
+import math
+import zlib
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+from search_index import tokenize
+
+# Hashed dimensions for the categorical fields and name tokens, followed by
+# the dimensions encoding the price on a log scale
+HASHED_DIMENSIONS = 112
+PRICE_DIMENSIONS = 16
+DIMENSIONS = HASHED_DIMENSIONS + PRICE_DIMENSIONS
+
+# Share of each feature group in the similarity; console dominates so that
+# accessories of the same console rank next to the console itself
+FIELD_WEIGHTS = {"console": 1.0, "brand": 0.6, "category": 0.5, "condition": 0.2}
+NAME_WEIGHT = 0.6
+PRICE_WEIGHT = 0.4
+
+# Prices spread over the price dimensions, from 1€ to 2000€
+PRICE_RANGE = (math.log1p(1.0), math.log1p(2000.0))
+
+# Similarities computed per matrix product: rows per batch times catalog size
+MAX_BATCH_CELLS = 16_000_000
+
+# Writes touching more products than this recompute every list
+MAX_INCREMENTAL_CHANGES = 2000
+
+
+def _hashed(feature: str) -> Tuple[int, float]:
+    """Dimension and sign of a feature; crc32 is stable across processes."""
+    digest = zlib.crc32(feature.encode())
+    return digest % HASHED_DIMENSIONS, 1.0 if digest & 0x80000000 else -1.0
+
+
+def feature_vector(product: dict) -> np.ndarray:
+    """Unit-length features of a product: cosine similarity is then a dot product."""
+    vector = np.zeros(DIMENSIONS, dtype=np.float32)
+    for field, weight in FIELD_WEIGHTS.items():
+        value = product.get(field)
+        if value:
+            dimension, sign = _hashed(f"{field}={value}")
+            vector[dimension] += sign * weight
+    tokens = set(tokenize(product.get("name")))
+    for token in tokens:
+        dimension, sign = _hashed(f"name={token}")
+        vector[dimension] += sign * NAME_WEIGHT / math.sqrt(len(tokens))
+    price = product.get("price")
+    if price is not None and price >= 0:
+        low, high = PRICE_RANGE
+        position = (min(max(math.log1p(price), low), high) - low) / (high - low) * (PRICE_DIMENSIONS - 1)
+        # Split between the two nearest price dimensions, so close prices overlap
+        lower = int(position)
+        upper = min(lower + 1, PRICE_DIMENSIONS - 1)
+        fraction = position - lower
+        vector[HASHED_DIMENSIONS + lower] += PRICE_WEIGHT * (1 - fraction)
+        vector[HASHED_DIMENSIONS + upper] += PRICE_WEIGHT * fraction
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+# Columns per group when narrowing top-k candidates to the best groups
+TOP_K_GROUP = 64
+
+
+def top_k(similarities: np.ndarray, rows: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Best k columns of each row of similarities, best first, excluding the row's own product.
+
+    Wide matrices are narrowed first: the k groups of columns with the
+    highest maxima hold every top-k column, so only those are partitioned.
+    Group g is the strided columns g, g + groups, g + 2 * groups..., whose
+    maxima reduce over contiguous memory.
+    """
+    similarities[np.arange(len(rows)), rows] = -np.inf
+    width = similarities.shape[1]
+    k = min(k, width)
+    if width >= 8 * k * TOP_K_GROUP:
+        groups = width // TOP_K_GROUP
+        full = groups * TOP_K_GROUP
+        maxima = similarities[:, :full].reshape(len(rows), TOP_K_GROUP, groups).max(axis=1)
+        best_groups = np.argpartition(maxima, groups - k, axis=1)[:, -k:]
+        columns = (best_groups[:, :, None] + np.arange(TOP_K_GROUP) * groups).reshape(len(rows), -1)
+        # Columns past the last full group are always candidates
+        columns = np.hstack([columns, np.broadcast_to(np.arange(full, width), (len(rows), width - full))])
+        candidate_scores = np.take_along_axis(similarities, columns, axis=1)
+    else:
+        columns = np.broadcast_to(np.arange(width), similarities.shape)
+        candidate_scores = similarities
+    best = np.argpartition(candidate_scores, candidate_scores.shape[1] - k, axis=1)[:, -k:]
+    best_scores = np.take_along_axis(candidate_scores, best, axis=1)
+    order = np.argsort(-best_scores, axis=1)
+    best = np.take_along_axis(best, order, axis=1)
+    return np.take_along_axis(columns, best, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+
+class RelatedState:
+    """Feature matrix and neighbour lists, one row per product slot.
+
+    Freed slots are reused lowest first, so the rows in use stay within
+    the first end rows, and only those take part in matrix products.
+    """
+
+    def __init__(self, k: int, capacity: int = 0):
+        self.k = k
+        self.ids: List[Optional[str]] = [None] * capacity
+        self.rows: Dict[str, int] = {}
+        self.free: List[int] = list(range(capacity))
+        self.end = 0
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.vectors = np.zeros((capacity, DIMENSIONS), dtype=np.float32)
+        self.neighbors = np.full((capacity, k), -1, dtype=np.int32)
+        self.scores = np.full((capacity, k), -np.inf, dtype=np.float32)
+
+    def allocate(self, product_id: str) -> int:
+        row = self.rows.get(product_id)
+        if row is not None:
+            return row
+        if not self.free:
+            self._grow(max(1024, 2 * len(self.ids)))
+        row = heapq.heappop(self.free)
+        self.ids[row] = product_id
+        self.rows[product_id] = row
+        self.alive[row] = True
+        self.end = max(self.end, row + 1)
+        return row
+
+    def _grow(self, capacity: int):
+        extra = capacity - len(self.ids)
+        self.free.extend(range(len(self.ids), capacity))
+        self.ids.extend([None] * extra)
+        self.alive = np.concatenate([self.alive, np.zeros(extra, dtype=bool)])
+        self.vectors = np.vstack([self.vectors, np.zeros((extra, DIMENSIONS), dtype=np.float32)])
+        self.neighbors = np.vstack([self.neighbors, np.full((extra, self.k), -1, dtype=np.int32)])
+        self.scores = np.vstack([self.scores, np.full((extra, self.k), -np.inf, dtype=np.float32)])
+
+    def release(self, product_id: str) -> Optional[int]:
+        row = self.rows.pop(product_id, None)
+        if row is not None:
+            self.ids[row] = None
+            self.alive[row] = False
+            self.vectors[row] = 0
+            self.neighbors[row] = -1
+            self.scores[row] = -np.inf
+            heapq.heappush(self.free, row)
+        return row
+
+    def copy(self) -> "RelatedState":
+        state = RelatedState(self.k)
+        state.ids = list(self.ids)
+        state.rows = dict(self.rows)
+        state.free = list(self.free)
+        state.end = self.end
+        state.alive = self.alive.copy()
+        state.vectors = self.vectors.copy()
+        state.neighbors = self.neighbors.copy()
+        state.scores = self.scores.copy()
+        return state
+
+    def embed(self, changed: Iterable[dict], removed_ids: Iterable[str]) -> set:
+        """Update the vectors of written and removed products; the rows touched."""
+        touched = set()
+        for product_id in removed_ids:
+            row = self.release(product_id)
+            if row is not None:
+                touched.add(row)
+        for product in changed:
+            row = self.allocate(product["id"])
+            self.vectors[row] = feature_vector(product)
+            touched.add(row)
+        return touched
+
+    def update(self, changed: List[dict], removed_ids: List[str]):
+        """Apply a write: re-embed it, then repair the lists it can have changed."""
+        touched = self.embed(changed, removed_ids)
+        if not touched:
+            return
+        written = np.array(sorted(row for row in touched if self.alive[row]), dtype=np.int64)
+        if len(touched) > MAX_INCREMENTAL_CHANGES:
+            self.recompute(self.live_rows())
+            return
+        # Lists that held a touched product have stale scores
+        stale = np.setdiff1d(self.referencing(touched), written)
+        self.recompute(np.union1d(self.rescore(stale, written), written))
+        self.offer(written)
+
+    def live_rows(self) -> np.ndarray:
+        return np.flatnonzero(self.alive[:self.end])
+
+    def recompute(self, rows: np.ndarray):
+        """Neighbour lists of rows against the whole catalog, in batches."""
+        if len(rows) == 0 or not self.rows:
+            return
+        candidates = self.vectors[:self.end]
+        dead = np.flatnonzero(~self.alive[:self.end])
+        batch = max(1, MAX_BATCH_CELLS // self.end)
+        for start in range(0, len(rows), batch):
+            chunk = rows[start:start + batch]
+            similarities = self.vectors[chunk] @ candidates.T
+            similarities[:, dead] = -np.inf
+            best, scores = top_k(similarities, chunk, self.k)
+            # Fewer products than k leave dead columns in the lists
+            best[~np.isfinite(scores)] = -1
+            width = best.shape[1]
+            self.neighbors[chunk] = -1
+            self.scores[chunk] = -np.inf
+            self.neighbors[chunk, :width] = best
+            self.scores[chunk, :width] = scores
+
+    def offer(self, rows: np.ndarray):
+        """Insert rows into the neighbour lists of every product they now beat."""
+        candidates = self.vectors[:self.end]
+        # Dead rows have no list to enter
+        thresholds = np.where(self.alive[:self.end], self.scores[:self.end, -1], np.inf)
+        batch = max(1, MAX_BATCH_CELLS // max(self.end, 1))
+        for start in range(0, len(rows), batch):
+            chunk = rows[start:start + batch]
+            similarities = candidates @ self.vectors[chunk].T
+            for column, row in enumerate(chunk):
+                scores = similarities[:, column]
+                for target in np.flatnonzero(scores > thresholds):
+                    if target != row and row not in self.neighbors[target]:
+                        self._insert(target, row, float(scores[target]))
+                        thresholds[target] = self.scores[target, -1]
+
+    def rescore(self, rows: np.ndarray, written: np.ndarray) -> np.ndarray:
+        """Rescore in place the written entries of rows' lists; the rows whose list needs a recompute.
+
+        A list stays exact while every rescored entry is still at least its
+        old last score, which bounded every product left out of it.
+        """
+        if len(rows) == 0:
+            return rows
+        positions = {row: position for position, row in enumerate(written.tolist())}
+        similarities = self.vectors[rows] @ self.vectors[written].T
+        redo = []
+        for index, row in enumerate(rows):
+            neighbors, scores = self.neighbors[row], self.scores[row]
+            rescored = scores.copy()
+            for slot, neighbor in enumerate(neighbors.tolist()):
+                if neighbor in positions:
+                    rescored[slot] = similarities[index, positions[neighbor]]
+                    if rescored[slot] < scores[-1]:
+                        break
+                elif neighbor >= 0 and not self.alive[neighbor]:
+                    break
+            else:
+                order = np.argsort(-rescored, kind="stable")
+                neighbors[:] = neighbors[order]
+                scores[:] = rescored[order]
+                continue
+            redo.append(row)
+        return np.array(redo, dtype=np.int64)
+
+    def _insert(self, target: int, row: int, score: float):
+        neighbors = self.neighbors[target]
+        scores = self.scores[target]
+        position = int(np.searchsorted(-scores, -score, side="right"))
+        neighbors[position + 1:] = neighbors[position:-1].copy()
+        scores[position + 1:] = scores[position:-1].copy()
+        neighbors[position] = row
+        scores[position] = score
+
+    def referencing(self, rows: Iterable[int]) -> np.ndarray:
+        """Live rows whose neighbour lists contain any of rows."""
+        mask = np.isin(self.neighbors[:self.end], np.fromiter(rows, dtype=np.int32)).any(axis=1)
+        return np.flatnonzero(mask & self.alive[:self.end])
+
+    def related(self, product_id: str, limit: int) -> Optional[List[Tuple[str, float]]]:
+        row = self.rows.get(product_id)
+        if row is None:
+            return None
+        return [
+            (self.ids[neighbor], float(score))
+            for neighbor, score in zip(self.neighbors[row][:limit], self.scores[row][:limit])
+            if neighbor >= 0
+        ]
+
+    def memory_bytes(self) -> int:
+        return self.alive.nbytes + self.vectors.nbytes + self.neighbors.nbytes + self.scores.nbytes
+
+
+def build_state(products: List[dict], k: int) -> RelatedState:
+    state = RelatedState(k, len(products))
+    for product in products:
+        row = state.allocate(product["id"])
+        state.vectors[row] = feature_vector(product)
+    state.recompute(state.live_rows())
+    return state
+
+
+class RelatedIndex:
+    """Top-k similar products for every product, kept in sync with writes.
+
+    Products are embedded as unit vectors hashed from console, brand,
+    category, condition and name tokens, plus a log-price encoding, so
+    similarity is a dot product. The full build takes every product's
+    neighbours from batched matrix products in a worker thread; after it,
+    each write re-embeds the products it touches, repairs their lists and
+    those that listed them, and offers them to every other list, all in
+    O(catalog size) vector operations per product. Writes are applied to a
+    copy of the index in a worker thread too, never on the event loop;
+    those made while one is applied are merged by product and applied
+    together next, so pending work never exceeds one entry per product.
+    Lookups read a precomputed row: O(k).
+    """
+
+    def __init__(self, k: int = 12):
+        self.k = k
+        self.state = RelatedState(k)
+        self.ready = False
+        self.building = False
+        self.task: Optional[asyncio.Task] = None
+        # Writes not applied yet, latest per product
+        self.pending_changed: Dict[str, dict] = {}
+        self.pending_removed: Set[str] = set()
+        self.rebuilds = 0
+        self.failures = 0
+
+    async def rebuild(self, products: List[dict]):
+        """Build from the whole catalog off the event loop, then apply writes made meanwhile."""
+        await self._swap_in(lambda: build_state(products, self.k))
+
+    def _swap_in(self, make_state) -> asyncio.Task:
+        """Make a new state in a worker thread and swap it in; writes meanwhile are held in pending."""
+        self.building = True
+        self.task = asyncio.get_running_loop().create_task(self._build(make_state))
+        return self.task
+
+    async def _build(self, make_state):
+        try:
+            self.state = await asyncio.to_thread(make_state)
+            self.rebuilds += 1
+            self.ready = True
+        except Exception as e:
+            # The index keeps its last state; writes held for it are dropped
+            # rather than retried against the same failure
+            self.failures += 1
+            dropped = len(self.pending_changed) + len(self.pending_removed)
+            self.pending_changed.clear()
+            self.pending_removed.clear()
+            print(f"Related products update failed, {dropped} pending writes dropped: {e!r}")
+        finally:
+            self.building = False
+        self._apply_pending()
+
+    def on_products_changed(self, changed: Iterable[dict], removed_ids: Iterable[str] = ()):
+        for product_id in removed_ids:
+            self.pending_changed.pop(product_id, None)
+            self.pending_removed.add(product_id)
+        for product in changed:
+            if "id" in product:
+                self.pending_removed.discard(product["id"])
+                self.pending_changed[product["id"]] = product
+        self._apply_pending()
+
+    def _apply_pending(self):
+        # Before the first build, writes wait for it
+        if self.building or not self.ready or not (self.pending_changed or self.pending_removed):
+            return
+        changed, removed_ids = list(self.pending_changed.values()), list(self.pending_removed)
+        self.pending_changed = {}
+        self.pending_removed = set()
+        self._swap_in(lambda: self._updated(changed, removed_ids))
+
+    async def settled(self):
+        """Wait until every write made so far is applied."""
+        while self.building:
+            await self.task
+
+    def _updated(self, changed: List[dict], removed_ids: List[str]) -> RelatedState:
+        state = self.state.copy()
+        state.update(changed, removed_ids)
+        return state
+
+    def related(self, product_id: str, limit: int) -> Optional[List[Tuple[str, float]]]:
+        return self.state.related(product_id, limit)
+
+    def stats(self) -> dict:
+        return {"products": len(self.state.rows), "k": self.k, "ready": self.ready,
+                "rebuilds": self.rebuilds, "failures": self.failures,
+                "pending": len(self.pending_changed) + len(self.pending_removed),
+                "memory_bytes": self.state.memory_bytes()}
@@ -0,0 +1,384 @@
+import base64
+import json
+import math
+import uuid
+from datetime import datetime, timezone
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import ReturnDocument, UpdateOne
+
+from facets import facet_pipeline
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Optional, Tuple
+
+# Called with the products written and the ids removed by each write
+ProductListener = Callable[[Iterable[dict], Iterable[str]], None]
+
+# Called with the ids of products whose stock alone changed
+StockListener = Callable[[List[str]], None]
+
+# Called with the cart id, the line written or deleted, and whether it was deleted
+CartListener = Callable[[str, dict, bool], None]
+
+# Cart line fields sent to listeners
+LINE_PROJECTION = {"_id": 0, "id": 1, "product_id": 1, "quantity": 1}
+
+# Fields a client may request through a projection
+PRODUCT_FIELDS = (
+    "id", "name", "category", "price", "description", "image_url",
+    "condition", "console", "brand", "stock", "created_at", "image",
+)
+
+# Keyset orders for product listings, each backed by indexes in bootstrap.py;
+# id breaks ties so every order is total
+LISTING_SORTS = {
+    "newest": [("created_at", -1), ("id", -1)],
+    "price": [("price", 1), ("id", 1)],
+    "-price": [("price", -1), ("id", -1)],
+}
+LISTING_SORT = LISTING_SORTS["newest"]
+
+
+def encode_cursor(position: dict) -> str:
+    """Opaque, URL-safe pagination cursor."""
+    raw = json.dumps(position, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> dict:
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError as e:
+        raise ValueError("Invalid cursor") from e
+    if not isinstance(position, dict):
+        raise ValueError("Invalid cursor")
+    return position
+
+
+def _is_timestamp(value) -> bool:
+    try:
+        datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+# What a cursor may hold for each sort key: plain values, never query operators
+CURSOR_VALUE_CHECKS = {
+    "created_at": _is_timestamp,
+    "price": lambda value: isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value),
+    "id": lambda value: isinstance(value, str),
+}
+
+
+def keyset_position(position: dict, sort: list) -> Optional[dict]:
+    """The position in a decoded cursor to page after in sort; None for the first page.
+
+    A cursor from another listing order, or a search offset, starts over.
+    Any other cursor must hold exactly the sort keys, each a plain value of
+    its type, since they go into the query; ValueError otherwise.
+    """
+    keys = {field for field, _ in sort}
+    if not position or (set(position) != keys and (set(position) == {"offset"} or any(
+            set(position) == {field for field, _ in other} for other in LISTING_SORTS.values()))):
+        return None
+    if set(position) != keys or not all(CURSOR_VALUE_CHECKS[field](position[field]) for field in keys):
+        raise ValueError("Invalid cursor")
+    return position
+
+
+def price_range(min_price: Optional[float], max_price: Optional[float]) -> dict:
+    """Query fragment bounding the price, inclusive at both ends."""
+    bounds = {}
+    if min_price is not None:
+        bounds["$gte"] = min_price
+    if max_price is not None:
+        bounds["$lte"] = max_price
+    return {"price": bounds} if bounds else {}
+
+
+def keyset_query(query: dict, sort: list, after: Optional[dict]) -> dict:
+    """query restricted to the products after position in the given order.
+
+    For a sort on (a, b) this is a > after.a, or a == after.a and b >
+    after.b, with > reversed for descending keys, which the index on the
+    sort keys answers as a single range scan.
+    """
+    if not after:
+        return query
+    (first, first_direction), (second, second_direction) = sort
+    first_op = "$lt" if first_direction < 0 else "$gt"
+    second_op = "$lt" if second_direction < 0 else "$gt"
+    return {**query, "$or": [
+        {first: {first_op: after[first]}},
+        {first: after[first], second: {second_op: after[second]}},
+    ]}
+
+
+def projection(fields: Optional[List[str]], *required: str) -> dict:
+    """Mongo projection for the requested fields plus those needed internally."""
+    if not fields:
+        return {"_id": 0}
+    return {"_id": 0, **{field: 1 for field in ("id", *required, *fields)}}
+
+
+class ProductRepository:
+    """Async access to the products collection.
+
+    The collection may be bound after construction, once the worker process
+    has created its Mongo client.
+    """
+
+    def __init__(self, collection: Optional[AsyncIOMotorCollection] = None):
+        self.collection = collection
+        self.listeners: List[ProductListener] = []
+        self.stock_listeners: List[StockListener] = []
+
+    def add_listener(self, listener: ProductListener):
+        """Register an in-process view (search index, caches) to keep in sync."""
+        self.listeners.append(listener)
+
+    def notify(self, changed: List[dict], removed_ids: List[str] = ()):
+        for listener in self.listeners:
+            listener(changed, removed_ids)
+
+    def add_stock_listener(self, listener: StockListener):
+        """Register a view that shows stock; searches and facets need not be told."""
+        self.stock_listeners.append(listener)
+
+    def notify_stock(self, product_ids: List[str]):
+        for listener in self.stock_listeners:
+            listener(product_ids)
+
+    async def page(self, query: dict, limit: int, after: Optional[dict] = None,
+                   fields: Optional[List[str]] = None,
+                   sort: list = LISTING_SORT) -> Tuple[List[dict], Optional[dict]]:
+        """One page of products in the given order, and the position of the next page.
+
+        Pages are addressed by the sort keys of the last product seen, so any
+        page is a bounded index range scan however deep it is.
+        """
+        keys = [field for field, _ in sort]
+        cursor = self.collection.find(keyset_query(query, sort, after), projection(fields, *keys))
+        products = await cursor.sort(sort).limit(limit + 1).to_list(length=limit + 1)
+
+        next_position = None
+        if len(products) > limit:
+            products = products[:limit]
+            last = products[-1]
+            next_position = {field: last.get(field) for field in keys}
+        if fields:
+            for product in products:
+                for field in keys:
+                    if field not in fields:
+                        product.pop(field, None)
+        return products, next_position
+
+    async def find_ranked(self, ids: List[str], query: dict,
+                          fields: Optional[List[str]] = None) -> List[dict]:
+        """Products with the given ids matching query, in the order of ids."""
+        cursor = self.collection.find({**query, "id": {"$in": ids}}, projection(fields))
+        found = {product["id"]: product async for product in cursor}
+        products = [found[product_id] for product_id in ids if product_id in found]
+        if fields and "id" not in fields:
+            for product in products:
+                del product["id"]
+        return products
+
+    async def text_search(self, search: str, query: dict, skip: int, limit: int,
+                          fields: Optional[List[str]] = None) -> List[dict]:
+        """Fallback search through the Mongo $text index, best match first."""
+        cursor = self.collection.find(
+            {**query, "$text": {"$search": search}},
+            {**projection(fields), "score": {"$meta": "textScore"}},
+        ).sort([("score", {"$meta": "textScore"})]).skip(skip).limit(limit)
+        products = await cursor.to_list(length=limit)
+        for product in products:
+            product.pop("score", None)
+            if fields and "id" not in fields:
+                product.pop("id", None)
+        return products
+
+    async def iter_all(self, projection: Optional[dict] = None, batch_size: int = 1000,
+                       query: Optional[dict] = None, sort: Optional[list] = None) -> AsyncIterator[dict]:
+        cursor = self.collection.find(query or {}, {"_id": 0, **(projection or {})}, batch_size=batch_size)
+        if sort:
+            cursor = cursor.sort(sort)
+        async for product in cursor:
+            yield product
+
+    async def get(self, product_id: str) -> Optional[dict]:
+        return await self.collection.find_one({"id": product_id}, {"_id": 0})
+
+    async def get_many(self, product_ids: List[str]) -> Dict[str, dict]:
+        cursor = self.collection.find({"id": {"$in": product_ids}}, {"_id": 0})
+        return {product["id"]: product async for product in cursor}
+
+    async def get_stock(self, product_id: str) -> Optional[int]:
+        product = await self.collection.find_one({"id": product_id}, {"_id": 0, "stock": 1})
+        return product.get("stock", 0) if product else None
+
+    async def take_stock(self, product_id: str, quantity: int) -> bool:
+        """Take quantity off the stock if at least that much is left.
+
+        The stock condition and the $inc apply in one atomic update, so
+        concurrent reservations can never drive stock below zero. version
+        counts stock changes for readers doing compare-and-set.
+        """
+        result = await self.collection.update_one(
+            {"id": product_id, "stock": {"$gte": quantity}},
+            {"$inc": {"stock": -quantity, "version": 1}},
+        )
+        if result.modified_count:
+            self.notify_stock([product_id])
+            return True
+        return False
+
+    async def return_stock(self, product_id: str, quantity: int):
+        await self.collection.update_one({"id": product_id}, {"$inc": {"stock": quantity, "version": 1}})
+        self.notify_stock([product_id])
+
+    async def facets(self, query: dict) -> dict:
+        """Raw $facet counts for the products matching query."""
+        result = await self.collection.aggregate(facet_pipeline(query)).to_list(length=1)
+        return result[0]
+
+    async def categories(self) -> List[str]:
+        return await self.collection.distinct("category")
+
+    async def count(self) -> int:
+        return await self.collection.count_documents({})
+
+    async def insert_many(self, products: List[dict]):
+        # insert_many adds _id to the dicts it is given, so insert copies
+        await self.collection.insert_many([dict(product) for product in products])
+        self.notify(products)
+
+    async def bulk_upsert(self, products: List[dict]) -> Tuple[int, int, int, List[Tuple[int, str]]]:
+        """Upsert products by id in one unordered bulk write.
+
+        stock is written only when a product is created: afterwards
+        reservations and orders own it, and a re-imported feed must not
+        hand back units already held by carts. Listeners are told about
+        the stored products, not the rows given. Returns the inserted,
+        matched and modified counts, matched products left as they were
+        counting as matched only, and the (index, message) of every
+        product the server rejected.
+        """
+        now = datetime.now().isoformat()
+        operations = []
+        for product in products:
+            if not product.get("id"):
+                product["id"] = str(uuid.uuid4())
+            fields = {field: value for field, value in product.items() if field != "stock"}
+            created = {"created_at": now, "stock": product.get("stock", 0)}
+            operations.append(UpdateOne({"id": product["id"]}, {"$set": fields, "$setOnInsert": created}, upsert=True))
+        errors = []
+        try:
+            result = (await self.collection.bulk_write(operations, ordered=False)).bulk_api_result
+        except BulkWriteError as e:
+            result = e.details
+            errors = [(error["index"], error["errmsg"]) for error in result["writeErrors"]]
+
+        failed = {index for index, _ in errors}
+        stored = await self.get_many([product["id"] for index, product in enumerate(products) if index not in failed])
+        self.notify(list(stored.values()))
+        return result["nUpserted"], result["nMatched"], result["nModified"], errors
+
+
+class CartRepository:
+    """Async access to per-session carts.
+
+    Every line carries the cart_id it belongs to and every query is scoped
+    by it, so reads cost O(lines in this cart) through the (cart_id,
+    product_id) index whatever the total cart volume, and cart_id is a
+    natural (hashed) shard key. A TTL index on added_at expires abandoned
+    lines without a cron job.
+    """
+
+    def __init__(self, collection: Optional[AsyncIOMotorCollection] = None):
+        self.collection = collection
+        self.listeners: List[CartListener] = []
+
+    def add_listener(self, listener: CartListener):
+        self.listeners.append(listener)
+
+    def notify(self, cart_id: str, line: Optional[dict], removed: bool = False):
+        if line is None:
+            return
+        for listener in self.listeners:
+            listener(cart_id, line, removed)
+
+    async def view(self, cart_id: str, products_collection: str = "products") -> dict:
+        """Cart lines joined with their product in a single aggregation.
+
+        Lines whose product no longer exists are dropped by the $unwind,
+        and the total is accumulated while the cursor is drained.
+        """
+        pipeline = [
+            {"$match": {"cart_id": cart_id}},
+            {"$lookup": {
+                "from": products_collection,
+                "localField": "product_id",
+                "foreignField": "id",
+                "as": "product",
+            }},
+            {"$unwind": "$product"},
+            {"$project": {"_id": 0, "cart_id": 0, "product._id": 0}},
+        ]
+        items = []
+        total = 0.0
+        async for item in self.collection.aggregate(pipeline):
+            total += item["product"]["price"] * item["quantity"]
+            item["added_at"] = item["added_at"].isoformat()
+            items.append(item)
+        return {"items": items, "total": round(total, 2), "count": len(items)}
+
+    async def add(self, cart_id: str, product_id: str, quantity: int):
+        """Atomically add quantity of a product to the cart.
+
+        The line is upserted with $inc, so concurrent adds cannot lose
+        increments. When two adds race to create the line, the unique
+        (cart_id, product_id) index rejects one upsert, which is then
+        applied as a plain $inc. Stock is checked by the reservation taken
+        before the add.
+        """
+        line_filter = {"cart_id": cart_id, "product_id": product_id}
+        # Touching a line pushes back its expiry
+        update = {"$inc": {"quantity": quantity}, "$set": {"added_at": datetime.now(timezone.utc)}}
+        try:
+            line = await self.collection.find_one_and_update(
+                line_filter,
+                {**update, "$setOnInsert": {"id": str(uuid.uuid4())}},
+                LINE_PROJECTION,
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            line = await self.collection.find_one_and_update(
+                line_filter, update, LINE_PROJECTION, return_document=ReturnDocument.AFTER)
+        self.notify(cart_id, line)
+
+    async def lines(self, cart_id: str) -> List[dict]:
+        """The cart's lines, with their Mongo _id, which change events identify deletes by."""
+        return await self.collection.find(
+            {"cart_id": cart_id}, {**LINE_PROJECTION, "_id": 1}
+        ).to_list(length=None)
+
+    async def get_line(self, cart_id: str, item_id: str) -> Optional[dict]:
+        return await self.collection.find_one({"cart_id": cart_id, "id": item_id}, {"_id": 0})
+
+    async def set_quantity(self, cart_id: str, item_id: str, quantity: int) -> bool:
+        line = await self.collection.find_one_and_update(
+            {"cart_id": cart_id, "id": item_id},
+            {"$set": {"quantity": quantity, "added_at": datetime.now(timezone.utc)}},
+            LINE_PROJECTION,
+            return_document=ReturnDocument.AFTER,
+        )
+        self.notify(cart_id, line)
+        return line is not None
+
+    async def remove(self, cart_id: str, item_id: str) -> Optional[dict]:
+        """Delete a line, returning it, or None if there was no such line."""
+        line = await self.collection.find_one_and_delete({"cart_id": cart_id, "id": item_id}, {"_id": 0})
+        self.notify(cart_id, line, removed=True)
+        return line
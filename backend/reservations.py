@@ -0,0 +1,159 @@
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from metrics import registry
+from repository import ProductRepository
+
+# Lock-free reservations wait on nothing, so contention shows as failures and retries
+reservation_outcomes = registry.counter(
+    "stock_reservations_total", "Stock reservation attempts by outcome", ("outcome",))
+reservation_duration = registry.histogram(
+    "stock_reservation_duration_seconds", "Time to take stock and record the hold", ("outcome",))
+reservations_in_flight = registry.gauge(
+    "stock_reservations_in_flight", "Stock reservations started and not yet finished")
+stock_released = registry.counter(
+    "stock_released_units_total", "Units of held stock returned, by reason", ("reason",))
+batch_rollbacks = registry.counter(
+    "stock_batch_rollbacks_total", "Whole-cart reservations undone because an item was unavailable")
+
+
+class ReservationRepository:
+    """Time-limited holds on product stock, one per cart and product.
+
+    Reserving takes the quantity off products.stock with a conditional $inc
+    (ProductRepository.take_stock) and then records the hold, so stock
+    never goes negative and no lock is held across round-trips. Holds
+    expire after ttl_seconds; sweep() deletes expired holds one at a time
+    with find_one_and_delete, so any number of workers can sweep
+    concurrently and each hold is returned to stock exactly once.
+
+    A process dying between taking stock and recording the hold, or between
+    deleting a hold and returning its stock, loses those units until an
+    operator corrects the stock: the engine errs towards underselling.
+    """
+
+    def __init__(self, products: ProductRepository, collection: Optional[AsyncIOMotorCollection] = None,
+                 ttl_seconds: int = 900):
+        self.products = products
+        self.collection = collection
+        self.ttl_seconds = ttl_seconds
+
+    def expiry(self) -> datetime:
+        return datetime.now(timezone.utc) + timedelta(seconds=self.ttl_seconds)
+
+    async def reserve(self, cart_id: str, product_id: str, quantity: int) -> bool:
+        """Hold quantity more of a product for a cart; False if not enough is in stock."""
+        started = time.perf_counter()
+        reservations_in_flight.inc()
+        outcome = "error"
+        try:
+            if not await self.products.take_stock(product_id, quantity):
+                outcome = "insufficient_stock"
+                return False
+            try:
+                await self._add_hold(cart_id, product_id, quantity)
+            except BaseException:
+                await self.products.return_stock(product_id, quantity)
+                raise
+            outcome = "reserved"
+            return True
+        finally:
+            reservations_in_flight.inc(amount=-1)
+            reservation_outcomes.inc(outcome)
+            reservation_duration.observe(time.perf_counter() - started, outcome)
+
+    async def _add_hold(self, cart_id: str, product_id: str, quantity: int):
+        hold_filter = {"cart_id": cart_id, "product_id": product_id}
+        update = {"$inc": {"quantity": quantity}, "$set": {"expires_at": self.expiry()}}
+        try:
+            await self.collection.update_one(hold_filter, update, upsert=True)
+        except DuplicateKeyError:
+            # A concurrent reserve created the hold first
+            await self.collection.update_one(hold_filter, update)
+
+    async def release(self, cart_id: str, product_id: str, quantity: Optional[int] = None,
+                      reason: str = "cart") -> int:
+        """Return quantity of a hold to stock, or all of it; the units released."""
+        hold_filter = {"cart_id": cart_id, "product_id": product_id}
+        released = 0
+        if quantity is not None:
+            hold = await self.collection.find_one_and_update(
+                {**hold_filter, "quantity": {"$gt": quantity}},
+                {"$inc": {"quantity": -quantity}},
+                return_document=ReturnDocument.AFTER,
+            )
+            if hold is not None:
+                released = quantity
+        if not released:
+            # Releasing at least the whole hold
+            hold = await self.collection.find_one_and_delete(hold_filter)
+            if hold is not None:
+                released = hold["quantity"]
+        if released:
+            await self.products.return_stock(product_id, released)
+            stock_released.inc(reason, amount=released)
+        return released
+
+    async def holds(self, cart_id: str) -> Dict[str, int]:
+        """Units held for a cart, by product id."""
+        cursor = self.collection.find({"cart_id": cart_id}, {"_id": 0, "product_id": 1, "quantity": 1})
+        return {hold["product_id"]: hold["quantity"] async for hold in cursor}
+
+    async def reserve_cart(self, cart_id: str, quantities: Dict[str, int]) -> Tuple[bool, List[str]]:
+        """Bring the cart's holds to exactly the given quantities, all or nothing.
+
+        Products are reserved in id order. If any product is short, the
+        units taken by this call are returned and the unavailable ids are
+        reported; holds already in place are left as they were. On success
+        every hold of the cart gets a fresh expiry.
+        """
+        held = await self.holds(cart_id)
+        taken: List[Tuple[str, int]] = []
+        unavailable = []
+        for product_id in sorted(quantities):
+            missing = quantities[product_id] - held.get(product_id, 0)
+            if missing <= 0:
+                continue
+            if await self.reserve(cart_id, product_id, missing):
+                taken.append((product_id, missing))
+            else:
+                unavailable.append(product_id)
+
+        if unavailable:
+            for product_id, quantity in taken:
+                await self.release(cart_id, product_id, quantity, reason="rollback")
+            batch_rollbacks.inc()
+            return False, unavailable
+
+        for product_id, quantity in held.items():
+            excess = quantity - quantities.get(product_id, 0)
+            if excess > 0:
+                await self.release(cart_id, product_id, excess)
+        await self.collection.update_many({"cart_id": cart_id}, {"$set": {"expires_at": self.expiry()}})
+        return True, []
+
+    async def sweep(self, now: Optional[datetime] = None) -> int:
+        """Return every expired hold to stock; the number of holds swept."""
+        now = now or datetime.now(timezone.utc)
+        swept = 0
+        while True:
+            hold = await self.collection.find_one_and_delete({"expires_at": {"$lte": now}})
+            if hold is None:
+                return swept
+            await self.products.return_stock(hold["product_id"], hold["quantity"])
+            stock_released.inc("expired", amount=hold["quantity"])
+            swept += 1
+
+    async def run_sweeper(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sweep()
+            except PyMongoError as e:
+                print(f"Reservation sweep failed, retrying: {e}")
@@ -0,0 +1,250 @@
+import bisect
+import heapq
+import math
+import re
+import unicodedata
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+# Ligatures NFKD leaves alone but French text uses ("œuf", "ex æquo")
+LIGATURES = str.maketrans({"œ": "oe", "æ": "ae", "ß": "ss"})
+
+# Per-field weight applied to term frequencies (a light BM25F)
+FIELD_WEIGHTS = {"name": 3.0, "brand": 2.0, "description": 1.0}
+
+# Prefix expansion is skipped for one-letter tokens and capped per token so
+# a short prefix cannot fan out over the whole vocabulary
+MIN_PREFIX_LENGTH = 2
+MAX_PREFIX_EXPANSIONS = 64
+PREFIX_PENALTY = 0.8
+
+# Product fields kept alongside each document so searches can be filtered
+FILTER_FIELDS = ("category", "brand", "console", "condition")
+
+
+def _in_range(price, min_price: Optional[float], max_price: Optional[float]) -> bool:
+    if price is None:
+        return False
+    return (min_price is None or price >= min_price) and (max_price is None or price <= max_price)
+
+
+def fold(text: str) -> str:
+    """Lowercase and strip accents so "Très bon état" matches "tres bon etat"."""
+    decomposed = unicodedata.normalize("NFKD", text.lower().translate(LIGATURES))
+    return "".join(char for char in decomposed if not unicodedata.combining(char))
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    if not text:
+        return []
+    return TOKEN_RE.findall(fold(text))
+
+
+class _Descending(str):
+    """A product id that sorts backwards, so equal scores rank by ascending id."""
+
+    def __lt__(self, other):
+        return str.__gt__(self, other)
+
+
+def _scaled(order: List[Tuple[float, str]], weight: float) -> Iterator[Tuple[float, str]]:
+    for negative, doc in order:
+        yield negative * weight, doc
+
+
+class SearchIndex:
+    """In-memory inverted index over product name, brand and description.
+
+    Every query token must match a document, either exactly or as a prefix
+    of an indexed term, and matches are ranked with BM25. Each term keeps an
+    impact-ordered posting list so the top results can be found with the
+    threshold algorithm without scoring every candidate.
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Dict[str, float]] = {}
+        self.vocabulary: List[str] = []
+        self.doc_terms: Dict[str, Dict[str, float]] = {}
+        self.doc_lengths: Dict[str, float] = {}
+        self.doc_attributes: Dict[str, Tuple] = {}
+        self.total_length = 0.0
+        # Term -> (posting list sorted by descending impact, impact per doc).
+        # Impacts are the idf-free part of BM25, computed against a snapshot of
+        # the average document length that is refreshed when the corpus drifts.
+        self.impacts: Dict[str, Tuple[List[Tuple[float, str]], Dict[str, float]]] = {}
+        self.scoring_docs = 0
+        self.scoring_average_length = 0.0
+        self.ready = False
+
+    def __len__(self) -> int:
+        return len(self.doc_terms)
+
+    def add(self, product: dict):
+        product_id = product["id"]
+        if product_id in self.doc_terms:
+            self.remove(product_id)
+
+        terms: Dict[str, float] = {}
+        for field, weight in FIELD_WEIGHTS.items():
+            for token in tokenize(product.get(field)):
+                terms[token] = terms.get(token, 0.0) + weight
+
+        length = sum(terms.values())
+        self.doc_terms[product_id] = terms
+        self.doc_lengths[product_id] = length
+        self.doc_attributes[product_id] = tuple(product.get(field) for field in FILTER_FIELDS) + (product.get("price"),)
+        self.total_length += length
+
+        for term, frequency in terms.items():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = {}
+                bisect.insort(self.vocabulary, term)
+            postings[product_id] = frequency
+            cached = self.impacts.get(term)
+            if cached is not None:
+                impact = self._impact(frequency, length)
+                bisect.insort(cached[0], (-impact, product_id))
+                cached[1][product_id] = impact
+
+    def remove(self, product_id: str):
+        terms = self.doc_terms.pop(product_id, None)
+        if terms is None:
+            return
+        for term in terms:
+            postings = self.postings[term]
+            del postings[product_id]
+            if not postings:
+                del self.postings[term]
+                del self.vocabulary[bisect.bisect_left(self.vocabulary, term)]
+            cached = self.impacts.get(term)
+            if cached is not None:
+                if postings:
+                    order, impacts = cached
+                    del order[bisect.bisect_left(order, (-impacts.pop(product_id), product_id))]
+                else:
+                    del self.impacts[term]
+        self.total_length -= self.doc_lengths.pop(product_id)
+        self.doc_attributes.pop(product_id, None)
+
+    def on_products_changed(self, changed: Iterable[dict], removed_ids: Iterable[str] = ()):
+        """Repository listener keeping the index in step with writes."""
+        for product in changed:
+            self.add(product)
+        for product_id in removed_ids:
+            self.remove(product_id)
+
+    def _impact(self, frequency: float, length: float) -> float:
+        norm = self.k1 * (1 - self.b + self.b * length / self.scoring_average_length)
+        return frequency * (self.k1 + 1) / (frequency + norm)
+
+    def _refresh_scoring(self):
+        """Recompute impacts once the corpus size drifts by more than 10%."""
+        doc_count = len(self.doc_terms)
+        if abs(doc_count - self.scoring_docs) > 0.1 * max(self.scoring_docs, 1):
+            self.impacts.clear()
+            self.scoring_docs = doc_count
+            self.scoring_average_length = (self.total_length / doc_count) or 1.0
+
+    def _term_impacts(self, term: str) -> Tuple[List[Tuple[float, str]], Dict[str, float]]:
+        cached = self.impacts.get(term)
+        if cached is None:
+            impacts = {
+                doc: self._impact(frequency, self.doc_lengths[doc])
+                for doc, frequency in self.postings[term].items()
+            }
+            order = sorted((-impact, doc) for doc, impact in impacts.items())
+            cached = self.impacts[term] = (order, impacts)
+        return cached
+
+    def _idf(self, term: str) -> float:
+        matching = len(self.postings[term])
+        return math.log(1 + (len(self.doc_terms) - matching + 0.5) / (matching + 0.5))
+
+    def _expand(self, token: str) -> Dict[str, float]:
+        """Indexed terms a query token matches, with their score multiplier."""
+        matches = {}
+        if token in self.postings:
+            matches[token] = 1.0
+        if len(token) >= MIN_PREFIX_LENGTH:
+            start = bisect.bisect_left(self.vocabulary, token)
+            for term in self.vocabulary[start:start + MAX_PREFIX_EXPANSIONS + 1]:
+                if not term.startswith(token):
+                    break
+                matches.setdefault(term, PREFIX_PENALTY)
+        return matches
+
+    def search(self, query: str, filters: Optional[dict] = None, limit: int = 200,
+               min_price: Optional[float] = None, max_price: Optional[float] = None) -> List[str]:
+        """Product ids matching every token of query and the filters, best first.
+
+        filters maps fields of FILTER_FIELDS to the value they must equal;
+        min_price and max_price bound the price, inclusively. Equal scores
+        rank by id, so the first n results are the same whatever the limit
+        and pages cut from them never overlap.
+        """
+        tokens = tokenize(query)
+        if not tokens or not self.doc_terms or limit <= 0:
+            return []
+
+        expansions = [self._expand(token) for token in dict.fromkeys(tokens)]
+        if not all(expansions):
+            return []
+        self._refresh_scoring()
+
+        # Per token: (term impacts, weight) pairs for random access, and one
+        # stream of (-score, doc) in descending score order for sorted access
+        weighted = []
+        streams = []
+        for terms in expansions:
+            pairs = []
+            for term, multiplier in terms.items():
+                order, impacts = self._term_impacts(term)
+                weight = multiplier * self._idf(term)
+                pairs.append((impacts, weight, order))
+            weighted.append([(impacts, weight) for impacts, weight, _ in pairs])
+            streams.append(heapq.merge(*[_scaled(order, weight) for _, weight, order in pairs]))
+
+        required = [
+            (FILTER_FIELDS.index(field), value) for field, value in (filters or {}).items()
+        ]
+        bounded = min_price is not None or max_price is not None
+
+        top: List[Tuple[float, _Descending]] = []
+        seen = set()
+        last_scores = [math.inf] * len(streams)
+        while True:
+            for position, stream in enumerate(streams):
+                item = next(stream, None)
+                if item is None:
+                    # Every document matching this token has been scored
+                    return [str(doc) for _, doc in sorted(top, reverse=True)]
+                negative, doc = item
+                last_scores[position] = -negative
+                if doc in seen:
+                    continue
+                seen.add(doc)
+                if required or bounded:
+                    attributes = self.doc_attributes[doc]
+                    if any(attributes[index] != value for index, value in required):
+                        continue
+                    if bounded and not _in_range(attributes[-1], min_price, max_price):
+                        continue
+                score = 0.0
+                for pairs in weighted:
+                    best = max((impacts.get(doc, 0.0) * weight for impacts, weight in pairs), default=0.0)
+                    if not best:
+                        break
+                    score += best
+                else:
+                    entry = (score, _Descending(doc))
+                    if len(top) < limit:
+                        heapq.heappush(top, entry)
+                    elif top[0] < entry:
+                        heapq.heapreplace(top, entry)
+            # No unseen document can beat, or tie, the current top results
+            if len(top) >= limit and top[0][0] > sum(last_scores):
+                return [str(doc) for _, doc in sorted(top, reverse=True)]
@@ -1,12 +1,82 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pymongo import MongoClient
-from typing import List, Optional
+from fastapi.responses import ORJSONResponse, PlainTextResponse, StreamingResponse
+from motor.motor_asyncio import AsyncIOMotorClient
+from typing import List, Optional, Set
+import asyncio
 import os
+import re
+import tempfile
+import time
 import uuid
-from datetime import datetime
 
-app = FastAPI()
+from admission import AdmissionMiddleware, LoadShedder, RateLimiter
+from analytics import Analytics
+from bootstrap import Bootstrap, create_product
+from bulk import ImportReport, export_batches, import_rows, parse_csv, parse_ndjson
+from cache import ANY_PRODUCT, ResponseCache, etag_matches
+from compression import CompressionMiddleware
+from encoding import EncodedProducts, dumps, stream_page
+from facets import FacetSummary, format_aggregation
+from live import LiveHub, compact_line, sse_frame
+from loader import ProductLoader
+from images import KEY_RE, MEDIA_TYPES, VARIANT_RE, ImageError, ImageStore, ProductImages
+from invalidation import ChangeStreamFeed, SocketBroadcast, supports_change_streams
+from jobs import JobQueue
+from metrics import MetricsMiddleware, MongoCommandListener, lag_monitor, registry, span
+from models import CartView, CheckoutIn, Order
+from orders import EmptyCart, OrderJobs, OrderRepository, OutOfStock
+from related import RelatedIndex
+from reservations import ReservationRepository
+from repository import (
+    LISTING_SORTS,
+    PRODUCT_FIELDS,
+    CartRepository,
+    ProductRepository,
+    decode_cursor,
+    encode_cursor,
+    keyset_position,
+    price_range,
+    projection,
+)
+from search_index import SearchIndex
+
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# Admission control: token buckets per client and route (requests per
+# second and burst; a rate of 0 disables the limit) and a concurrency cap
+# on writes that shrinks while Mongo or the event loop falls behind. Added
+# first so that rejections still carry CORS headers
+RATE_LIMIT_READ_PER_SECOND = float(os.environ.get('RATE_LIMIT_READ_PER_SECOND', '50'))
+RATE_LIMIT_READ_BURST = float(os.environ.get('RATE_LIMIT_READ_BURST', '100'))
+RATE_LIMIT_WRITE_PER_SECOND = float(os.environ.get('RATE_LIMIT_WRITE_PER_SECOND', '10'))
+RATE_LIMIT_WRITE_BURST = float(os.environ.get('RATE_LIMIT_WRITE_BURST', '20'))
+RATE_LIMIT_MAX_CLIENTS = int(os.environ.get('RATE_LIMIT_MAX_CLIENTS', '10000'))
+# Behind a reverse proxy every client shares its address: list the proxies'
+# addresses or CIDR ranges, and clients are told apart by X-Forwarded-For
+RATE_LIMIT_TRUSTED_PROXIES = os.environ.get('RATE_LIMIT_TRUSTED_PROXIES', '').split(',')
+SHED_MAX_READS = int(os.environ.get('SHED_MAX_READS', '512'))
+SHED_MAX_WRITES = int(os.environ.get('SHED_MAX_WRITES', '64'))
+SHED_MIN_WRITES = int(os.environ.get('SHED_MIN_WRITES', '4'))
+SHED_MAX_MONGO_IN_FLIGHT = int(os.environ.get('SHED_MAX_MONGO_IN_FLIGHT', '200'))
+SHED_MAX_LOOP_LAG_SECONDS = float(os.environ.get('SHED_MAX_LOOP_LAG_SECONDS', '0.2'))
+
+rate_limiter = RateLimiter({
+    "read": (RATE_LIMIT_READ_PER_SECOND, RATE_LIMIT_READ_BURST),
+    "write": (RATE_LIMIT_WRITE_PER_SECOND, RATE_LIMIT_WRITE_BURST),
+}, RATE_LIMIT_MAX_CLIENTS)
+mongo_listener = MongoCommandListener()
+load_shedder = LoadShedder(
+    lambda: mongo_listener.in_flight,
+    lambda: lag_monitor.last_lag,
+    max_reads=SHED_MAX_READS,
+    max_writes=SHED_MAX_WRITES,
+    min_writes=SHED_MIN_WRITES,
+    max_mongo_in_flight=SHED_MAX_MONGO_IN_FLIGHT,
+    max_loop_lag=SHED_MAX_LOOP_LAG_SECONDS,
+)
+app.add_middleware(AdmissionMiddleware, rate_limiter=rate_limiter, load_shedder=load_shedder,
+                   trusted_proxies=RATE_LIMIT_TRUSTED_PROXIES)
 
 # CORS middleware
 app.add_middleware(
@@ -15,330 +85,917 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Cart-Id", "Server-Timing", "Retry-After"],
 )
 
+# Negotiated brotli/gzip for bodies above the threshold and for streams
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '1024'))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', '6'))
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', '4'))
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=COMPRESSION_MIN_SIZE,
+    gzip_level=COMPRESSION_GZIP_LEVEL,
+    brotli_quality=COMPRESSION_BROTLI_QUALITY,
+)
+
+# Per-route latency, Mongo command tracing and a Server-Timing header
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', '10'))
+app.add_middleware(MetricsMiddleware, n_plus_one_threshold=N_PLUS_ONE_THRESHOLD)
+
 # MongoDB connection
 MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
 DB_NAME = os.environ.get('DB_NAME', 'test_database')
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', '100'))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', '0'))
+MONGO_CONNECT_TIMEOUT_MS = int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', '5000'))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', '5000'))
+MONGO_SOCKET_TIMEOUT_MS = int(os.environ.get('MONGO_SOCKET_TIMEOUT_MS', '10000'))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', '2000'))
 
-client = MongoClient(MONGO_URL)
-db = client[DB_NAME]
-products_collection = db.products
-cart_collection = db.cart
+# The client is created in startup, in each worker process: pymongo
+# clients must not be shared across a fork
+client: Optional[AsyncIOMotorClient] = None
+db = None
+products_repo = ProductRepository()
+cart_repo = CartRepository()
 
-# Product model structure
-def create_product(name: str, category: str, price: float, description: str, 
-                  image_url: str, condition: str = "Très bon état", 
-                  console: str = None, brand: str = None, stock: int = 1):
-    return {
-        "id": str(uuid.uuid4()),
-        "name": name,
-        "category": category,
-        "price": price,
-        "description": description,
-        "image_url": image_url,
-        "condition": condition,
-        "console": console,
-        "brand": brand,
-        "stock": stock,
-        "created_at": datetime.now().isoformat()
-    }
+# Stock held for carts, returned to stock when a hold expires
+RESERVATION_TTL_SECONDS = int(os.environ.get('RESERVATION_TTL_SECONDS', '900'))
+RESERVATION_SWEEP_INTERVAL_SECONDS = float(os.environ.get('RESERVATION_SWEEP_INTERVAL_SECONDS', '30'))
+reservations = ReservationRepository(products_repo, ttl_seconds=RESERVATION_TTL_SECONDS)
+
+# Side effects of writes (order emails, invoices, analytics) queued in Mongo
+# and run by a pool of workers in every process
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '4'))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '5'))
+JOB_RETRY_DELAY_SECONDS = float(os.environ.get('JOB_RETRY_DELAY_SECONDS', '2'))
+JOB_LEASE_SECONDS = float(os.environ.get('JOB_LEASE_SECONDS', '60'))
+JOB_POLL_INTERVAL_SECONDS = float(os.environ.get('JOB_POLL_INTERVAL_SECONDS', '1'))
+JOB_MAX_BACKLOG = int(os.environ.get('JOB_MAX_BACKLOG', '10000'))
+job_queue = JobQueue(
+    concurrency=JOB_WORKERS,
+    max_attempts=JOB_MAX_ATTEMPTS,
+    retry_delay=JOB_RETRY_DELAY_SECONDS,
+    lease_seconds=JOB_LEASE_SECONDS,
+    poll_interval=JOB_POLL_INTERVAL_SECONDS,
+    max_backlog=JOB_MAX_BACKLOG,
+)
+
+# Checkout runs in one transaction where the deployment supports them
+# (replica sets, mongos): auto, true or false
+CHECKOUT_TRANSACTIONS = os.environ.get('CHECKOUT_TRANSACTIONS', 'auto').lower()
+SMTP_HOST = os.environ.get('SMTP_HOST')
+SMTP_PORT = int(os.environ.get('SMTP_PORT', '25'))
+ORDER_EMAIL_SENDER = os.environ.get('ORDER_EMAIL_SENDER', 'boutique@localhost')
+orders_repo = OrderRepository(products_repo, cart_repo, reservations, job_queue)
+OrderJobs(orders_repo, SMTP_HOST, SMTP_PORT, ORDER_EMAIL_SENDER).register(job_queue)
+
+# Columnar snapshots of products, carts and orders behind /api/analytics,
+# read from secondaries when there are any. ANALYTICS_MONGO_URL gives the
+# scans their own small pool, e.g. on a hidden analytics member
+ANALYTICS_REFRESH_SECONDS = float(os.environ.get('ANALYTICS_REFRESH_SECONDS', '300'))
+ANALYTICS_BATCH_SIZE = int(os.environ.get('ANALYTICS_BATCH_SIZE', '10000'))
+ANALYTICS_MONGO_URL = os.environ.get('ANALYTICS_MONGO_URL')
+ANALYTICS_MAX_POOL_SIZE = int(os.environ.get('ANALYTICS_MAX_POOL_SIZE', '4'))
+ANALYTICS_MAX_DAYS = 366
+analytics_client: Optional[AsyncIOMotorClient] = None
+analytics = Analytics(ANALYTICS_REFRESH_SECONDS, ANALYTICS_BATCH_SIZE)
+
+# Product images: each image_url is fetched once by a background job and
+# resized to WebP/AVIF variants in a pool of processes, stored on disk by
+# content hash and served as immutable. IMAGE_LOCAL_ROOT allows file://
+# image URLs under that directory, e.g. for tests. Other image URLs must
+# resolve to public addresses and, if IMAGE_FETCH_HOSTS lists any, be on
+# one of those hosts
+IMAGE_CACHE_DIR = os.environ.get('IMAGE_CACHE_DIR', os.path.join(tempfile.gettempdir(), f'gaming-store-{DB_NAME}-images'))
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get('IMAGE_CACHE_MAX_BYTES', str(2 * 2 ** 30)))
+IMAGE_WIDTHS = [int(width) for width in os.environ.get('IMAGE_WIDTHS', '160,320,640,1280').split(',')]
+IMAGE_FORMATS = os.environ.get('IMAGE_FORMATS', 'avif,webp').split(',')
+IMAGE_AVIF_QUALITY = int(os.environ.get('IMAGE_AVIF_QUALITY', '55'))
+IMAGE_WEBP_QUALITY = int(os.environ.get('IMAGE_WEBP_QUALITY', '80'))
+IMAGE_PROCESSES = int(os.environ.get('IMAGE_PROCESSES', '2'))
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', '2'))
+IMAGE_MAX_SOURCE_BYTES = int(os.environ.get('IMAGE_MAX_SOURCE_BYTES', str(20 * 2 ** 20)))
+IMAGE_FETCH_TIMEOUT_SECONDS = float(os.environ.get('IMAGE_FETCH_TIMEOUT_SECONDS', '20'))
+IMAGE_LOCAL_ROOT = os.environ.get('IMAGE_LOCAL_ROOT')
+IMAGE_FETCH_HOSTS = os.environ.get('IMAGE_FETCH_HOSTS', '').split(',')
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+image_store = ImageStore(
+    IMAGE_CACHE_DIR,
+    widths=IMAGE_WIDTHS,
+    formats=IMAGE_FORMATS,
+    quality={"avif": IMAGE_AVIF_QUALITY, "webp": IMAGE_WEBP_QUALITY},
+    max_bytes=IMAGE_CACHE_MAX_BYTES,
+    processes=IMAGE_PROCESSES,
+)
+# Own workers and backlog, so a catalog import never holds up order jobs
+image_jobs = JobQueue(
+    concurrency=IMAGE_WORKERS,
+    max_attempts=JOB_MAX_ATTEMPTS,
+    retry_delay=JOB_RETRY_DELAY_SECONDS,
+    lease_seconds=JOB_LEASE_SECONDS,
+    poll_interval=JOB_POLL_INTERVAL_SECONDS,
+    name="images",
+)
+product_images = ProductImages(products_repo, image_store, image_jobs, IMAGE_MAX_SOURCE_BYTES,
+                               IMAGE_FETCH_TIMEOUT_SECONDS, IMAGE_LOCAL_ROOT, IMAGE_FETCH_HOSTS)
+product_images.register(image_jobs)
+products_repo.add_listener(product_images.on_products_changed)
+
+
+def connect_database():
+    global client, db, analytics_client
+    client = AsyncIOMotorClient(
+        MONGO_URL,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=MONGO_MIN_POOL_SIZE,
+        connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+        serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+        waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        event_listeners=[mongo_listener],
+    )
+    db = client[DB_NAME]
+    products_repo.collection = db.products
+    cart_repo.collection = db.cart
+    reservations.collection = db.reservations
+    job_queue.collection = db.jobs
+    image_jobs.collection = db.jobs
+    orders_repo.collection = db.orders
+    analytics.db = db
+    if ANALYTICS_MONGO_URL:
+        analytics_client = AsyncIOMotorClient(
+            ANALYTICS_MONGO_URL,
+            maxPoolSize=ANALYTICS_MAX_POOL_SIZE,
+            connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+            serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        )
+        analytics.db = analytics_client[DB_NAME]
+
+# Worker processes for `python server.py`; under gunicorn use
+# -k uvicorn.workers.UvicornWorker -w $WEB_CONCURRENCY
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', '1'))
+
+# How product writes reach the in-process views of the other workers:
+# changestream (replica sets, any host), socket (workers on one host), off,
+# or auto (change streams when available, else sockets with several workers)
+WORKER_SYNC = os.environ.get('WORKER_SYNC', 'auto')
+WORKER_SYNC_DIR = os.environ.get('WORKER_SYNC_DIR', os.path.join(tempfile.gettempdir(), f'gaming-store-{DB_NAME}'))
+worker_sync = None
+
+# Server-sent catalog and cart deltas (/api/live), fed by the change stream
+# when there is one, else by this worker's own writes
+LIVE_HEARTBEAT_SECONDS = float(os.environ.get('LIVE_HEARTBEAT_SECONDS', '15'))
+live_hub = LiveHub()
+change_feed = None
+
+# In-process product search, kept in sync with product writes
+SEARCH_INDEX_ENABLED = os.environ.get('SEARCH_INDEX_ENABLED', 'true').lower() == 'true'
+
+# Read-through cache of encoded catalog responses, dropped on product writes
+# and, response by response, on stock changes to the products they show
+CATALOG_CACHE_MAX_ENTRIES = int(os.environ.get('CATALOG_CACHE_MAX_ENTRIES', '1024'))
+CATALOG_CACHE_TTL_SECONDS = float(os.environ.get('CATALOG_CACHE_TTL_SECONDS', '60'))
+CATALOG_CACHE_CONTROL = os.environ.get('CATALOG_CACHE_CONTROL', 'public, max-age=0, must-revalidate')
+
+catalog_cache = ResponseCache(CATALOG_CACHE_MAX_ENTRIES, CATALOG_CACHE_TTL_SECONDS)
+products_repo.add_listener(catalog_cache.on_products_changed)
+products_repo.add_stock_listener(catalog_cache.on_stock_changed)
+
+catalog_cache_events = registry.counter(
+    "catalog_cache_events_total", "Catalog cache lookups and removals", ("event",))
+catalog_cache_entries = registry.gauge("catalog_cache_entries", "Responses held in the catalog cache")
+
+
+def collect_cache_stats():
+    stats = catalog_cache.stats()
+    for event in ("hits", "misses", "evictions", "expirations", "invalidations", "stock_invalidations"):
+        catalog_cache_events.set(stats[event], event)
+    catalog_cache_entries.set(stats["entries"])
+
+
+registry.add_collector(collect_cache_stats)
+
+# Bulk import/export of supplier feeds
+BULK_BATCH_SIZE = int(os.environ.get('BULK_BATCH_SIZE', '1000'))
+BULK_MAX_REPORTED_ERRORS = int(os.environ.get('BULK_MAX_REPORTED_ERRORS', '1000'))
+BULK_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv; charset=utf-8"}
+
+# Carts are keyed by a session id sent back in a header and a cookie
+CART_HEADER = "X-Cart-Id"
+CART_COOKIE = "cart_id"
+CART_TTL_SECONDS = int(os.environ.get('CART_TTL_SECONDS', str(7 * 24 * 3600)))
+CART_ID_RE = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+
+# Product listing page sizes
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', '50'))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', '200'))
+
+# Ids accepted by one GET /api/products:batch
+BATCH_MAX_IDS = int(os.environ.get('BATCH_MAX_IDS', '300'))
+product_loader = ProductLoader(products_repo)
+
+# Products per chunk of a streamed listing (?stream=true)
+STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', '500'))
+
+# Pre-encoded product JSON that listing pages are assembled from
+encoded_products = EncodedProducts()
+products_repo.add_listener(encoded_products.on_products_changed)
+products_repo.add_stock_listener(encoded_products.on_stock_changed)
+
+search_index = SearchIndex()
+if SEARCH_INDEX_ENABLED:
+    products_repo.add_listener(search_index.on_products_changed)
+
+# Catalog-wide facet counts, serving unfiltered facets and the category list
+facet_summary = FacetSummary()
+products_repo.add_listener(facet_summary.on_products_changed)
+
+# Precomputed similar products for product pages
+RELATED_K = int(os.environ.get('RELATED_K', '12'))
+related_index = RelatedIndex(RELATED_K)
+products_repo.add_listener(related_index.on_products_changed)
+
+
+# Sample data is only written on request, e.g. for local development
+SEED_SAMPLE_DATA = os.environ.get('SEED_SAMPLE_DATA', 'false').lower() in ('1', 'true', 'yes')
+bootstrapper = Bootstrap(products_repo, cart_repo, CART_TTL_SECONDS, SEED_SAMPLE_DATA)
+
+
+async def build_catalog_views():
+    """Load the search index, facet summary and related products in one pass over the catalog."""
+    products = []
+    async for product in products_repo.iter_all():
+        if SEARCH_INDEX_ENABLED:
+            search_index.add(product)
+        facet_summary.add(product)
+        products.append(product)
+    search_index.ready = SEARCH_INDEX_ENABLED
+    facet_summary.ready = True
+    # Drop responses served by the Mongo fallbacks while building
+    catalog_cache.invalidate()
+    print(f"Catalog views built with {len(facet_summary.products)} products")
+    await related_index.rebuild(products)
+    catalog_cache.invalidate()
+    print(f"Related products built for {related_index.stats()['products']} products")
+
+async def start_worker_sync():
+    global worker_sync, change_feed
+    change_streams = await supports_change_streams(db)
+    mode = WORKER_SYNC
+    if mode == "auto":
+        if change_streams:
+            mode = "changestream"
+        else:
+            mode = "socket" if WEB_CONCURRENCY > 1 else "off"
+    if mode == "changestream":
+        worker_sync = change_feed = ChangeStreamFeed(products_repo)
+    elif mode == "socket":
+        worker_sync = SocketBroadcast(products_repo, WORKER_SYNC_DIR)
+
+    # Live updates share the worker's single change stream cursor
+    if change_streams:
+        if change_feed is None:
+            change_feed = ChangeStreamFeed(products_repo, sync_products=False)
+        live_hub.watch(change_feed, products_repo.collection.name, cart_repo.collection.name)
+        change_feed.start()
+    else:
+        live_hub.listen(products_repo, cart_repo)
+    if worker_sync is not None and worker_sync is not change_feed:
+        worker_sync.start()
+    print(f"Worker {os.getpid()} product sync: {mode}, live updates: {'changestream' if change_streams else 'local'}")
 
-# Initialize sample products
 @app.on_event("startup")
 async def startup_event():
-    # Check if products already exist
-    if products_collection.count_documents({}) == 0:
-        sample_products = [
-            # Consoles
-            create_product(
-                "PlayStation 5",
-                "consoles",
-                450.00,
-                "Console PlayStation 5 d'occasion en excellent état. Inclut la manette DualSense.",
-                "https://images.unsplash.com/photo-1507457379470-08b800bebc67",
-                "Excellent état",
-                "PlayStation 5",
-                "Sony",
-                2
-            ),
-            create_product(
-                "Xbox One X",
-                "consoles", 
-                320.00,
-                "Console Xbox One X d'occasion. Parfait pour jouer en 4K.",
-                "https://images.unsplash.com/photo-1571126770292-d50130a36459",
-                "Bon état",
-                "Xbox One",
-                "Microsoft",
-                1
-            ),
-            create_product(
-                "PlayStation 1 Retro",
-                "consoles",
-                85.00,
-                "Console PlayStation 1 vintage avec manette d'origine. Parfait pour les nostalgiques.",
-                "https://images.unsplash.com/photo-1531390658120-e06b58d826ea",
-                "Bon état",
-                "PlayStation 1",
-                "Sony",
-                1
-            ),
-            
-            # Manettes
-            create_product(
-                "Manette Xbox Series X",
-                "manettes",
-                45.00,
-                "Manette sans fil Xbox Series X en très bon état. Compatible avec PC et Xbox.",
-                "https://images.unsplash.com/photo-1629917629391-47d9209b7c19",
-                "Très bon état",
-                "Xbox Series X",
-                "Microsoft",
-                3
-            ),
-            create_product(
-                "Manette DualSense PS5",
-                "manettes",
-                55.00,
-                "Manette DualSense officielle PlayStation 5 avec retour haptique.",
-                "https://images.unsplash.com/photo-1571716846319-21f2bf095516",
-                "Excellent état",
-                "PlayStation 5",
-                "Sony",
-                2
-            ),
-            create_product(
-                "Manette PlayStation 4",
-                "manettes",
-                35.00,
-                "Manette DualShock 4 pour PlayStation 4. Fonctionne parfaitement.",
-                "https://images.pexels.com/photos/32713615/pexels-photo-32713615.jpeg",
-                "Bon état",
-                "PlayStation 4",
-                "Sony",
-                4
-            ),
-            
-            # Casques
-            create_product(
-                "Casque Gaming Pro",
-                "casques",
-                89.00,
-                "Casque gaming haute qualité avec microphone détachable. Son surround 7.1.",
-                "https://images.unsplash.com/photo-1677086813101-496781a0f327",
-                "Très bon état",
-                None,
-                "Gaming Pro",
-                2
-            ),
-            create_product(
-                "Casque Gaming RGB",
-                "casques",
-                65.00,
-                "Casque gaming avec éclairage RGB et son immersif. Compatible toutes plateformes.",
-                "https://images.unsplash.com/photo-1600186279172-fdbaefd74383",
-                "Bon état",
-                None,
-                "RGB Gaming",
-                1
-            ),
-            
-            # Claviers
-            create_product(
-                "Clavier Mécanique RGB",
-                "claviers",
-                75.00,
-                "Clavier mécanique gaming avec switches Blue et rétroéclairage RGB personnalisable.",
-                "https://images.unsplash.com/photo-1612198188060-c7c2a3b66eae",
-                "Très bon état",
-                None,
-                "Mechanical Pro",
-                2
-            ),
-            create_product(
-                "Clavier Gaming Compact",
-                "claviers",
-                55.00,
-                "Clavier gaming compact 60% avec éclairage RGB. Parfait pour l'esport.",
-                "https://images.unsplash.com/photo-1631449061775-c79df03a44f6",
-                "Excellent état",
-                None,
-                "Compact Gaming",
-                1
-            ),
-            
-            # Souris
-            create_product(
-                "Souris Gaming RGB",
-                "souris",
-                42.00,
-                "Souris gaming haute précision avec capteur optique 12000 DPI et éclairage RGB.",
-                "https://images.unsplash.com/photo-1628832307345-7404b47f1751",
-                "Très bon état",
-                None,
-                "Gaming RGB",
-                3
-            ),
-            create_product(
-                "Souris Esport Pro",
-                "souris",
-                38.00,
-                "Souris gaming professionnelle utilisée par les joueurs esport. Très légère.",
-                "https://images.pexels.com/photos/2115256/pexels-photo-2115256.jpeg",
-                "Bon état",
-                None,
-                "Esport Pro",
-                2
-            ),
-            
-            # Jeux vidéo
-            create_product(
-                "Call of Duty Modern Warfare",
-                "jeux",
-                35.00,
-                "Jeu Call of Duty Modern Warfare pour PlayStation 4. Excellent état.",
-                "https://images.pexels.com/photos/8307628/pexels-photo-8307628.jpeg",
-                "Excellent état",
-                "PlayStation 4",
-                "Activision",
-                1
-            ),
-        ]
-        
-        products_collection.insert_many(sample_products)
-        print("Sample products inserted successfully!")
+    connect_database()
+    await start_worker_sync()
+    # Transactions need the same deployments as change streams
+    orders_repo.transactions = CHECKOUT_TRANSACTIONS == "true" or (
+        CHECKOUT_TRANSACTIONS == "auto" and await supports_change_streams(db))
+    job_queue.start()
+    if image_store.enabled:
+        image_jobs.start()
+        asyncio.create_task(image_store.load())
+    # Seeding and index builds run in the background; /api/health/ready
+    # reports their progress and holds traffic until the unique indexes exist
+    asyncio.create_task(bootstrapper.run())
+    # Searches fall back to the $text index, and facets to an aggregation,
+    # until the build completes
+    asyncio.create_task(build_catalog_views())
+    asyncio.create_task(lag_monitor.run())
+    asyncio.create_task(reservations.run_sweeper(RESERVATION_SWEEP_INTERVAL_SECONDS))
+    asyncio.create_task(analytics.run())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    live_hub.close()
+    await job_queue.stop()
+    await image_jobs.stop()
+    image_store.close()
+    if worker_sync is not None:
+        worker_sync.stop()
+    if change_feed is not None and change_feed is not worker_sync:
+        change_feed.stop()
+    client.close()
+    if analytics_client is not None:
+        analytics_client.close()
 
 # API Routes
 @app.get("/")
 async def root():
     return {"message": "Gaming Store API"}
 
+async def cached_json(request: Request, key: tuple, produce) -> Response:
+    """Serve a catalog response from the cache, answering If-None-Match with 304.
+
+    produce is given a set to add the ids of the products whose stock the
+    response shows to, so that stock changes drop only those responses.
+    """
+    version = catalog_cache.version
+    entry = catalog_cache.get(key)
+    if entry is None:
+        shown: Set[str] = set()
+        content = await produce(shown)
+        with span("serialize"):
+            body = content if isinstance(content, bytes) else dumps(content)
+        entry = catalog_cache.set(key, body, version, shown)
+
+    headers = {"ETag": entry.etag, "Cache-Control": CATALOG_CACHE_CONTROL}
+    if etag_matches(request.headers.get("if-none-match"), entry.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(entry.body, media_type="application/json", headers=headers)
+
+
+def show_stock(shown: Set[str], products: List[dict], field_list: Optional[List[str]]):
+    """Add the ids of products to shown, if their stock is in the response."""
+    if field_list and "stock" not in field_list:
+        return
+    ids = [product.get("id") for product in products]
+    # Projected out of the response, the ids are unknown here
+    shown.update(ids) if all(ids) else shown.add(ANY_PRODUCT)
+
+
+def parse_fields(fields: Optional[str]) -> Optional[List[str]]:
+    if not fields:
+        return None
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in PRODUCT_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return requested
+
+
+def parse_cursor(cursor: Optional[str], sort: Optional[str]) -> dict:
+    """The position a cursor holds for the listing order; search positions pass through."""
+    if not cursor:
+        return {}
+    try:
+        position = decode_cursor(cursor)
+        if sort is not None:
+            return keyset_position(position, LISTING_SORTS[sort]) or {}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # Search cursors hold an offset into the ranking; listing cursors start over
+    if "offset" not in position:
+        return {}
+    offset = position["offset"]
+    if set(position) != {"offset"} or not isinstance(offset, int) or isinstance(offset, bool) or offset < 0:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return position
+
+
+def product_filters(category: Optional[str], brand: Optional[str],
+                    console: Optional[str], condition: Optional[str]) -> dict:
+    """Equality filters shared by the product listing and the facets."""
+    filters = {
+        "category": category if category != "all" else None,
+        "brand": brand,
+        "console": console,
+        "condition": condition,
+    }
+    return {field: value for field, value in filters.items() if value}
+
+
+def parse_sort(sort: Optional[str], search: Optional[str]) -> Optional[str]:
+    """The listing order; None keeps searches in relevance order."""
+    if sort is None:
+        return None if search else "newest"
+    if sort not in LISTING_SORTS:
+        raise HTTPException(status_code=400, detail=f"sort must be one of: {', '.join(LISTING_SORTS)}")
+    if search:
+        raise HTTPException(status_code=400, detail="sort cannot be combined with search")
+    return sort
+
+
 @app.get("/api/products")
-async def get_products(category: Optional[str] = None, search: Optional[str] = None):
+async def get_products(request: Request, category: Optional[str] = None, search: Optional[str] = None,
+                       limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                       cursor: Optional[str] = None, fields: Optional[str] = None,
+                       brand: Optional[str] = None, console: Optional[str] = None,
+                       condition: Optional[str] = None, stream: bool = False,
+                       min_price: Optional[float] = Query(None, ge=0),
+                       max_price: Optional[float] = Query(None, ge=0),
+                       sort: Optional[str] = None):
     try:
-        query = {}
-        
-        if category and category != "all":
-            query["category"] = category
-            
-        if search:
-            query["$or"] = [
-                {"name": {"$regex": search, "$options": "i"}},
-                {"description": {"$regex": search, "$options": "i"}},
-                {"brand": {"$regex": search, "$options": "i"}}
-            ]
-        
-        products = list(products_collection.find(query, {"_id": 0}).sort("created_at", -1))
-        return {"products": products}
+        filters = product_filters(category, brand, console, condition)
+        if min_price is not None and max_price is not None and min_price > max_price:
+            raise HTTPException(status_code=400, detail="min_price cannot exceed max_price")
+        query = {**filters, **price_range(min_price, max_price)}
+        search = search.strip() if search else None
+        sort = parse_sort(sort, search)
+        field_list = parse_fields(fields)
+        if stream:
+            if search:
+                raise HTTPException(status_code=400, detail="stream cannot be combined with search")
+            return StreamingResponse(stream_products(query, field_list, sort), media_type="application/json")
+        position = parse_cursor(cursor, sort)
+        key = ("products", tuple(sorted(filters.items())), min_price, max_price, sort, search, limit, cursor,
+               tuple(field_list) if field_list else None)
+        return await cached_json(
+            request, key, lambda shown: load_products(query, search, limit, position, field_list, sort, shown))
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/api/products/{product_id}")
-async def get_product(product_id: str):
+
+async def load_products(query: dict, search: Optional[str], limit: int, position: dict,
+                        field_list: Optional[List[str]], sort: Optional[str], shown: Set[str]) -> bytes:
+    version = encoded_products.version
+    next_position = None
+
+    if search:
+        # Search results are ranked, so their cursor is an offset into the ranking
+        offset = position.get("offset", 0)
+        if search_index.ready:
+            filters = {field: value for field, value in query.items() if field != "price"}
+            bounds = query.get("price", {})
+            # Rank one past the page, so a further match means a next page
+            ids = search_index.search(search, filters, offset + limit + 1, bounds.get("$gte"), bounds.get("$lte"))
+            products = await products_repo.find_ranked(ids[offset:offset + limit], query, field_list)
+            if not field_list or "stock" in field_list:
+                shown.update(ids[offset:offset + limit])
+            has_more = len(ids) > offset + limit
+        else:
+            products = await products_repo.text_search(search, query, offset, limit + 1, field_list)
+            has_more = len(products) > limit
+            products = products[:limit]
+        if has_more:
+            next_position = {"offset": offset + limit}
+    else:
+        products, next_position = await products_repo.page(query, limit, position or None, field_list,
+                                                           LISTING_SORTS[sort])
+    show_stock(shown, products, field_list)
+
+    next_cursor = encode_cursor(next_position) if next_position else None
+    with span("serialize"):
+        if field_list:
+            return dumps({"products": products, "next_cursor": next_cursor})
+        return encoded_products.page(products, next_cursor, version)
+
+def stream_products(query: dict, field_list: Optional[List[str]], sort: str):
+    """Every product matching query, in the given order, encoded batch by batch.
+
+    Neither the time to the first byte nor memory grows with the catalog,
+    unlike a page materialized in full.
+    """
+    version = encoded_products.version
+    products = products_repo.iter_all(projection(field_list), STREAM_BATCH_SIZE, query, LISTING_SORTS[sort])
+    if field_list:
+        return stream_page(products, dumps, STREAM_BATCH_SIZE)
+    return stream_page(products, lambda product: encoded_products.encode(product, version), STREAM_BATCH_SIZE)
+
+def bulk_format(request: Request, format: Optional[str]) -> str:
+    if format is None:
+        format = "csv" if "csv" in request.headers.get("content-type", "") else "ndjson"
+    if format not in BULK_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="format must be ndjson or csv")
+    return format
+
+@app.post("/api/products/bulk")
+async def bulk_import_products(request: Request, format: Optional[str] = None):
+    fmt = bulk_format(request, format)
     try:
-        product = products_collection.find_one({"id": product_id}, {"_id": 0})
+        parser = parse_csv if fmt == "csv" else parse_ndjson
+        report = ImportReport(BULK_MAX_REPORTED_ERRORS)
+        started = time.perf_counter()
+        await import_rows(parser(request.stream()), products_repo.bulk_upsert, BULK_BATCH_SIZE, report)
+        return report.as_dict(time.perf_counter() - started)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/products/export")
+async def export_products(request: Request, format: Optional[str] = "ndjson", category: Optional[str] = None):
+    fmt = bulk_format(request, format)
+    query = {"category": category} if category and category != "all" else {}
+    products = products_repo.iter_all(batch_size=BULK_BATCH_SIZE, query=query)
+    return StreamingResponse(
+        export_batches(products, fmt, BULK_BATCH_SIZE),
+        media_type=BULK_MEDIA_TYPES[fmt],
+        headers={"Content-Disposition": f'attachment; filename="products.{fmt}"'},
+    )
+
+@app.get("/api/products:batch")
+async def get_products_batch(ids: List[str] = Query([])):
+    """Products for up to BATCH_MAX_IDS ids, in request order.
+
+    Ids may be repeated (?ids=a&ids=b) or comma separated. Each position of
+    "products" holds the product or null, and "missing" lists unknown ids.
+    """
+    requested = [product_id.strip() for value in ids for product_id in value.split(",") if product_id.strip()]
+    if not requested:
+        raise HTTPException(status_code=400, detail="ids is required")
+    if len(requested) > BATCH_MAX_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_IDS} ids per request")
+    try:
+        # Products already encoded need no query
+        version = encoded_products.version
+        encoded = {product_id: encoded_products.cached(product_id) for product_id in requested}
+        loaded = await product_loader.load_many(
+            product_id for product_id, body in encoded.items() if body is None
+        )
+        missing = []
+        with span("serialize"):
+            for product_id, product in loaded.items():
+                if product is None:
+                    missing.append(product_id)
+                else:
+                    encoded[product_id] = encoded_products.encode(product, version)
+            body = b"".join((
+                b'{"products":[',
+                b",".join(encoded[product_id] or b"null" for product_id in requested),
+                b'],"missing":',
+                dumps(missing),
+                b"}",
+            ))
+        return Response(body, media_type="application/json")
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/products/{product_id}")
+async def get_product(request: Request, product_id: str):
+    async def load_product(shown: Set[str]):
+        shown.add(product_id)
+        version = encoded_products.version
+        product = await products_repo.get(product_id)
         if not product:
             raise HTTPException(status_code=404, detail="Product not found")
-        return product
+        return encoded_products.encode(product, version)
+
+    try:
+        return await cached_json(request, ("product", product_id), load_product)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/products/{product_id}/related")
+async def get_related_products(request: Request, product_id: str, limit: Optional[int] = None):
+    """Up to limit (default RELATED_K) products most similar to one, best first."""
+    limit = RELATED_K if limit is None else limit
+    if not 1 <= limit <= RELATED_K:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {RELATED_K}")
+
+    async def load_related(shown: Set[str]):
+        version = encoded_products.version
+        related = related_index.related(product_id, limit) if related_index.ready else None
+        if related is None:
+            # Index still building: newest products of the same category
+            product = await products_repo.get(product_id)
+            if not product:
+                raise HTTPException(status_code=404, detail="Product not found")
+            query = {"category": product.get("category"), "id": {"$ne": product_id}}
+            products, _ = await products_repo.page(query, limit)
+            show_stock(shown, products, None)
+            return b'{"products":[' + b",".join(encoded_products.encode(item, version) for item in products) + b"]}"
+        encoded = {related_id: encoded_products.cached(related_id) for related_id, _ in related}
+        shown.update(encoded)
+        loaded = await product_loader.load_many(related_id for related_id, body in encoded.items() if body is None)
+        for related_id, product in loaded.items():
+            if product is not None:
+                encoded[related_id] = encoded_products.encode(product, version)
+        return b'{"products":[' + b",".join(body for body in encoded.values() if body is not None) + b"]}"
+
+    try:
+        return await cached_json(request, ("related", product_id, limit), load_related)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.put("/api/products/{product_id}/image")
+async def upload_product_image(request: Request, product_id: str):
+    """Replace a product's image with the request body, e.g. a JPEG; returns the product with its variants."""
+    if not image_store.enabled:
+        raise HTTPException(status_code=501, detail="Image processing is not available")
+    data = bytearray()
+    async for chunk in request.stream():
+        data += chunk
+        if len(data) > IMAGE_MAX_SOURCE_BYTES:
+            raise HTTPException(status_code=413, detail=f"Images are limited to {IMAGE_MAX_SOURCE_BYTES} bytes")
+    try:
+        product = await product_images.upload(product_id, bytes(data))
+    except ImageError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    if product is None:
+        raise HTTPException(status_code=404, detail="Product not found")
+    return product
+
+@app.get("/api/images/{key}/{variant}")
+async def get_image(request: Request, key: str, variant: str):
+    """A resized product image, e.g. /api/images/<key>/320.webp; URLs never change content."""
+    match = VARIANT_RE.match(variant)
+    if (not KEY_RE.match(key) or match is None or int(match[1]) not in image_store.widths
+            or match[2] not in image_store.formats):
+        raise HTTPException(status_code=404, detail="Image not found")
+    # Content-addressed: the URL identifies the bytes
+    headers = {"ETag": f'"{key[:16]}-{variant}"', "Cache-Control": IMAGE_CACHE_CONTROL}
+    if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    try:
+        data = await image_store.read(key, int(match[1]), match[2])
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if data is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    return Response(data, media_type=MEDIA_TYPES[match[2]], headers=headers)
 
 @app.get("/api/categories")
-async def get_categories():
+async def get_categories(request: Request):
+    async def load_categories(shown: Set[str]):
+        if facet_summary.ready:
+            return {"categories": facet_summary.categories()}
+        return {"categories": await products_repo.categories()}
+
     try:
-        categories = products_collection.distinct("category")
-        return {"categories": categories}
+        return await cached_json(request, ("categories",), load_categories)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/facets")
+async def get_facets(request: Request, category: Optional[str] = None, search: Optional[str] = None,
+                     brand: Optional[str] = None, console: Optional[str] = None,
+                     condition: Optional[str] = None):
+    try:
+        query = product_filters(category, brand, console, condition)
+        search = search.strip() if search else None
+        key = ("facets", tuple(sorted(query.items())), search)
+        return await cached_json(request, key, lambda shown: load_facets(query, search))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+async def load_facets(query: dict, search: Optional[str]) -> dict:
+    """Counts per category, brand, console, condition and price bucket."""
+    if not query and not search and facet_summary.ready:
+        return facet_summary.as_dict()
+    if search and search_index.ready:
+        # Count over the same ranked result set the listing pages through
+        # Facets count every match, not only a first page of them
+        query = {"id": {"$in": search_index.search(search, query, len(search_index))}}
+    elif search:
+        query = {**query, "$text": {"$search": search}}
+    return format_aggregation(await products_repo.facets(query))
+
 # Cart endpoints
+def cart_session(request: Request, response: Response) -> str:
+    """The caller's cart id, issuing a new one when none or a malformed one is sent."""
+    cart_id = request.headers.get(CART_HEADER) or request.cookies.get(CART_COOKIE)
+    if not cart_id or not CART_ID_RE.match(cart_id):
+        cart_id = uuid.uuid4().hex
+    response.headers[CART_HEADER] = cart_id
+    response.set_cookie(CART_COOKIE, cart_id, max_age=CART_TTL_SECONDS, httponly=True, samesite="lax")
+    return cart_id
+
 @app.post("/api/cart/add")
-async def add_to_cart(product_id: str, quantity: int = 1):
+async def add_to_cart(product_id: str, quantity: int = Query(1, ge=1),
+                      cart_id: str = Depends(cart_session)):
     try:
-        # Check if product exists
-        product = products_collection.find_one({"id": product_id}, {"_id": 0})
-        if not product:
-            raise HTTPException(status_code=404, detail="Product not found")
-        
-        # Check if item already in cart
-        existing_item = cart_collection.find_one({"product_id": product_id})
-        
-        if existing_item:
-            # Update quantity
-            new_quantity = existing_item["quantity"] + quantity
-            cart_collection.update_one(
-                {"product_id": product_id},
-                {"$set": {"quantity": new_quantity}}
-            )
-        else:
-            # Add new item
-            cart_item = {
-                "id": str(uuid.uuid4()),
-                "product_id": product_id,
-                "quantity": quantity,
-                "added_at": datetime.now().isoformat()
-            }
-            cart_collection.insert_one(cart_item)
-        
+        # Hold the stock first; the conditional $inc cannot oversell
+        if not await reservations.reserve(cart_id, product_id, quantity):
+            if await products_repo.get_stock(product_id) is None:
+                raise HTTPException(status_code=404, detail="Product not found")
+            raise HTTPException(status_code=409, detail="Not enough stock")
+
+        # Insert or increment the cart line in one atomic write
+        try:
+            await cart_repo.add(cart_id, product_id, quantity)
+        except Exception:
+            await reservations.release(cart_id, product_id, quantity, reason="rollback")
+            raise
+
         return {"message": "Product added to cart successfully"}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/api/cart")
-async def get_cart():
+@app.get("/api/cart", response_model=CartView)
+async def get_cart(cart_id: str = Depends(cart_session)):
     try:
-        cart_items = list(cart_collection.find({}, {"_id": 0}))
-        
-        # Get product details for each cart item
-        cart_with_products = []
-        for item in cart_items:
-            product = products_collection.find_one({"id": item["product_id"]}, {"_id": 0})
-            if product:
-                cart_with_products.append({
-                    **item,
-                    "product": product
-                })
-        
-        total = sum(item["product"]["price"] * item["quantity"] for item in cart_with_products)
-        
-        return {
-            "items": cart_with_products,
-            "total": round(total, 2),
-            "count": len(cart_with_products)
-        }
+        return await cart_repo.view(cart_id, products_repo.collection.name)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/cart/reserve")
+async def reserve_cart(cart_id: str = Depends(cart_session)):
+    """Hold stock for every line of the cart, all or nothing, e.g. before checkout."""
+    try:
+        quantities = {line["product_id"]: line["quantity"] for line in await cart_repo.lines(cart_id)}
+        reserved, unavailable = await reservations.reserve_cart(cart_id, quantities)
+        if not reserved:
+            raise HTTPException(status_code=409, detail={"message": "Not enough stock", "unavailable": unavailable})
+        return {"reserved": quantities, "ttl_seconds": RESERVATION_TTL_SECONDS}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/checkout", response_model=Order)
+async def checkout(body: CheckoutIn, cart_id: str = Depends(cart_session)):
+    """Turn the whole cart into an order; its emails, invoice and analytics follow in the background."""
+    if job_queue.saturated():
+        raise HTTPException(status_code=503, detail="Checkout is busy, retry shortly", headers={"Retry-After": "5"})
+    try:
+        order = await orders_repo.checkout(cart_id, body.model_dump())
+        order["created_at"] = order["created_at"].isoformat()
+        return order
+    except EmptyCart:
+        raise HTTPException(status_code=400, detail="Cart is empty")
+    except OutOfStock as e:
+        raise HTTPException(status_code=409, detail={"message": "Not enough stock", "unavailable": e.unavailable})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/orders/{order_id}", response_model=Order)
+async def get_order(order_id: str):
+    try:
+        order = await orders_repo.get(order_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if order is None:
+        raise HTTPException(status_code=404, detail="Order not found")
+    order["created_at"] = order["created_at"].isoformat()
+    return order
+
+@app.get("/api/orders/{order_id}/invoice")
+async def get_order_invoice(order_id: str):
+    try:
+        pdf = await orders_repo.invoice(order_id)
+        if pdf is None:
+            if await orders_repo.get(order_id) is None:
+                raise HTTPException(status_code=404, detail="Order not found")
+            # Rendered by a background job shortly after checkout
+            raise HTTPException(status_code=404, detail="Invoice not ready yet", headers={"Retry-After": "2"})
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return Response(pdf, media_type="application/pdf",
+                    headers={"Content-Disposition": f'inline; filename="facture-{order_id}.pdf"'})
+
+def analytics_snapshot():
+    if analytics.snapshot is None:
+        raise HTTPException(status_code=503, detail="Analytics snapshot not taken yet", headers={"Retry-After": "10"})
+    return analytics.snapshot
+
+@app.get("/api/analytics/stock-value")
+async def get_stock_value():
+    """Units and value of stock per category, as of the last snapshot."""
+    snapshot = analytics_snapshot()
+    return {"snapshot": snapshot.info(), **snapshot.stock_value()}
+
+@app.get("/api/analytics/price-distribution")
+async def get_price_distribution(bins: int = Query(20, ge=1, le=200), category: Optional[str] = None):
+    """Price quartiles and a histogram per condition, optionally within one category."""
+    snapshot = analytics_snapshot()
+    distribution = snapshot.price_distribution(bins, category)
+    if distribution is None:
+        raise HTTPException(status_code=404, detail="Category not found")
+    return {"snapshot": snapshot.info(), **distribution}
+
+@app.get("/api/analytics/cart-conversion")
+async def get_cart_conversion(days: int = Query(30, ge=1, le=ANALYTICS_MAX_DAYS)):
+    """Share of recently active carts that became orders, with units carted and sold per category."""
+    snapshot = analytics_snapshot()
+    return {"snapshot": snapshot.info(), **snapshot.cart_conversion(days)}
+
 @app.delete("/api/cart/{item_id}")
-async def remove_from_cart(item_id: str):
+async def remove_from_cart(item_id: str, cart_id: str = Depends(cart_session)):
     try:
-        result = cart_collection.delete_one({"id": item_id})
-        if result.deleted_count == 0:
+        line = await cart_repo.remove(cart_id, item_id)
+        if line is None:
             raise HTTPException(status_code=404, detail="Cart item not found")
+        await reservations.release(cart_id, line["product_id"])
         return {"message": "Item removed from cart"}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.put("/api/cart/{item_id}")
-async def update_cart_quantity(item_id: str, quantity: int):
+async def update_cart_quantity(item_id: str, quantity: int, cart_id: str = Depends(cart_session)):
     try:
         if quantity <= 0:
             # Remove item if quantity is 0 or negative
-            return await remove_from_cart(item_id)
-        
-        result = cart_collection.update_one(
-            {"id": item_id},
-            {"$set": {"quantity": quantity}}
-        )
+            return await remove_from_cart(item_id, cart_id)
         
-        if result.matched_count == 0:
+        line = await cart_repo.get_line(cart_id, item_id)
+        if line is None:
             raise HTTPException(status_code=404, detail="Cart item not found")
-        
+
+        # Hold or return the difference before changing the line
+        delta = quantity - line["quantity"]
+        if delta > 0 and not await reservations.reserve(cart_id, line["product_id"], delta):
+            raise HTTPException(status_code=409, detail="Not enough stock")
+        if not await cart_repo.set_quantity(cart_id, item_id, quantity):
+            if delta > 0:
+                await reservations.release(cart_id, line["product_id"], delta, reason="rollback")
+            raise HTTPException(status_code=404, detail="Cart item not found")
+        if delta < 0:
+            await reservations.release(cart_id, line["product_id"], -delta)
+
         return {"message": "Cart updated successfully"}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/health/live")
+async def liveness():
+    return {"status": "ok"}
+
+@app.get("/api/health/ready")
+async def readiness(response: Response):
+    """Ready once Mongo answers and the unique indexes are built; other index builds do not hold traffic."""
+    status = {
+        "bootstrap": bootstrapper.status(),
+        "catalog_views": {"search_index": search_index.ready, "facets": facet_summary.ready},
+    }
+    try:
+        await db.command("ping")
+        status["database"] = "ok"
+    except Exception as e:
+        status["database"] = f"unreachable: {e}"
+    status["ready"] = (status["database"] == "ok" and bootstrapper.error is None
+                       and bootstrapper.unique_indexes_ready())
+    if not status["ready"]:
+        response.status_code = 503
+    return status
+
+@app.get("/api/live")
+async def live_updates(cart_id: Optional[str] = None):
+    """Server-sent events with catalog deltas and, given a cart_id, its line changes.
+
+    Events: product ({id, changes} or {id, product}), product_removed,
+    cart (a snapshot of the lines, sent first), cart_line, cart_line_removed
+    and resync, after which the client should refetch what it shows.
+    EventSource cannot send headers, so the cart id comes in the query.
+    """
+    if cart_id is not None and not CART_ID_RE.match(cart_id):
+        raise HTTPException(status_code=400, detail="Invalid cart_id")
+    # Subscribe before reading the snapshot so no change falls in between;
+    # line events carry absolute quantities, so replaying one is harmless
+    subscription = live_hub.subscribe(cart_id)
+    snapshot = None
+    try:
+        if cart_id is not None:
+            lines = await cart_repo.lines(cart_id)
+            live_hub.track_lines(cart_id, lines)
+            snapshot = sse_frame("cart", {"items": [compact_line(line) for line in lines]})
+    except Exception as e:
+        live_hub.unsubscribe(subscription)
+        raise HTTPException(status_code=500, detail=str(e))
+    return StreamingResponse(
+        live_hub.stream(subscription, snapshot, LIVE_HEARTBEAT_SECONDS),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/api/cache/stats")
+async def get_cache_stats():
+    return {
+        "catalog": catalog_cache.stats(),
+        "encoded_products": encoded_products.stats(),
+        "product_loader": product_loader.stats(),
+        "worker_sync": worker_sync.stats() if worker_sync is not None else None,
+        "live": live_hub.stats(),
+        "related": related_index.stats(),
+        "jobs": job_queue.stats(),
+        "analytics": analytics.stats(),
+        "images": {**image_store.stats(), "jobs": image_jobs.stats()},
+    }
+
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
+    # An import string lets uvicorn start each worker with its own app and client
+    uvicorn.run("server:app", host="0.0.0.0", port=8001, workers=WEB_CONCURRENCY)
\ No newline at end of file
@@ -0,0 +1,866 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+import requests
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+# Defaults to a locally running backend; point at a preview URL with BACKEND_URL
+BACKEND_URL = os.environ.get("BACKEND_URL", "http://localhost:8001")
+API_URL = f"{BACKEND_URL}/api"
+
+# Direct database access, used to seed fixtures and read server op counters
+MONGO_URL = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
+DB_NAME = os.environ.get("DB_NAME", "test_database")
+
+BACKEND_DIR = Path(__file__).parent / "backend"
+
+SEARCH_TERMS = ["PlayStation", "Xbox", "Gaming", "Manette", "Souris"]
+CATEGORIES = ["consoles", "manettes", "casques", "claviers", "souris", "jeux"]
+
+# Vocabulary for synthetic products in the in-process mode
+BRANDS = ["Sony", "Microsoft", "Nintendo", "Logitech", "Razer", "SteelSeries", "Corsair", "HyperX"]
+CONSOLES = ["PlayStation 5", "PlayStation 4", "Xbox Series X", "Xbox One", "Nintendo Switch", None]
+CONDITIONS = ["Comme neuf", "Très bon état", "Bon état", "État correct"]
+NOUNS = {
+    "consoles": "Console",
+    "manettes": "Manette",
+    "casques": "Casque Gaming",
+    "claviers": "Clavier mécanique",
+    "souris": "Souris Gaming",
+    "jeux": "Jeu",
+}
+
+# Per-route metrics compared by the regression gate; higher is worse for all
+GATED_METRICS = ("p95_ms", "p99_ms", "mongo_ops_per_request")
+
+SERVER_TIMING_OPS = re.compile(r'mongo;[^,]*desc="(\d+) ops"')
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of latencies."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize(samples, ops=None):
+    summary = {
+        "requests": len(samples),
+        "p50_ms": round(percentile(samples, 50), 2),
+        "p95_ms": round(percentile(samples, 95), 2),
+        "p99_ms": round(percentile(samples, 99), 2),
+        "mean_ms": round(statistics.mean(samples), 2) if samples else 0.0,
+    }
+    if ops:
+        summary["mongo_ops_per_request"] = round(statistics.mean(ops), 2)
+    return summary
+
+
+def mongo_ops_from_headers(headers):
+    """Mongo round-trips reported by the Server-Timing header, if any."""
+    match = SERVER_TIMING_OPS.search(headers.get("server-timing", ""))
+    return int(match.group(1)) if match else None
+
+
+class MixedWorkload:
+    """Mixed catalog and cart traffic, weighted towards catalog reads.
+
+    Operations describe a request as (method, path under /api, params) so
+    the same mix drives both a remote server and the in-process app.
+    """
+
+    def __init__(self, product_ids):
+        self.product_ids = product_ids
+
+    def browse(self):
+        category = random.choice(CATEGORIES + ["all"])
+        return "GET", "/products", {"category": category}
+
+    def search(self):
+        return "GET", "/products", {"search": random.choice(SEARCH_TERMS)}
+
+    def product(self):
+        return "GET", f"/products/{random.choice(self.product_ids)}", None
+
+    def categories(self):
+        return "GET", "/categories", None
+
+    def add_to_cart(self):
+        return "POST", "/cart/add", {"product_id": random.choice(self.product_ids), "quantity": 1}
+
+    def view_cart(self):
+        return "GET", "/cart", None
+
+    def operations(self):
+        return [
+            ("browse", self.browse, 35),
+            ("search", self.search, 20),
+            ("product", self.product, 15),
+            ("categories", self.categories, 5),
+            ("add_to_cart", self.add_to_cart, 10),
+            ("view_cart", self.view_cart, 15),
+        ]
+
+    def next_request(self):
+        operations = self.operations()
+        name, operation, _ = random.choices(operations, weights=[op[2] for op in operations])[0]
+        return (name,) + operation()
+
+
+# Admission control turning a request away; counted apart from errors and
+# kept out of the latencies, which they would flatter
+REJECTED_STATUSES = (429, 503)
+
+
+class Recorder:
+    """Latencies, Mongo round-trips, errors and rejections per operation."""
+
+    def __init__(self, count_ops=True):
+        self.count_ops = count_ops
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.ops = {}
+        self.errors = {}
+        self.rejected = {}
+
+    def record(self, name, elapsed_ms, status_code, headers):
+        ops = mongo_ops_from_headers(headers) if self.count_ops else None
+        with self.lock:
+            if status_code in REJECTED_STATUSES:
+                self.rejected[name] = self.rejected.get(name, 0) + 1
+                return
+            self.latencies.setdefault(name, []).append(elapsed_ms)
+            if ops is not None:
+                self.ops.setdefault(name, []).append(ops)
+            if status_code >= 400:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def result(self, concurrency, duration, **extra):
+        everything = [sample for samples in self.latencies.values() for sample in samples]
+        all_ops = [count for counts in self.ops.values() for count in counts]
+        return {
+            "workload": "mixed",
+            **extra,
+            "concurrency": concurrency,
+            "duration_s": round(duration, 2),
+            "rps": round(len(everything) / duration, 1),
+            "overall": summarize(everything, all_ops),
+            "routes": {
+                name: summarize(samples, self.ops.get(name))
+                for name, samples in sorted(self.latencies.items())
+            },
+            "errors": self.errors,
+            "rejected": self.rejected,
+        }
+
+
+def run_mixed(concurrency, total_requests):
+    """Fire total_requests weighted operations from concurrency threads."""
+    products = requests.get(f"{API_URL}/products").json()["products"]
+    product_ids = [product["id"] for product in products]
+    if not product_ids:
+        sys.exit("No products available to benchmark against")
+
+    local = threading.local()
+    recorder = Recorder()
+
+    def worker(_):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+            local.session.headers["X-Cart-Id"] = f"bench-{uuid.uuid4()}"
+            local.workload = MixedWorkload(product_ids)
+        name, method, path, params = local.workload.next_request()
+        start = time.perf_counter()
+        response = local.session.request(method, f"{API_URL}{path}", params=params)
+        elapsed = (time.perf_counter() - start) * 1000
+        recorder.record(name, elapsed, response.status_code, response.headers)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(total_requests)))
+    return recorder.result(concurrency, time.perf_counter() - started, target=API_URL)
+
+
+def synthetic_products(count, create_product):
+    """Catalog of count products built with the app's own create_product."""
+    products = []
+    for i in range(count):
+        category = CATEGORIES[i % len(CATEGORIES)]
+        brand = random.choice(BRANDS)
+        console = random.choice(CONSOLES)
+        products.append(create_product(
+            f"{NOUNS[category]} {brand} {console or 'PC'} #{i}",
+            category,
+            round(random.uniform(5, 600), 2),
+            f"{NOUNS[category]} {brand} compatible {console or 'PC'}, testé et garanti.",
+            f"https://example.com/images/{i}.jpg",
+            condition=random.choice(CONDITIONS),
+            console=console,
+            brand=brand,
+            stock=1000,
+        ))
+    return products
+
+
+def mongod_available(url):
+    try:
+        MongoClient(url, serverSelectionTimeoutMS=500).admin.command("ping")
+        return True
+    except PyMongoError:
+        return False
+
+
+def load_app(mongo):
+    """Import the backend against a scratch database on mongod or mongomock.
+
+    The server reads its settings and binds the Mongo client class at import
+    time, so the stand-in and the database name are set up before the import.
+    """
+    if mongo == "auto":
+        mongo = "mongod" if mongod_available(MONGO_URL) else "mongomock"
+    os.environ["MONGO_URL"] = MONGO_URL
+    os.environ["DB_NAME"] = f"bench_{uuid.uuid4().hex[:12]}"
+    # One benchmark client stands in for many users
+    os.environ.setdefault("RATE_LIMIT_READ_PER_SECOND", "0")
+    os.environ.setdefault("RATE_LIMIT_WRITE_PER_SECOND", "0")
+    if mongo == "mongomock":
+        import mongomock_motor
+        import motor.motor_asyncio
+        motor.motor_asyncio.AsyncIOMotorClient = lambda *args, **kwargs: mongomock_motor.AsyncMongoMockClient()
+    sys.path.insert(0, str(BACKEND_DIR))
+    import server
+    return server, mongo
+
+
+async def run_in_process(concurrency, total_requests, product_count, mongo):
+    """Run the mixed workload against the app in this process over ASGI.
+
+    No network or running server is needed. Mongo round-trips per request
+    come from the Server-Timing header, which needs a real mongod: pymongo
+    command events are not emitted by mongomock.
+    """
+    import httpx
+
+    server, mongo = load_app(mongo)
+    await server.app.router.startup()
+    try:
+        await server.products_repo.insert_many(synthetic_products(product_count, server.create_product))
+        while not server.facet_summary.ready:
+            await asyncio.sleep(0.05)
+        product_ids = [product["id"] async for product in server.products_repo.iter_all({"id": 1})]
+
+        # mongomock emits no command events, so its "0 ops" would be misleading
+        recorder = Recorder(count_ops=mongo == "mongod")
+        remaining = iter(range(total_requests))
+        transport = httpx.ASGITransport(app=server.app)
+
+        async def worker():
+            workload = MixedWorkload(product_ids)
+            async with httpx.AsyncClient(
+                transport=transport,
+                base_url="http://bench/api",
+                headers={"X-Cart-Id": f"bench-{uuid.uuid4()}"},
+            ) as client:
+                for _ in remaining:
+                    name, method, path, params = workload.next_request()
+                    start = time.perf_counter()
+                    response = await client.request(method, path, params=params)
+                    elapsed = (time.perf_counter() - start) * 1000
+                    recorder.record(name, elapsed, response.status_code, response.headers)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        duration = time.perf_counter() - started
+    finally:
+        await server.app.router.shutdown()
+        if mongo == "mongod":
+            await server.client.drop_database(server.db.name)
+    return recorder.result(concurrency, duration, target="in-process", mongo=mongo, products=product_count)
+
+
+def time_per_call(function, repeats):
+    """Best-of-repeats wall time of one call, in milliseconds."""
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def run_encode(product_count, repeats):
+    """Time encoding a listing page of product_count products, per 1k products.
+
+    Compares FastAPI's default path (jsonable_encoder then json.dumps), the
+    previous json.dumps path, orjson, and joining pre-encoded product bytes.
+    """
+    from fastapi.encoders import jsonable_encoder
+
+    sys.path.insert(0, str(BACKEND_DIR))
+    from encoding import EncodedProducts, dumps
+    from server import create_product
+
+    products = synthetic_products(product_count, create_product)
+    page = {"products": products, "next_cursor": None}
+    encoded = EncodedProducts()
+    encoded.page(products, None, encoded.version)
+
+    def stdlib():
+        return json.dumps(page, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    encoders = {
+        "jsonable_encoder+json": lambda: json.dumps(jsonable_encoder(page)).encode("utf-8"),
+        "json.dumps": stdlib,
+        "orjson": lambda: dumps(page),
+        "pre-encoded": lambda: encoded.page(products, None, encoded.version),
+    }
+    assert json.loads(encoders["pre-encoded"]()) == json.loads(stdlib())
+    scale = 1000 / product_count
+    timings = {
+        name: round(time_per_call(encode, repeats) * scale, 3)
+        for name, encode in encoders.items()
+    }
+    for name, ms in timings.items():
+        print(f"{name:<24}{ms:>10.3f} ms per 1k products")
+    return {"workload": "encode", "products": product_count, "repeats": repeats, "ms_per_1k_products": timings}
+
+
+async def asgi_get(app, path, query="", headers=()):
+    """GET through the ASGI app, timing the first body bytes without keeping the body."""
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": "GET", "scheme": "http", "path": path, "raw_path": path.encode(),
+        "query_string": query.encode(), "root_path": "", "client": ("127.0.0.1", 0),
+        "server": ("bench", 80), "headers": [(b"host", b"bench"), *headers],
+    }
+    timing = {"bytes": 0, "chunks": 0}
+    started = time.perf_counter()
+    requested = False
+
+    async def receive():
+        # One empty request body, then a client that never disconnects
+        nonlocal requested
+        if requested:
+            await asyncio.Event().wait()
+        requested = True
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            timing["status"] = message["status"]
+        elif message["type"] == "http.response.body" and message.get("body"):
+            elapsed = (time.perf_counter() - started) * 1000
+            timing.setdefault("ttfb_ms", elapsed)
+            # The first chunk of a stream is only the opening of the JSON document
+            if timing["chunks"] == 1 or not message.get("more_body"):
+                timing.setdefault("first_products_ms", elapsed)
+            timing["chunks"] += 1
+            timing["bytes"] += len(message["body"])
+
+    await app(scope, receive, send)
+    timing["total_ms"] = (time.perf_counter() - started) * 1000
+    return timing
+
+
+async def measure(request):
+    """Timings of one request, then its peak traced memory from a second run."""
+    timing = await request()
+    tracemalloc.start()
+    try:
+        await request()
+        timing["peak_memory_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+    return {name: round(value, 2) if isinstance(value, float) else value for name, value in timing.items()}
+
+
+async def run_stream(sizes, mongo):
+    """Time to first byte and peak memory of a full-catalog listing as the catalog grows.
+
+    Compares the streamed listing (?stream=true), the same stream
+    gzip-compressed, and a listing materialized in full before encoding.
+    Figures are only representative on mongod: mongomock sorts and copies
+    the whole result in memory before its cursor yields anything.
+    """
+    server, mongo = load_app(mongo)
+    await server.app.router.startup()
+    steps = []
+    try:
+        seeded = 0
+        for size in sizes:
+            while seeded < size:
+                batch = min(size - seeded, 10_000)
+                await server.products_repo.insert_many(synthetic_products(batch, server.create_product))
+                seeded += batch
+
+            async def materialized():
+                started = time.perf_counter()
+                products = [product async for product in server.products_repo.iter_all(sort=server.LISTING_SORTS["newest"])]
+                body = server.dumps({"products": products, "next_cursor": None})
+                elapsed = (time.perf_counter() - started) * 1000
+                return {"ttfb_ms": elapsed, "total_ms": elapsed, "bytes": len(body)}
+
+            step = {
+                "products": size,
+                "stream": await measure(lambda: asgi_get(server.app, "/api/products", "stream=true")),
+                "stream_gzip": await measure(lambda: asgi_get(
+                    server.app, "/api/products", "stream=true", [(b"accept-encoding", b"gzip")])),
+                "materialized": await measure(materialized),
+            }
+            steps.append(step)
+            print(f"{size:>7} products: stream ttfb {step['stream']['ttfb_ms']:.1f} ms, "
+                  f"first products {step['stream']['first_products_ms']:.1f} ms, "
+                  f"peak {step['stream']['peak_memory_mb']:.1f} MB; materialized "
+                  f"{step['materialized']['ttfb_ms']:.1f} ms, peak {step['materialized']['peak_memory_mb']:.1f} MB")
+    finally:
+        await server.app.router.shutdown()
+        if mongo == "mongod":
+            await server.client.drop_database(server.db.name)
+    return {"workload": "stream", "mongo": mongo, "steps": steps}
+
+
+async def run_live(connection_counts, events):
+    """Fan-out cost of /api/live: publish time and delivery delay as connections grow.
+
+    Each connection is a consumer draining the same SSE generator the
+    endpoint returns; events carry their publish time, and are spaced so
+    every consumer can keep up, as with real clients between writes.
+    """
+    sys.path.insert(0, str(BACKEND_DIR))
+    from live import LiveHub
+
+    steps = []
+    for count in connection_counts:
+        hub = LiveHub()
+        delays = []
+
+        async def consume(subscription):
+            async for frame in hub.stream(subscription, None, heartbeat=60):
+                if frame.startswith(b"event: product"):
+                    published = json.loads(frame.split(b"data: ", 1)[1])["changes"]["published"]
+                    delays.append((time.perf_counter() - published) * 1000)
+
+        tracemalloc.start()
+        subscriptions = [hub.subscribe() for _ in range(count)]
+        consumers = [asyncio.create_task(consume(subscription)) for subscription in subscriptions]
+        await asyncio.sleep(0)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        publish_ms = []
+        for i in range(events):
+            started = time.perf_counter()
+            hub.publish("product", {"id": f"product-{i}", "changes": {"stock": i, "published": started}})
+            publish_ms.append((time.perf_counter() - started) * 1000)
+            # Let every consumer drain before the next write
+            while len(delays) < (i + 1) * count:
+                await asyncio.sleep(0)
+        hub.close()
+        await asyncio.gather(*consumers)
+
+        step = {
+            "connections": count,
+            "publish_ms": summarize(publish_ms),
+            "delivery_ms": summarize(delays),
+            "memory_per_connection_kb": round(memory / count / 1024, 2),
+            "dropped": hub.dropped,
+        }
+        steps.append(step)
+        print(f"{count:>7} connections: publish p50 {step['publish_ms']['p50_ms']:.3f} ms, "
+              f"delivery p99 {step['delivery_ms']['p99_ms']:.1f} ms, "
+              f"{step['memory_per_connection_kb']:.1f} KB per connection")
+    return {"workload": "live", "events": events, "steps": steps}
+
+
+async def run_related(sizes, repeats):
+    """Related products index: build time and memory, then the cost of one write and one lookup.
+
+    The build embeds every product and takes its neighbours from batched
+    matrix products, so its time grows with the square of the catalog;
+    memory is the peak traced during the build, and the size of the arrays
+    kept afterwards.
+    """
+    sys.path.insert(0, str(BACKEND_DIR))
+    from related import RelatedIndex
+    from server import create_product
+
+    steps = []
+    for size in sizes:
+        products = synthetic_products(size, create_product)
+        index = RelatedIndex()
+        tracemalloc.start()
+        started = time.perf_counter()
+        await index.rebuild(products)
+        build_seconds = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        update_ms = []
+        for _ in range(repeats):
+            product = dict(random.choice(products), price=round(random.uniform(5, 600), 2))
+            started = time.perf_counter()
+            index.on_products_changed([product])
+            # Writes are applied in a worker thread; time until this one is
+            await index.settled()
+            update_ms.append((time.perf_counter() - started) * 1000)
+        ids = [product["id"] for product in products]
+        lookup_ms = time_per_call(lambda: index.related(random.choice(ids), index.k), repeats)
+
+        step = {
+            "products": size,
+            "build_seconds": round(build_seconds, 3),
+            "build_peak_mb": round(peak / 2 ** 20, 1),
+            "index_mb": round(index.stats()["memory_bytes"] / 2 ** 20, 1),
+            "update_ms": summarize(update_ms),
+            "lookup_ms": round(lookup_ms, 4),
+        }
+        steps.append(step)
+        print(f"{size:>7} products: build {step['build_seconds']:.2f} s, peak {step['build_peak_mb']:.0f} MB, "
+              f"index {step['index_mb']:.1f} MB, update p50 {step['update_ms']['p50_ms']:.1f} ms, "
+              f"lookup {step['lookup_ms']:.4f} ms")
+    return {"workload": "related", "repeats": repeats, "steps": steps}
+
+
+async def synthetic_rows(count, make):
+    for i in range(count):
+        yield make(i)
+
+
+async def run_analytics(rows, repeats):
+    """Analytics snapshot: time to turn rows streamed in batches into columns, then the cost of each report.
+
+    Products and cart lines are rows each, orders a tenth of that with two
+    items apiece, generated in the shape the snapshot's projections return.
+    The generation alone is timed too (source_seconds), so the columnar
+    build is the difference; BSON decoding by the driver is not included.
+    """
+    sys.path.insert(0, str(BACKEND_DIR))
+    from analytics import take_snapshot
+
+    now = datetime.now(timezone.utc).timestamp()
+    carts = max(1, rows // 4)
+
+    def sources():
+        product = lambda i: {"id": f"p{i}", "category": CATEGORIES[i % len(CATEGORIES)],
+                             "condition": CONDITIONS[i % len(CONDITIONS)], "price": 5 + (i * 7919) % 59500 / 100,
+                             "stock": i % 13}
+        line = lambda i: {"cart_id": f"c{i % carts}", "product_id": f"p{(i * 31) % rows}", "quantity": 1 + i % 3,
+                          "added_at": datetime.fromtimestamp(now - (i % 45) * 86400, timezone.utc)}
+        order = lambda i: {"cart_id": f"c{(i * 7) % carts}",
+                           "created_at": datetime.fromtimestamp(now - (i % 60) * 86400, timezone.utc),
+                           "total": 60.0, "items": [
+                               {"category": CATEGORIES[i % len(CATEGORIES)], "quantity": 1, "subtotal": 20.0},
+                               {"category": CATEGORIES[(i + 1) % len(CATEGORIES)], "quantity": 2, "subtotal": 40.0}]}
+        return (synthetic_rows(rows, product), synthetic_rows(rows, line), synthetic_rows(max(1, rows // 10), order))
+
+    started = time.perf_counter()
+    for source in sources():
+        async for _ in source:
+            pass
+    source_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    snapshot = await take_snapshot(*sources(), batch_size=10_000)
+    refresh_seconds = time.perf_counter() - started
+
+    category = CATEGORIES[0]
+    queries = {
+        "stock_value": lambda: snapshot.stock_value(),
+        "price_distribution": lambda: snapshot.price_distribution(20),
+        "price_distribution_category": lambda: snapshot.price_distribution(20, category),
+        "cart_conversion_30d": lambda: snapshot.cart_conversion(30),
+    }
+    query_ms = {name: round(time_per_call(query, repeats), 3) for name, query in queries.items()}
+    print(f"{rows:>8} rows: refresh {refresh_seconds:.2f} s (source {source_seconds:.2f} s), "
+          f"snapshot {snapshot.memory_bytes() / 2 ** 20:.0f} MB, "
+          + ", ".join(f"{name} {ms:.2f} ms" for name, ms in query_ms.items()))
+    return {"workload": "analytics", "rows": snapshot.rows(), "repeats": repeats,
+            "source_seconds": round(source_seconds, 3), "refresh_seconds": round(refresh_seconds, 3),
+            "snapshot_mb": round(snapshot.memory_bytes() / 2 ** 20, 1), "query_ms": query_ms}
+
+
+def synthetic_photo(seed, size=(3000, 2000)):
+    """A JPEG the size of a catalog original, with enough detail not to compress to nothing."""
+    from PIL import Image
+    import io
+    x0 = -2.0 + (seed % 7) * 0.1
+    image = Image.effect_mandelbrot(size, (x0, -1.0, x0 + 3.0, 1.0), 60 + seed % 40).convert("RGB")
+    noise = Image.effect_noise(size, 40).convert("RGB")
+    buffer = io.BytesIO()
+    Image.blend(image, noise, 0.3).save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+async def run_images(count, processes, repeats):
+    """Image variants: ingest throughput through the process pool, event loop lag meanwhile, bytes saved.
+
+    Sources are synthetic 3000x2000 JPEGs, roughly the catalog's originals.
+    Loop lag is the worst overshoot of a 10 ms sleep while every source is
+    rendered at once; inline_render_ms is how long one render would hold
+    the loop if it ran there instead.
+    """
+    import tempfile
+    sys.path.insert(0, str(BACKEND_DIR))
+    from images import ImageStore, render
+
+    sources = [synthetic_photo(seed) for seed in range(count)]
+    with tempfile.TemporaryDirectory() as directory:
+        store = ImageStore(directory, processes=processes)
+        # Start the pool outside the measurement
+        await asyncio.get_running_loop().run_in_executor(store.pool, time.sleep, 0)
+
+        worst_lag = 0.0
+        done = False
+
+        async def probe():
+            nonlocal worst_lag
+            while not done:
+                started = time.perf_counter()
+                await asyncio.sleep(0.01)
+                worst_lag = max(worst_lag, time.perf_counter() - started - 0.01)
+
+        prober = asyncio.create_task(probe())
+        latencies = []
+
+        async def ingest(data):
+            started = time.perf_counter()
+            image = await store.ingest(data)
+            latencies.append((time.perf_counter() - started) * 1000)
+            return image
+
+        started = time.perf_counter()
+        images = await asyncio.gather(*(ingest(data) for data in sources))
+        elapsed = time.perf_counter() - started
+        done = True
+        await prober
+
+        variant_bytes = {}
+        for image in images:
+            for width in image["widths"]:
+                for fmt in store.formats:
+                    path = os.path.join(store.variant_directory(image["key"]), f"{width}.{fmt}")
+                    variant_bytes.setdefault(f"{width}.{fmt}", []).append(os.path.getsize(path))
+
+        key, width, fmt = images[0]["key"], images[0]["widths"][1], store.formats[-1]
+        hit_ms = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            await store.read(key, width, fmt)
+            hit_ms.append((time.perf_counter() - started) * 1000)
+
+        inline = os.path.join(directory, "inline")
+        started = time.perf_counter()
+        render(store.source_path(key), inline, store.widths, store.formats, store.quality, store.max_pixels)
+        inline_ms = (time.perf_counter() - started) * 1000
+        store.close()
+
+    original = statistics.mean(len(data) for data in sources)
+    result = {
+        "workload": "images",
+        "images": count,
+        "processes": processes,
+        "seconds": round(elapsed, 2),
+        "images_per_second": round(count / elapsed, 2),
+        "ingest_ms": summarize(latencies),
+        "max_loop_lag_ms": round(worst_lag * 1000, 1),
+        "inline_render_ms": round(inline_ms, 1),
+        "cache_hit_ms": summarize(hit_ms),
+        "original_kb": round(original / 1024, 1),
+        "variant_kb": {name: round(statistics.mean(sizes) / 1024, 1) for name, sizes in variant_bytes.items()},
+    }
+    print(f"{count} images on {processes} processes: {result['images_per_second']} images/s, "
+          f"loop lag max {result['max_loop_lag_ms']} ms (inline render {result['inline_render_ms']} ms), "
+          f"{result['original_kb']} KB original vs {result['variant_kb']} KB")
+    return result
+
+
+def mongo_ops(client):
+    """Total operations the server has executed, across all op types."""
+    counters = client.admin.command("serverStatus")["opcounters"]
+    return sum(counters[name] for name in ("query", "getmore", "command", "insert", "update", "delete"))
+
+
+def run_cart_growth(sizes, repeats):
+    """Time GET /api/cart while the cart grows, counting Mongo ops per call.
+
+    Synthetic products and cart lines are written straight to the database,
+    under a "bench-" id prefix and a dedicated cart, and removed afterwards.
+    """
+    client = MongoClient(MONGO_URL)
+    db = client[DB_NAME]
+    largest = max(sizes)
+    products = [
+        {
+            "id": f"bench-{i}",
+            "name": f"Produit bench {i}",
+            "category": "bench",
+            "price": 10.0 + i % 50,
+            "description": "Produit synthétique pour le benchmark du panier.",
+            "image_url": "",
+            "condition": "Bon état",
+            "console": None,
+            "brand": "Bench",
+            "stock": 1000,
+            "created_at": "1970-01-01T00:00:00",
+        }
+        for i in range(largest)
+    ]
+    db.products.insert_many(products)
+    cart_id = "bench-cart-growth"
+    session = requests.Session()
+    session.headers["X-Cart-Id"] = cart_id
+    steps = []
+    try:
+        for size in sizes:
+            db.cart.delete_many({"cart_id": cart_id})
+            db.cart.insert_many([
+                {"id": f"bench-line-{i}", "cart_id": cart_id, "product_id": f"bench-{i}",
+                 "quantity": 1, "added_at": datetime.now(timezone.utc)}
+                for i in range(size)
+            ])
+            session.get(f"{API_URL}/cart")
+            latencies = []
+            ops_before = mongo_ops(client)
+            for _ in range(repeats):
+                start = time.perf_counter()
+                session.get(f"{API_URL}/cart").raise_for_status()
+                latencies.append((time.perf_counter() - start) * 1000)
+            # serverStatus itself counts as one command
+            ops = (mongo_ops(client) - ops_before - 1) / repeats
+            steps.append({"cart_lines": size, "mongo_ops_per_request": round(ops, 2), **summarize(latencies)})
+            print(f"{size:>5} lines: {ops:6.2f} ops/request, p50 {steps[-1]['p50_ms']:.2f} ms")
+    finally:
+        db.cart.delete_many({"cart_id": cart_id})
+        db.products.delete_many({"id": {"$regex": "^bench-"}})
+    return {"workload": "cart-growth", "repeats": repeats, "steps": steps}
+
+
+def change(old, new):
+    return (new - old) / old * 100 if old else 0.0
+
+
+def compare(before, after, max_regression=None):
+    """Print p99 deltas between two results; return the regressions found.
+
+    With max_regression set, any gated metric of a route present in both
+    results that got worse by more than that percentage, or throughput
+    dropping by more than it, counts as a regression.
+    """
+    print(f"{'route':<14}{'before p99':>12}{'after p99':>12}{'change':>10}")
+    rows = [("overall", before["overall"], after["overall"])]
+    rows += [
+        (name, before["routes"][name], after["routes"][name])
+        for name in after["routes"] if name in before["routes"]
+    ]
+    regressions = []
+    for name, old, new in rows:
+        print(f"{name:<14}{old['p99_ms']:>12.2f}{new['p99_ms']:>12.2f}{change(old['p99_ms'], new['p99_ms']):>9.1f}%")
+        if max_regression is None:
+            continue
+        for metric in GATED_METRICS:
+            if metric in old and metric in new and change(old[metric], new[metric]) > max_regression:
+                regressions.append(f"{name} {metric}: {old[metric]} -> {new[metric]}")
+    print(f"{'rps':<14}{before['rps']:>12.1f}{after['rps']:>12.1f}")
+    if max_regression is not None and -change(before["rps"], after["rps"]) > max_regression:
+        regressions.append(f"rps: {before['rps']} -> {after['rps']}")
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrency benchmark for the gaming store API")
+    parser.add_argument("--workload", default="mixed", choices=[
+        "mixed", "cart-growth", "encode", "stream", "live", "related", "analytics", "images"])
+    parser.add_argument("--in-process", action="store_true",
+                        help="Run the app in this process against synthetic data instead of BACKEND_URL")
+    parser.add_argument("--mongo", choices=["auto", "mongod", "mongomock"], default="auto",
+                        help="Database behind the in-process app; auto uses MONGO_URL when it answers")
+    parser.add_argument("--products", type=int, default=2000,
+                        help="Synthetic products seeded for the in-process mode and encoded by --workload encode")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--seed", type=int, help="Seed the random workload for repeatable runs")
+    parser.add_argument("--cart-sizes", default="1,10,50,100,250,500",
+                        help="Comma separated cart line counts for the cart-growth workload")
+    parser.add_argument("--catalog-sizes", default="1000,10000,100000",
+                        help="Comma separated catalog sizes for the stream and related workloads")
+    parser.add_argument("--connections", default="100,1000,10000",
+                        help="Comma separated live update connection counts for the live workload")
+    parser.add_argument("--rows", type=int, default=1_000_000,
+                        help="Products and cart lines in the analytics workload; orders are a tenth of it")
+    parser.add_argument("--images", type=int, default=16, help="Source images rendered by the images workload")
+    parser.add_argument("--processes", type=int, default=2, help="Render processes for the images workload")
+    parser.add_argument("--events", type=int, default=100, help="Events published per step of the live workload")
+    parser.add_argument("--repeats", type=int, default=50)
+    parser.add_argument("--output", help="Write the JSON result to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"),
+                        help="Compare two saved result files instead of running")
+    parser.add_argument("--baseline", help="Compare this run against a saved result file")
+    parser.add_argument("--max-regression", type=float, metavar="PCT",
+                        help="Exit with status 1 when a compared metric regresses by more than PCT percent")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as before, open(args.compare[1]) as after:
+            regressions = compare(json.load(before), json.load(after), args.max_regression)
+        sys.exit(1 if regressions else 0)
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    if args.workload == "cart-growth":
+        if args.in_process:
+            parser.error("the cart-growth workload reads mongod op counters and needs a running backend")
+        print(f"Benchmarking backend API at: {API_URL}")
+        sizes = [int(size) for size in args.cart_sizes.split(",")]
+        result = run_cart_growth(sizes, args.repeats)
+    elif args.workload == "stream":
+        sizes = [int(size) for size in args.catalog_sizes.split(",")]
+        result = asyncio.run(run_stream(sizes, args.mongo))
+    elif args.workload == "live":
+        counts = [int(count) for count in args.connections.split(",")]
+        result = asyncio.run(run_live(counts, args.events))
+    elif args.workload == "related":
+        sizes = [int(size) for size in args.catalog_sizes.split(",")]
+        result = asyncio.run(run_related(sizes, args.repeats))
+    elif args.workload == "analytics":
+        result = asyncio.run(run_analytics(args.rows, args.repeats))
+    elif args.workload == "images":
+        result = asyncio.run(run_images(args.images, args.processes, args.repeats))
+    elif args.workload == "encode":
+        result = run_encode(args.products, args.repeats)
+    elif args.in_process:
+        result = asyncio.run(run_in_process(args.concurrency, args.requests, args.products, args.mongo))
+    else:
+        print(f"Benchmarking backend API at: {API_URL}")
+        result = run_mixed(args.concurrency, args.requests)
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+    if args.baseline and result["workload"] == "mixed":
+        with open(args.baseline) as f:
+            regressions = compare(json.load(f), result, args.max_regression)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
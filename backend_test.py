@@ -1,14 +1,48 @@
 #!/usr/bin/env python3
 import requests
+import io
 import json
 import unittest
 import os
 import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from itertools import combinations, product as cartesian
+
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+# Listing queries and rate limit keys come from the backend's own helpers
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+from admission import RateLimiter, client_key, parse_networks, route_key
+from repository import LISTING_SORTS, encode_cursor, keyset_query, price_range
 
 # Get the backend URL from the frontend .env file
 BACKEND_URL = "https://c5074add-db37-4a52-ba8e-eeaa3e775d0e.preview.emergentagent.com"
 API_URL = f"{BACKEND_URL}/api"
 
+# Database behind the backend, for query plan checks
+MONGO_URL = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
+DB_NAME = os.environ.get("DB_NAME", "test_database")
+
+# Carts are per session; run every cart call against one test cart
+CART_HEADERS = {"X-Cart-Id": f"backend-test-{uuid.uuid4().hex}"}
+
+def admitted(method, url, headers, timeout=120):
+    """Send a write, retrying while the server rate limits this client (429) or sheds load (503)
+
+    Every request of the suite comes from one client, so writes fired in
+    parallel queue behind its per-client write rate.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        response = requests.request(method, url, headers=headers)
+        if response.status_code not in (429, 503) or time.monotonic() > deadline:
+            return response
+        time.sleep(float(response.headers.get("Retry-After", 1)))
+
 class TestBackendAPI(unittest.TestCase):
     """Test suite for the gaming e-commerce backend API"""
 
@@ -29,9 +63,14 @@ class TestBackendAPI(unittest.TestCase):
         self.assertIsInstance(data["products"], list, "Products should be a list")
         self.assertGreater(len(data["products"]), 0, "No products returned")
         
+        # Revalidation answers 304 with the very validator the 200 carried
+        revalidated = requests.get(f"{API_URL}/products", headers={"If-None-Match": response.headers["etag"]})
+        self.assertEqual(revalidated.status_code, 304, "Unchanged listing not answered with 304")
+        self.assertEqual(revalidated.headers["etag"], response.headers["etag"], "304 carries a different ETag")
+
         # Store a product ID for later tests
         self.product_id = data["products"][0]["id"]
-        
+
         print(f"✅ Found {len(data['products'])} products")
         print(f"Sample product: {data['products'][0]['name']}")
         
@@ -73,6 +112,20 @@ class TestBackendAPI(unittest.TestCase):
             
             print(f"✅ Search for '{term}' returned {len(data['products'])} products")
 
+        # Paging one result at a time walks the whole ranking, without repeats
+        everything = requests.get(f"{API_URL}/products", params={"search": "Gaming", "limit": 100}).json()["products"]
+        paged, cursor = [], None
+        while len(paged) <= len(everything):
+            page = requests.get(f"{API_URL}/products", params={"search": "Gaming", "limit": 1, "cursor": cursor}).json()
+            paged += [product["id"] for product in page["products"]]
+            cursor = page["next_cursor"]
+            if not cursor:
+                break
+        self.assertEqual(paged, [product["id"] for product in everything], "Search pages differ from the full ranking")
+        for offset in (-1, "2", 1.5, True, None):
+            response = requests.get(f"{API_URL}/products", params={"search": "Gaming", "cursor": encode_cursor({"offset": offset})})
+            self.assertEqual(response.status_code, 400, f"Should reject the search offset {offset!r}")
+
     def test_04_product_by_id(self):
         """Test GET /api/products/{id} endpoint"""
         print("\n=== Testing GET /api/products/{id} ===")
@@ -118,20 +171,22 @@ class TestBackendAPI(unittest.TestCase):
         """Test POST /api/cart/add endpoint"""
         print("\n=== Testing POST /api/cart/add ===")
         
-        # Ensure we have a product ID
-        if not self.product_id:
-            products = self.test_01_products_endpoint()
-            self.product_id = products[0]["id"]
+        # Other tests call this one again: empty the cart, which returns its
+        # held stock, then pick a product with room for the 3 test_08 sets
+        for item in requests.get(f"{API_URL}/cart", headers=CART_HEADERS).json()["items"]:
+            admitted("DELETE", f"{API_URL}/cart/{item['id']}", CART_HEADERS)
+        products = self.test_01_products_endpoint()
+        self.product_id = next(p["id"] for p in products if p["stock"] >= 3)
         
         # Add product to cart
-        response = requests.post(f"{API_URL}/cart/add?product_id={self.product_id}&quantity=2")
+        response = requests.post(f"{API_URL}/cart/add?product_id={self.product_id}&quantity=2", headers=CART_HEADERS)
         self.assertEqual(response.status_code, 200, "Failed to add product to cart")
         
         print("✅ Successfully added product to cart")
         
         # Test adding invalid product
         invalid_id = "nonexistent-id"
-        response = requests.post(f"{API_URL}/cart/add?product_id={invalid_id}&quantity=1")
+        response = requests.post(f"{API_URL}/cart/add?product_id={invalid_id}&quantity=1", headers=CART_HEADERS)
         self.assertEqual(response.status_code, 404, "Should return 404 for invalid product ID")
         
         print("✅ Correctly returns 404 when adding invalid product to cart")
@@ -145,7 +200,7 @@ class TestBackendAPI(unittest.TestCase):
             self.test_06_add_to_cart()
             self.test_06_add_to_cart_run = True
         
-        response = requests.get(f"{API_URL}/cart")
+        response = requests.get(f"{API_URL}/cart", headers=CART_HEADERS)
         self.assertEqual(response.status_code, 200, "Failed to get cart")
         
         data = response.json()
@@ -170,11 +225,11 @@ class TestBackendAPI(unittest.TestCase):
             self.test_07_get_cart()
         
         # Update quantity to 3
-        response = requests.put(f"{API_URL}/cart/{self.cart_item_id}?quantity=3")
+        response = requests.put(f"{API_URL}/cart/{self.cart_item_id}?quantity=3", headers=CART_HEADERS)
         self.assertEqual(response.status_code, 200, "Failed to update cart quantity")
         
         # Verify quantity was updated
-        response = requests.get(f"{API_URL}/cart")
+        response = requests.get(f"{API_URL}/cart", headers=CART_HEADERS)
         data = response.json()
         
         item = next((item for item in data["items"] if item["id"] == self.cart_item_id), None)
@@ -185,7 +240,7 @@ class TestBackendAPI(unittest.TestCase):
         
         # Test updating invalid cart item
         invalid_id = "nonexistent-id"
-        response = requests.put(f"{API_URL}/cart/{invalid_id}?quantity=1")
+        response = requests.put(f"{API_URL}/cart/{invalid_id}?quantity=1", headers=CART_HEADERS)
         self.assertEqual(response.status_code, 404, "Should return 404 for invalid cart item ID")
         
         print("✅ Correctly returns 404 when updating invalid cart item")
@@ -199,11 +254,11 @@ class TestBackendAPI(unittest.TestCase):
             self.test_07_get_cart()
         
         # Remove item from cart
-        response = requests.delete(f"{API_URL}/cart/{self.cart_item_id}")
+        response = requests.delete(f"{API_URL}/cart/{self.cart_item_id}", headers=CART_HEADERS)
         self.assertEqual(response.status_code, 200, "Failed to remove item from cart")
         
         # Verify item was removed
-        response = requests.get(f"{API_URL}/cart")
+        response = requests.get(f"{API_URL}/cart", headers=CART_HEADERS)
         data = response.json()
         
         item = next((item for item in data["items"] if item["id"] == self.cart_item_id), None)
@@ -213,7 +268,7 @@ class TestBackendAPI(unittest.TestCase):
         
         # Test removing invalid cart item
         invalid_id = "nonexistent-id"
-        response = requests.delete(f"{API_URL}/cart/{invalid_id}")
+        response = requests.delete(f"{API_URL}/cart/{invalid_id}", headers=CART_HEADERS)
         self.assertEqual(response.status_code, 404, "Should return 404 for invalid cart item ID")
         
         print("✅ Correctly returns 404 when removing invalid cart item")
@@ -257,6 +312,527 @@ class TestBackendAPI(unittest.TestCase):
         for category, count in categories.items():
             print(f"  - {category}: {count} products")
 
+    def test_11_concurrent_add_to_cart(self):
+        """Fire parallel POST /api/cart/add calls and check no increment is lost"""
+        print("\n=== Testing concurrent POST /api/cart/add ===")
+        
+        # Start from an empty cart, so no stock is held by earlier tests
+        cart = requests.get(f"{API_URL}/cart", headers=CART_HEADERS).json()
+        for item in cart["items"]:
+            admitted("DELETE", f"{API_URL}/cart/{item['id']}", CART_HEADERS)
+        
+        products = requests.get(f"{API_URL}/products").json()["products"]
+        product = max(products, key=lambda p: p["stock"])
+        
+        # Far more than any product's stock, though few enough to get through
+        # the per-client write rate in a minute or so
+        attempts = 300
+        
+        def add(_):
+            return admitted("POST", f"{API_URL}/cart/add?product_id={product['id']}&quantity=1", CART_HEADERS).status_code
+        
+        with ThreadPoolExecutor(max_workers=64) as pool:
+            statuses = list(pool.map(add, range(attempts)))
+        
+        expected = min(attempts, product["stock"])
+        self.assertEqual(statuses.count(200), expected, "Accepted adds don't match available stock")
+        self.assertEqual(statuses.count(409), attempts - expected, "Adds over stock should return 409")
+        
+        cart = requests.get(f"{API_URL}/cart", headers=CART_HEADERS).json()
+        lines = [item for item in cart["items"] if item["product_id"] == product["id"]]
+        self.assertEqual(len(lines), 1, "Concurrent adds created duplicate cart lines")
+        self.assertEqual(lines[0]["quantity"], expected, "Final quantity doesn't match accepted adds")
+        
+        admitted("DELETE", f"{API_URL}/cart/{lines[0]['id']}", CART_HEADERS)
+        
+        print(f"✅ {attempts} concurrent adds left exactly {expected} in one cart line")
+
+    def test_12_products_batch(self):
+        """Test GET /api/products:batch returns products in request order with misses"""
+        print("\n=== Testing GET /api/products:batch ===")
+        
+        products = requests.get(f"{API_URL}/products").json()["products"]
+        ids = [products[2]["id"], "invalid-product-id", products[0]["id"], products[2]["id"]]
+        
+        response = requests.get(f"{API_URL}/products:batch", params={"ids": ",".join(ids)})
+        self.assertEqual(response.status_code, 200, "Failed to batch fetch products")
+        data = response.json()
+        
+        self.assertEqual(len(data["products"]), len(ids), "One entry expected per requested id")
+        self.assertEqual(data["products"][0]["id"], ids[0])
+        self.assertIsNone(data["products"][1], "Unknown id should map to null")
+        self.assertEqual(data["products"][2]["id"], ids[2])
+        self.assertEqual(data["products"][3]["id"], ids[3])
+        self.assertEqual(data["missing"], ["invalid-product-id"])
+        
+        response = requests.get(f"{API_URL}/products:batch")
+        self.assertEqual(response.status_code, 400, "Missing ids should return 400")
+        
+        print(f"✅ Batch fetch returned {len(ids)} entries in request order")
+
+    def test_13_concurrent_reservations_never_oversell(self):
+        """Race hundreds of carts for one product and check stock never goes negative"""
+        print("\n=== Testing concurrent stock reservations ===")
+        
+        products = requests.get(f"{API_URL}/products").json()["products"]
+        product = max(products, key=lambda p: p["stock"])
+        stock = product["stock"]
+        attempts = 300
+        carts = [{"X-Cart-Id": f"reserve-{uuid.uuid4().hex}"} for _ in range(attempts)]
+        
+        def add(headers):
+            return admitted("POST", f"{API_URL}/cart/add?product_id={product['id']}&quantity=1", headers).status_code
+        
+        with ThreadPoolExecutor(max_workers=64) as pool:
+            statuses = list(pool.map(add, carts))
+        
+        accepted = [headers for headers, status in zip(carts, statuses) if status == 200]
+        self.assertEqual(len(accepted), min(attempts, stock), "Accepted reservations don't match stock")
+        self.assertEqual(statuses.count(409), attempts - len(accepted), "Reservations over stock should return 409")
+        remaining = requests.get(f"{API_URL}/products/{product['id']}").json()["stock"]
+        self.assertEqual(remaining, stock - len(accepted), "Stock oversold or leaked")
+        
+        # Holding carts can re-reserve their lines; emptying them returns the stock
+        for headers in accepted:
+            self.assertEqual(admitted("POST", f"{API_URL}/cart/reserve", headers).status_code, 200)
+            for item in requests.get(f"{API_URL}/cart", headers=headers).json()["items"]:
+                self.assertEqual(admitted("DELETE", f"{API_URL}/cart/{item['id']}", headers).status_code, 200)
+        restored = requests.get(f"{API_URL}/products/{product['id']}").json()["stock"]
+        self.assertEqual(restored, stock, "Released reservations didn't return to stock")
+        
+        print(f"✅ {attempts} carts racing for {stock} units reserved exactly {len(accepted)}")
+
+    def test_14_price_filters_and_sort(self):
+        """Test min_price/max_price/sort on GET /api/products"""
+        print("\n=== Testing price range and sorted listings ===")
+        
+        response = requests.get(f"{API_URL}/products", params={"sort": "price", "min_price": 30, "max_price": 100, "limit": 5})
+        self.assertEqual(response.status_code, 200, "Failed to get price-sorted products")
+        prices = []
+        cursor = None
+        while True:
+            params = {"sort": "price", "min_price": 30, "max_price": 100, "limit": 5}
+            if cursor:
+                params["cursor"] = cursor
+            data = requests.get(f"{API_URL}/products", params=params).json()
+            prices += [p["price"] for p in data["products"]]
+            cursor = data["next_cursor"]
+            if not cursor:
+                break
+        self.assertTrue(prices, "No products between 30 and 100")
+        self.assertEqual(prices, sorted(prices), "Products not in ascending price order across pages")
+        self.assertTrue(all(30 <= price <= 100 for price in prices), "Price range not applied")
+        
+        data = requests.get(f"{API_URL}/products", params={"sort": "-price", "category": "manettes"}).json()
+        descending = [p["price"] for p in data["products"]]
+        self.assertEqual(descending, sorted(descending, reverse=True), "Products not in descending price order")
+        
+        for params in ({"sort": "cheapest"}, {"sort": "price", "search": "manette"}, {"min_price": 50, "max_price": 10}):
+            response = requests.get(f"{API_URL}/products", params=params)
+            self.assertEqual(response.status_code, 400, f"Should reject {params}")
+        
+        # Cursor values go into the query, so anything but plain sort keys is refused
+        for sort, position in (("price", {"price": {"$gt": 0}, "id": "a"}), ("price", {"price": 10, "id": {"$ne": None}}),
+                               ("price", {"price": 10, "id": "a", "stock": 1}), ("price", {"price": "10", "id": "a"}),
+                               ("newest", {"created_at": {"$ne": None}, "id": "a"}), ("newest", {"created_at": "yesterday", "id": "a"})):
+            response = requests.get(f"{API_URL}/products", params={"sort": sort, "cursor": encode_cursor(position)})
+            self.assertEqual(response.status_code, 400, f"Should reject cursor {position}")
+        response = requests.get(f"{API_URL}/products", params={"sort": "price", "cursor": encode_cursor(
+            {"created_at": "2024-01-01T00:00:00", "id": "a"})})
+        self.assertEqual(response.status_code, 200, "A cursor from another order should start over")
+        
+        print(f"✅ {len(prices)} products between 30€ and 100€ listed cheapest first")
+
+    def test_15_listing_queries_use_indexes(self):
+        """Explain every supported filter/sort combination and check none scans the collection"""
+        print("\n=== Testing listing query plans ===")
+        
+        client = MongoClient(MONGO_URL, serverSelectionTimeoutMS=2000)
+        try:
+            client.admin.command("ping")
+        except PyMongoError:
+            self.skipTest(f"MongoDB not reachable at {MONGO_URL}")
+        collection = client[DB_NAME].products
+        sample = collection.find_one({}, {"_id": 0})
+        self.assertIsNotNone(sample, "No products to explain queries against")
+        indexes = collection.index_information()
+        for name in ("category_listing", "listing", "category_price", "console_price", "price_listing"):
+            self.assertIn(name, indexes, f"Index {name} missing")
+        
+        def scans_collection(plan):
+            if isinstance(plan, dict):
+                return plan.get("stage") == "COLLSCAN" or any(scans_collection(value) for value in plan.values())
+            if isinstance(plan, list):
+                return any(scans_collection(value) for value in plan)
+            return False
+        
+        filter_fields = ("category", "brand", "console", "condition")
+        price_ranges = [(None, None), (10, None), (None, 100), (10, 100)]
+        checked = 0
+        for size in range(len(filter_fields) + 1):
+            for fields in combinations(filter_fields, size):
+                filters = {field: sample.get(field) for field in fields}
+                for (min_price, max_price), (sort_name, sort) in cartesian(price_ranges, LISTING_SORTS.items()):
+                    query = {**filters, **price_range(min_price, max_price)}
+                    # First pages and the keyset range of later pages
+                    for after in (None, {field: sample.get(field) for field, _ in sort}):
+                        explain = collection.find(keyset_query(query, sort, after)).sort(sort).limit(51).explain()
+                        self.assertFalse(
+                            scans_collection(explain["queryPlanner"]["winningPlan"]),
+                            f"COLLSCAN for filters={query} sort={sort_name} after={after}",
+                        )
+                        checked += 1
+        client.close()
+        
+        print(f"✅ {checked} listing queries all planned on indexes")
+
+    def test_16_read_rate_limit(self):
+        """Burst past the per-client read rate and check for fast 429s with Retry-After"""
+        print("\n=== Testing read rate limiting ===")
+        
+        with ThreadPoolExecutor(max_workers=32) as pool:
+            responses = list(pool.map(lambda _: requests.get(f"{API_URL}/categories"), range(400)))
+        statuses = [response.status_code for response in responses]
+        self.assertEqual(set(statuses) - {200, 429}, set(), "Unexpected statuses under a burst")
+        limited = [response for response in responses if response.status_code == 429]
+        if not limited:
+            self.skipTest("Read rate limiting is disabled")
+        self.assertTrue(all(response.headers.get("Retry-After") for response in limited), "429 without Retry-After")
+        
+        # The bucket refills: after waiting, reads are admitted again
+        time.sleep(max(int(response.headers["Retry-After"]) for response in limited) + 1)
+        self.assertEqual(requests.get(f"{API_URL}/categories").status_code, 200, "Reads still limited after waiting")
+        
+        print(f"✅ {len(limited)} of {len(statuses)} burst reads limited with 429")
+
+    def test_17_live_updates(self):
+        """Follow GET /api/live while changing a cart and check the pushed deltas"""
+        print("\n=== Testing GET /api/live ===")
+        
+        cart_id = f"live-{uuid.uuid4().hex}"
+        headers = {"X-Cart-Id": cart_id}
+        products = requests.get(f"{API_URL}/products").json()["products"]
+        product = next(p for p in products if p["stock"] >= 1)
+        
+        events = []
+        connected = threading.Event()
+        
+        def follow():
+            with requests.get(f"{API_URL}/live", params={"cart_id": cart_id}, stream=True, timeout=30) as response:
+                self.assertEqual(response.headers["content-type"].split(";")[0], "text/event-stream")
+                event = None
+                for line in response.iter_lines(decode_unicode=True):
+                    if line.startswith("event: "):
+                        event = line[len("event: "):]
+                    elif line.startswith("data: "):
+                        events.append((event, json.loads(line[len("data: "):])))
+                        if event == "cart":
+                            connected.set()
+                        if event == "cart_line_removed":
+                            return
+        
+        follower = threading.Thread(target=follow, daemon=True)
+        follower.start()
+        self.assertTrue(connected.wait(10), "No cart snapshot on connect")
+        
+        response = admitted("POST", f"{API_URL}/cart/add?product_id={product['id']}&quantity=1", headers)
+        self.assertEqual(response.status_code, 200, "Failed to add product to cart")
+        item = requests.get(f"{API_URL}/cart", headers=headers).json()["items"][0]
+        admitted("DELETE", f"{API_URL}/cart/{item['id']}", headers)
+        follower.join(15)
+        
+        self.assertEqual(events[0], ("cart", {"items": []}), "Snapshot of the empty cart expected first")
+        self.assertIn(("cart_line", {"id": item["id"], "product_id": product["id"], "quantity": 1}), events)
+        self.assertIn(("cart_line_removed", {"id": item["id"]}), events)
+        stock_changes = [data["changes"]["stock"] for event, data in events
+                         if event == "product" and data["id"] == product["id"] and "stock" in data.get("changes", {})]
+        self.assertIn(product["stock"] - 1, stock_changes, "Reserved stock was not pushed")
+        
+        print(f"✅ Live stream pushed {len(events)} events for one add and remove")
+
+    def test_18_related_products(self):
+        """Test GET /api/products/{id}/related"""
+        print("\n=== Testing GET /api/products/{id}/related ===")
+        
+        product = requests.get(f"{API_URL}/products").json()["products"][0]
+        response = requests.get(f"{API_URL}/products/{product['id']}/related?limit=4")
+        self.assertEqual(response.status_code, 200, f"Failed to get related products: {response.text}")
+        related = response.json()["products"]
+        self.assertLessEqual(len(related), 4)
+        self.assertNotIn(product["id"], [item["id"] for item in related], "A product is not related to itself")
+        self.assertEqual(len({item["id"] for item in related}), len(related), "Related products repeated")
+        
+        response = requests.get(f"{API_URL}/products/{uuid.uuid4()}/related")
+        self.assertEqual(response.status_code, 404, "Unknown product should give 404")
+        response = requests.get(f"{API_URL}/products/{product['id']}/related?limit=0")
+        self.assertEqual(response.status_code, 400, "limit below 1 should be rejected")
+        
+        print(f"✅ {len(related)} products related to {product['name']}")
+
+    def test_19_checkout(self):
+        """Test POST /api/checkout, the order it places and its background invoice
+
+        Against a single-node replica set (mongod --replSet rs0, then
+        rs.initiate() in mongosh) checkout runs as one transaction; against
+        a standalone server it goes through the reservation holds instead.
+        """
+        print("\n=== Testing POST /api/checkout ===")
+        
+        headers = {"X-Cart-Id": f"checkout-{uuid.uuid4().hex}"}
+        response = requests.post(f"{API_URL}/checkout", json={"email": "joueur@example.fr"}, headers=headers)
+        self.assertEqual(response.status_code, 400, "Checking out an empty cart should give 400")
+        response = requests.post(f"{API_URL}/checkout", json={"email": "not an email"}, headers=headers)
+        self.assertEqual(response.status_code, 422, "Invalid email should be rejected")
+        
+        # Orders consume stock for good: take one unit of the best stocked products
+        products = sorted(requests.get(f"{API_URL}/products").json()["products"], key=lambda p: -p["stock"])[:2]
+        self.assertTrue(products and products[-1]["stock"] >= 1, "No product with stock to check out")
+        for product in products:
+            response = admitted("POST", f"{API_URL}/cart/add?product_id={product['id']}", headers)
+            self.assertEqual(response.status_code, 200, "Failed to add product to cart")
+        
+        response = requests.post(f"{API_URL}/checkout", json={"email": "joueur@example.fr", "name": "Joueur"},
+                                 headers=headers)
+        self.assertEqual(response.status_code, 200, f"Checkout failed: {response.text}")
+        order = response.json()
+        self.assertEqual(order["status"], "placed")
+        self.assertEqual(sorted(item["product_id"] for item in order["items"]),
+                         sorted(product["id"] for product in products))
+        self.assertAlmostEqual(order["total"], sum(product["price"] for product in products), places=2)
+        
+        self.assertEqual(requests.get(f"{API_URL}/cart", headers=headers).json()["count"], 0, "Cart not emptied")
+        for product in products:
+            stock = requests.get(f"{API_URL}/products/{product['id']}").json()["stock"]
+            self.assertEqual(stock, product["stock"] - 1, "Stock not taken by the order")
+        self.assertEqual(requests.get(f"{API_URL}/orders/{order['id']}").json()["id"], order["id"])
+        self.assertEqual(requests.get(f"{API_URL}/orders/{uuid.uuid4()}").status_code, 404)
+        
+        # Rendered by a background job after the commit
+        for _ in range(50):
+            invoice = requests.get(f"{API_URL}/orders/{order['id']}/invoice")
+            if invoice.status_code == 200:
+                break
+            time.sleep(0.2)
+        self.assertEqual(invoice.status_code, 200, "Invoice was never rendered")
+        self.assertEqual(invoice.headers["content-type"], "application/pdf")
+        self.assertTrue(invoice.content.startswith(b"%PDF-"))
+        
+        print(f"✅ Order {order['id']} placed for {order['total']}, invoice of {len(invoice.content)} bytes")
+
+    def test_20_checkout_out_of_stock_changes_nothing(self):
+        """A checkout short of stock is refused and leaves stock, cart and orders as they were"""
+        print("\n=== Testing checkout without enough stock ===")
+        
+        client = MongoClient(MONGO_URL, serverSelectionTimeoutMS=2000)
+        try:
+            client.admin.command("ping")
+        except PyMongoError:
+            self.skipTest(f"MongoDB not reachable at {MONGO_URL}")
+        db = client[DB_NAME]
+        
+        cart_id = f"checkout-{uuid.uuid4().hex}"
+        headers = {"X-Cart-Id": cart_id}
+        products = [product for product in requests.get(f"{API_URL}/products").json()["products"]
+                    if product["stock"] >= 1][:2]
+        self.assertEqual(len(products), 2, "Two products with stock needed")
+        for product in products:
+            admitted("POST", f"{API_URL}/cart/add?product_id={product['id']}", headers)
+        # More of the second product than there will ever be
+        db.cart.update_one({"cart_id": cart_id, "product_id": products[1]["id"]}, {"$set": {"quantity": 10 ** 6}})
+        orders = db.orders.count_documents({})
+        stock = {product["id"]: db.products.find_one({"id": product["id"]})["stock"] for product in products}
+        
+        response = requests.post(f"{API_URL}/checkout", json={"email": "joueur@example.fr"}, headers=headers)
+        self.assertEqual(response.status_code, 409, f"Expected 409, got {response.status_code}: {response.text}")
+        self.assertEqual(response.json()["detail"]["unavailable"], [products[1]["id"]])
+        self.assertEqual(db.orders.count_documents({}), orders, "An order was placed")
+        self.assertEqual(db.cart.count_documents({"cart_id": cart_id}), 2, "Cart lines were removed")
+        for product_id, before in stock.items():
+            self.assertEqual(db.products.find_one({"id": product_id})["stock"], before, "Stock moved")
+        
+        print("✅ Checkout refused with 409 and nothing changed")
+
+    def test_21_analytics(self):
+        """Test the /api/analytics reports, served from the last columnar snapshot"""
+        print("\n=== Testing /api/analytics ===")
+        
+        # 503 until the first snapshot of the process serving the request
+        for _ in range(30):
+            response = requests.get(f"{API_URL}/analytics/stock-value")
+            if response.status_code != 503:
+                break
+            time.sleep(float(response.headers.get("Retry-After", 1)))
+        self.assertEqual(response.status_code, 200, f"Failed to get stock value: {response.text}")
+        stock = response.json()
+        categories = stock["categories"]
+        self.assertEqual(sum(row["products"] for row in categories), stock["total"]["products"])
+        self.assertAlmostEqual(sum(row["stock_value"] for row in categories), stock["total"]["stock_value"], places=1)
+        values = [row["stock_value"] for row in categories]
+        self.assertEqual(values, sorted(values, reverse=True), "Categories should come by stock value")
+        
+        response = requests.get(f"{API_URL}/analytics/price-distribution?bins=10")
+        self.assertEqual(response.status_code, 200, f"Failed to get price distribution: {response.text}")
+        distribution = response.json()
+        self.assertEqual(len(distribution["bin_edges"]), 11)
+        for row in distribution["conditions"]:
+            self.assertEqual(sum(row["histogram"]), row["products"])
+            self.assertTrue(row["min"] <= row["p25"] <= row["p50"] <= row["p75"] <= row["max"])
+        if categories:
+            response = requests.get(f"{API_URL}/analytics/price-distribution",
+                                    params={"category": categories[0]["category"]})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(sum(row["products"] for row in response.json()["conditions"]), categories[0]["products"])
+        response = requests.get(f"{API_URL}/analytics/price-distribution?category={uuid.uuid4()}")
+        self.assertEqual(response.status_code, 404, "Unknown category should give 404")
+        
+        response = requests.get(f"{API_URL}/analytics/cart-conversion?days=7")
+        self.assertEqual(response.status_code, 200, f"Failed to get cart conversion: {response.text}")
+        conversion = response.json()
+        self.assertEqual(len(conversion["daily"]), 7)
+        self.assertLessEqual(conversion["converted"], conversion["carts"])
+        self.assertTrue(0 <= conversion["conversion_rate"] <= 1)
+        self.assertEqual(sum(day["orders"] for day in conversion["daily"]), conversion["orders"])
+        self.assertEqual(requests.get(f"{API_URL}/analytics/cart-conversion?days=0").status_code, 422)
+        
+        print(f"✅ Snapshot of {stock['snapshot']['rows']}, conversion {conversion['conversion_rate']}")
+
+    def test_22_product_image_variants(self):
+        """Test PUT /api/products/{id}/image and the immutable resized variants it lists"""
+        print("\n=== Testing product image variants ===")
+        
+        try:
+            from PIL import Image
+        except ImportError:
+            self.skipTest("Pillow is needed to make a test image")
+        buffer = io.BytesIO()
+        Image.linear_gradient("L").resize((1600, 1000)).convert("RGB").save(buffer, "JPEG")
+        
+        row = {"id": f"image-{uuid.uuid4().hex}", "name": "Manette Image Test", "category": "manettes",
+               "price": 29.9, "description": "Manette importée", "image_url": "https://example.com/manette.jpg",
+               "stock": 1}
+        imported = requests.post(f"{API_URL}/products/bulk", data=json.dumps(row) + "\n",
+                                 headers={"Content-Type": "application/x-ndjson"})
+        self.assertEqual(imported.status_code, 200, f"Import failed: {imported.text}")
+        response = requests.put(f"{API_URL}/products/{row['id']}/image", data=buffer.getvalue(),
+                                headers={"Content-Type": "image/jpeg"})
+        if response.status_code == 501:
+            self.skipTest("Image processing is not available on the server")
+        self.assertEqual(response.status_code, 200, f"Failed to upload image: {response.text}")
+        image = response.json()["image"]
+        self.assertEqual((image["width"], image["height"]), (1600, 1000))
+        self.assertEqual(response.json()["image_url"], row["image_url"], "The upload should keep the original URL")
+        self.assertEqual(image["source_url"], row["image_url"])
+        self.assertTrue(image["uploaded"])
+        self.assertTrue(all(width <= 1600 for width in image["widths"]), "Images should not be upscaled")
+        
+        for media_type, srcset in image["srcset"].items():
+            candidates = [candidate.split(" ") for candidate in srcset.split(", ")]
+            self.assertEqual([int(width[:-1]) for _, width in candidates], image["widths"])
+            variant = requests.get(f"{BACKEND_URL}{candidates[0][0]}")
+            self.assertEqual(variant.status_code, 200, f"Variant not served: {candidates[0][0]}")
+            self.assertEqual(variant.headers["content-type"], media_type)
+            self.assertIn("immutable", variant.headers["cache-control"])
+            self.assertLess(len(variant.content), len(buffer.getvalue()))
+            revalidated = requests.get(f"{BACKEND_URL}{candidates[0][0]}",
+                                       headers={"If-None-Match": variant.headers["etag"]})
+            self.assertEqual(revalidated.status_code, 304)
+        
+        # Re-importing the same row keeps the upload instead of fetching over it
+        requests.post(f"{API_URL}/products/bulk", data=json.dumps({**row, "price": 27.9}) + "\n",
+                      headers={"Content-Type": "application/x-ndjson"})
+        self.assertEqual(requests.get(f"{API_URL}/products/{row['id']}").json()["image"]["key"], image["key"])
+        
+        response = requests.put(f"{API_URL}/products/{row['id']}/image", data=b"not an image")
+        self.assertEqual(response.status_code, 400, "A body that is not an image should give 400")
+        self.assertEqual(requests.get(f"{API_URL}/images/{image['key']}/123.webp").status_code, 404)
+        
+        print(f"✅ Image {image['key'][:12]} served at widths {image['widths']} as {', '.join(image['srcset'])}")
+
+    def test_23_bulk_reimport_keeps_reserved_stock(self):
+        """Re-importing a product leaves its stock to reservations and reports unchanged rows"""
+        print("\n=== Testing POST /api/products/bulk re-imports ===")
+
+        row = {"id": f"bulk-{uuid.uuid4().hex}", "name": "Manette Bulk Test", "category": "Accessoires",
+               "price": 19.9, "description": "Manette importée", "image_url": "https://example.com/manette.jpg",
+               "stock": 5}
+
+        def bulk_import(row):
+            response = requests.post(f"{API_URL}/products/bulk", data=json.dumps(row) + "\n",
+                                     headers={"Content-Type": "application/x-ndjson"})
+            self.assertEqual(response.status_code, 200, f"Import failed: {response.text}")
+            return response.json()
+
+        self.assertEqual(bulk_import(row)["inserted"], 1)
+        headers = {"X-Cart-Id": f"bulk-{uuid.uuid4().hex}"}
+        self.assertEqual(admitted("POST", f"{API_URL}/cart/add?product_id={row['id']}&quantity=2", headers).status_code, 200)
+
+        report = bulk_import(row)
+        self.assertEqual((report["inserted"], report["matched"], report["updated"]), (0, 1, 0))
+        self.assertEqual(requests.get(f"{API_URL}/products/{row['id']}").json()["stock"], 3,
+                         "The re-import gave back stock held by a cart")
+        report = bulk_import({**row, "price": 17.9})
+        self.assertEqual((report["matched"], report["updated"]), (1, 1))
+        product = requests.get(f"{API_URL}/products/{row['id']}").json()
+        self.assertEqual((product["price"], product["stock"]), (17.9, 3))
+
+        item = requests.get(f"{API_URL}/cart", headers=headers).json()["items"][0]
+        admitted("DELETE", f"{API_URL}/cart/{item['id']}", headers)
+
+        print(f"✅ Re-import kept stock at {product['stock']} and reported the unchanged row")
+
+    def test_24_stock_changes_keep_other_cached_responses(self):
+        """A reservation drops the cached responses showing that product, and only those"""
+        print("\n=== Testing catalog cache invalidation on stock changes ===")
+
+        products = [product for product in requests.get(f"{API_URL}/products").json()["products"]
+                    if product["stock"] >= 1][:2]
+        self.assertEqual(len(products), 2, "Two products with stock needed")
+        reserved, other = products
+        for product in products:
+            requests.get(f"{API_URL}/products/{product['id']}")
+        hits = requests.get(f"{API_URL}/cache/stats").json()["catalog"]["hits"]
+
+        headers = {"X-Cart-Id": f"cache-{uuid.uuid4().hex}"}
+        self.assertEqual(admitted("POST", f"{API_URL}/cart/add?product_id={reserved['id']}", headers).status_code, 200)
+        requests.get(f"{API_URL}/products/{other['id']}")
+        self.assertEqual(requests.get(f"{API_URL}/cache/stats").json()["catalog"]["hits"], hits + 1,
+                         "A reservation dropped the cached response of another product")
+        self.assertEqual(requests.get(f"{API_URL}/products/{reserved['id']}").json()["stock"], reserved["stock"] - 1,
+                         "Cached response shows stock from before the reservation")
+
+        item = requests.get(f"{API_URL}/cart", headers=headers).json()["items"][0]
+        admitted("DELETE", f"{API_URL}/cart/{item['id']}", headers)
+
+        print("✅ Reservation dropped only the reserved product's cached response")
+
+    def test_25_rate_limit_keys(self):
+        """Behind trusted proxies each shopper, and each route, gets its own bucket"""
+        print("\n=== Testing rate limit keys ===")
+
+        proxies = parse_networks(["10.0.0.0/8", "127.0.0.1"])
+
+        def scope(peer, forwarded=None):
+            headers = [(b"x-forwarded-for", forwarded.encode())] if forwarded else []
+            return {"type": "http", "client": (peer, 4321), "headers": headers}
+
+        self.assertEqual(client_key(scope("10.1.2.3", "198.51.100.7"), proxies), "198.51.100.7")
+        self.assertEqual(client_key(scope("10.1.2.3", "1.2.3.4, 198.51.100.7, 10.4.5.6"), proxies), "198.51.100.7",
+                         "The rightmost hop that is not a trusted proxy identifies the shopper")
+        self.assertEqual(client_key(scope("10.1.2.3"), proxies), "10.1.2.3")
+        self.assertEqual(client_key(scope("203.0.113.9", "198.51.100.7"), proxies), "203.0.113.9",
+                         "X-Forwarded-For from an untrusted peer must be ignored")
+        self.assertEqual(client_key(scope("10.1.2.3", "198.51.100.7")), "10.1.2.3")
+
+        self.assertEqual(route_key("/api/cart/5f2c"), "/api/cart")
+        self.assertEqual(route_key("/api/products"), "/api/products")
+        limiter = RateLimiter({"write": (1, 1)})
+        self.assertEqual(limiter.check("198.51.100.7", "write", "/api/cart"), 0)
+        self.assertGreater(limiter.check("198.51.100.7", "write", "/api/cart"), 0)
+        self.assertEqual(limiter.check("198.51.100.7", "write", "/api/orders"), 0, "Routes should not share a bucket")
+        self.assertEqual(limiter.check("198.51.100.8", "write", "/api/cart"), 0, "Shoppers should not share a bucket")
+
+        print("✅ Buckets keyed by the forwarded client and the route")
+
 if __name__ == "__main__":
     print(f"Testing backend API at: {API_URL}")
-    unittest.main(argv=['first-arg-is-ignored'], exit=False)
\ No newline at end of file
+    unittest.main(argv=['first-arg-is-ignored'], exit=False)
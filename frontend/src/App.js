@@ -1,29 +1,90 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import './App.css';
 
 const API_BASE_URL = process.env.REACT_APP_BACKEND_URL || 'http://localhost:8001';
+const PAGE_SIZE = 24;
+const CART_ID_KEY = 'cartId';
+const RECENTLY_VIEWED_KEY = 'recentlyViewed';
+const RECENTLY_VIEWED_MAX = 8;
+
+// Cart calls carry the session cart id the API issued us
+const cartFetch = async (path, options = {}) => {
+  const headers = { ...(options.headers || {}) };
+  const cartId = localStorage.getItem(CART_ID_KEY);
+  if (cartId) headers['X-Cart-Id'] = cartId;
+  const response = await fetch(`${API_BASE_URL}${path}`, { ...options, headers });
+  const issuedId = response.headers.get('X-Cart-Id');
+  if (issuedId) localStorage.setItem(CART_ID_KEY, issuedId);
+  return response;
+};
+
+// Merge a live product event, {id, changes} or {id, product}, into a product
+const applyProductEvent = (update) => (product) =>
+  product.id === update.id ? { ...product, ...(update.product || update.changes) } : product;
+
+const cartWithTotals = (items) => ({
+  items,
+  total: Math.round(items.reduce((sum, item) => sum + item.product.price * item.quantity, 0) * 100) / 100,
+  count: items.length,
+});
+
+// Image variants are served by the API under relative URLs
+const apiUrl = (url) => (url.startsWith('/') ? `${API_BASE_URL}${url}` : url);
+
+// A product's AVIF/WebP variants once the API has made them from its
+// image_url, else image_url itself; sizes is the width the image is drawn at
+const ProductImage = ({ product, sizes, className }) => {
+  const image = product.image;
+  if (!image || image.source_url !== product.image_url) {
+    return <img src={apiUrl(product.image_url)} alt={product.name} className={className} loading="lazy" />;
+  }
+  return (
+    <picture>
+      {Object.entries(image.srcset).map(([type, srcset]) => (
+        <source key={type} type={type} sizes={sizes}
+          srcSet={srcset.split(', ').map(apiUrl).join(', ')} />
+      ))}
+      <img src={apiUrl(image.src)} alt={product.name} className={className}
+        width={image.width} height={image.height} loading="lazy" decoding="async" />
+    </picture>
+  );
+};
 
 function App() {
   const [products, setProducts] = useState([]);
   const [categories, setCategories] = useState([]);
   const [loading, setLoading] = useState(true);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [loadingMore, setLoadingMore] = useState(false);
   const [selectedCategory, setSelectedCategory] = useState('all');
   const [searchTerm, setSearchTerm] = useState('');
   const [cart, setCart] = useState({ items: [], total: 0, count: 0 });
   const [showCart, setShowCart] = useState(false);
   const [selectedProduct, setSelectedProduct] = useState(null);
+  const [recentlyViewed, setRecentlyViewed] = useState([]);
+  const liveUpdates = useRef(null);
+  // The listing shown, for event handlers registered on an earlier render
+  const listing = useRef({ category: 'all', search: '' });
+
+  // Mutations refetch the cart only while no live stream keeps it current
+  const isLive = () => liveUpdates.current && liveUpdates.current.readyState === EventSource.OPEN;
+
+  // Fetch products, one page at a time
+  const productParams = (category, search, cursor) => {
+    const params = new URLSearchParams({ limit: PAGE_SIZE });
+    if (category !== 'all') params.append('category', category);
+    if (search) params.append('search', search);
+    if (cursor) params.append('cursor', cursor);
+    return params;
+  };
 
-  // Fetch products
   const fetchProducts = async (category = 'all', search = '') => {
     try {
       setLoading(true);
-      const params = new URLSearchParams();
-      if (category !== 'all') params.append('category', category);
-      if (search) params.append('search', search);
-      
-      const response = await fetch(`${API_BASE_URL}/api/products?${params}`);
+      const response = await fetch(`${API_BASE_URL}/api/products?${productParams(category, search)}`);
       const data = await response.json();
       setProducts(data.products || []);
+      setNextCursor(data.next_cursor || null);
     } catch (error) {
       console.error('Error fetching products:', error);
     } finally {
@@ -31,12 +92,29 @@ function App() {
     }
   };
 
-  // Fetch categories
+  // Append the next page of the current listing
+  const loadMoreProducts = async () => {
+    if (!nextCursor) return;
+    try {
+      setLoadingMore(true);
+      const params = productParams(selectedCategory, searchTerm, nextCursor);
+      const response = await fetch(`${API_BASE_URL}/api/products?${params}`);
+      const data = await response.json();
+      setProducts((current) => [...current, ...(data.products || [])]);
+      setNextCursor(data.next_cursor || null);
+    } catch (error) {
+      console.error('Error fetching more products:', error);
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
+  // Fetch categories with their product counts from the facets
   const fetchCategories = async () => {
     try {
-      const response = await fetch(`${API_BASE_URL}/api/categories`);
+      const response = await fetch(`${API_BASE_URL}/api/facets`);
       const data = await response.json();
-      setCategories(data.categories || []);
+      setCategories(data.facets?.category || []);
     } catch (error) {
       console.error('Error fetching categories:', error);
     }
@@ -45,7 +123,7 @@ function App() {
   // Fetch cart
   const fetchCart = async () => {
     try {
-      const response = await fetch(`${API_BASE_URL}/api/cart`);
+      const response = await cartFetch('/api/cart');
       const data = await response.json();
       setCart(data);
     } catch (error) {
@@ -56,17 +134,16 @@ function App() {
   // Add to cart
   const addToCart = async (productId) => {
     try {
-      const response = await fetch(`${API_BASE_URL}/api/cart/add`, {
+      const params = new URLSearchParams({ product_id: productId, quantity: 1 });
+      const response = await cartFetch(`/api/cart/add?${params}`, {
         method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({ product_id: productId, quantity: 1 }),
       });
       
       if (response.ok) {
-        fetchCart();
+        if (!isLive()) fetchCart();
         alert('Produit ajouté au panier !');
+      } else if (response.status === 409) {
+        alert('Stock insuffisant pour ce produit.');
       }
     } catch (error) {
       console.error('Error adding to cart:', error);
@@ -76,12 +153,12 @@ function App() {
   // Remove from cart
   const removeFromCart = async (itemId) => {
     try {
-      const response = await fetch(`${API_BASE_URL}/api/cart/${itemId}`, {
+      const response = await cartFetch(`/api/cart/${itemId}`, {
         method: 'DELETE',
       });
       
       if (response.ok) {
-        fetchCart();
+        if (!isLive()) fetchCart();
       }
     } catch (error) {
       console.error('Error removing from cart:', error);
@@ -91,29 +168,128 @@ function App() {
   // Update cart quantity
   const updateCartQuantity = async (itemId, quantity) => {
     try {
-      const response = await fetch(`${API_BASE_URL}/api/cart/${itemId}`, {
+      const params = new URLSearchParams({ quantity: parseInt(quantity) });
+      const response = await cartFetch(`/api/cart/${itemId}?${params}`, {
         method: 'PUT',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({ quantity: parseInt(quantity) }),
       });
       
       if (response.ok) {
-        fetchCart();
+        if (!isLive()) fetchCart();
       }
     } catch (error) {
       console.error('Error updating cart:', error);
     }
   };
 
+  // Place an order for the whole cart
+  const checkout = async () => {
+    const email = window.prompt('Adresse e-mail pour la confirmation de commande :');
+    if (!email) return;
+    try {
+      const response = await cartFetch('/api/checkout', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ email }),
+      });
+      
+      if (response.ok) {
+        const order = await response.json();
+        if (!isLive()) fetchCart();
+        setShowCart(false);
+        alert(`Commande ${order.id} confirmée ! Un e-mail de confirmation va vous être envoyé.`);
+      } else if (response.status === 409) {
+        alert('Stock insuffisant pour certains produits du panier.');
+      } else if (response.status === 422) {
+        alert('Adresse e-mail invalide.');
+      } else {
+        alert('La commande n\'a pas pu être passée, veuillez réessayer.');
+      }
+    } catch (error) {
+      console.error('Error during checkout:', error);
+    }
+  };
+
+  // Rehydrate recently viewed products in one batch request
+  const fetchRecentlyViewed = async () => {
+    const ids = JSON.parse(localStorage.getItem(RECENTLY_VIEWED_KEY) || '[]');
+    if (ids.length === 0) return;
+    try {
+      const params = new URLSearchParams({ ids: ids.join(',') });
+      const response = await fetch(`${API_BASE_URL}/api/products:batch?${params}`);
+      const data = await response.json();
+      const found = data.products.filter(Boolean);
+      setRecentlyViewed(found);
+      localStorage.setItem(RECENTLY_VIEWED_KEY, JSON.stringify(found.map((product) => product.id)));
+    } catch (error) {
+      console.error('Error fetching recently viewed products:', error);
+    }
+  };
+
+  const viewProduct = (product) => {
+    setSelectedProduct(product);
+    const recent = [product, ...recentlyViewed.filter((item) => item.id !== product.id)].slice(0, RECENTLY_VIEWED_MAX);
+    setRecentlyViewed(recent);
+    localStorage.setItem(RECENTLY_VIEWED_KEY, JSON.stringify(recent.map((item) => item.id)));
+  };
+
+  // Push channel for stock, price and cart line changes, opened once the
+  // API has issued a cart id
+  const openLiveUpdates = () => {
+    const params = new URLSearchParams();
+    const cartId = localStorage.getItem(CART_ID_KEY);
+    if (cartId) params.append('cart_id', cartId);
+    const source = new EventSource(`${API_BASE_URL}/api/live?${params}`);
+    const onProduct = (event) => {
+      const update = JSON.parse(event.data);
+      setProducts((current) => current.map(applyProductEvent(update)));
+      setRecentlyViewed((current) => current.map(applyProductEvent(update)));
+      setSelectedProduct((current) => (current ? applyProductEvent(update)(current) : current));
+      setCart((current) => cartWithTotals(current.items.map((item) => ({
+        ...item,
+        product: applyProductEvent(update)(item.product),
+      }))));
+    };
+    source.addEventListener('product', onProduct);
+    source.addEventListener('product_removed', (event) => {
+      const { id } = JSON.parse(event.data);
+      setProducts((current) => current.filter((product) => product.id !== id));
+    });
+    // Sent on every (re)connection
+    source.addEventListener('cart', () => fetchCart());
+    source.addEventListener('cart_line', (event) => {
+      const line = JSON.parse(event.data);
+      setCart((current) => {
+        if (!current.items.some((item) => item.id === line.id)) {
+          // A new line: its product details come with the full cart
+          fetchCart();
+          return current;
+        }
+        return cartWithTotals(current.items.map((item) => (
+          item.id === line.id ? { ...item, quantity: line.quantity } : item
+        )));
+      });
+    });
+    source.addEventListener('cart_line_removed', (event) => {
+      const { id } = JSON.parse(event.data);
+      setCart((current) => cartWithTotals(current.items.filter((item) => item.id !== id)));
+    });
+    source.addEventListener('resync', () => {
+      fetchProducts(listing.current.category, listing.current.search);
+      fetchCart();
+    });
+    liveUpdates.current = source;
+  };
+
   useEffect(() => {
     fetchProducts();
     fetchCategories();
-    fetchCart();
+    fetchCart().then(openLiveUpdates);
+    fetchRecentlyViewed();
+    return () => liveUpdates.current && liveUpdates.current.close();
   }, []);
 
   useEffect(() => {
+    listing.current = { category: selectedCategory, search: searchTerm };
     fetchProducts(selectedCategory, searchTerm);
   }, [selectedCategory, searchTerm]);
 
@@ -132,9 +308,9 @@ function App() {
   const ProductCard = ({ product }) => (
     <div className="bg-white rounded-xl shadow-lg overflow-hidden hover:shadow-xl transition-all duration-300 transform hover:-translate-y-1">
       <div className="relative">
-        <img 
-          src={product.image_url} 
-          alt={product.name}
+        <ProductImage
+          product={product}
+          sizes="(min-width: 1280px) 300px, (min-width: 1024px) 33vw, (min-width: 768px) 50vw, 100vw"
           className="w-full h-48 object-cover"
         />
         <div className="absolute top-3 right-3">
@@ -166,7 +342,7 @@ function App() {
           <span className="text-sm text-gray-500">Stock: {product.stock}</span>
           <div className="space-x-2">
             <button
-              onClick={() => setSelectedProduct(product)}
+              onClick={() => viewProduct(product)}
               className="px-3 py-2 bg-gray-100 text-gray-700 rounded-lg hover:bg-gray-200 transition-colors text-sm"
             >
               Détails
@@ -197,9 +373,9 @@ function App() {
             </svg>
           </button>
           
-          <img 
-            src={product.image_url} 
-            alt={product.name}
+          <ProductImage
+            product={product}
+            sizes="(min-width: 672px) 672px, 100vw"
             className="w-full h-64 object-cover rounded-t-xl"
           />
         </div>
@@ -269,9 +445,9 @@ function App() {
               <div className="space-y-4 mb-6">
                 {cart.items.map((item) => (
                   <div key={item.id} className="flex items-center space-x-4 p-4 border rounded-lg">
-                    <img 
-                      src={item.product.image_url} 
-                      alt={item.product.name}
+                    <ProductImage
+                      product={item.product}
+                      sizes="64px"
                       className="w-16 h-16 object-cover rounded-lg"
                     />
                     <div className="flex-1">
@@ -310,7 +486,10 @@ function App() {
                   <span className="text-xl font-bold">Total:</span>
                   <span className="text-2xl font-bold text-purple-600">{cart.total.toFixed(2)}€</span>
                 </div>
-                <button className="w-full bg-purple-600 text-white py-3 rounded-lg hover:bg-purple-700 transition-colors font-medium">
+                <button
+                  onClick={checkout}
+                  className="w-full bg-purple-600 text-white py-3 rounded-lg hover:bg-purple-700 transition-colors font-medium"
+                >
                   Procéder au paiement
                 </button>
               </div>
@@ -376,7 +555,7 @@ function App() {
               >
                 Tous
               </button>
-              {categories.map((category) => (
+              {categories.map(({ value: category, count }) => (
                 <button
                   key={category}
                   onClick={() => setSelectedCategory(category)}
@@ -386,7 +565,7 @@ function App() {
                       : 'bg-gray-100 text-gray-700 hover:bg-gray-200'
                   }`}
                 >
-                  {getCategoryDisplayName(category)}
+                  {getCategoryDisplayName(category)} ({count})
                 </button>
               ))}
             </div>
@@ -416,11 +595,42 @@ function App() {
               ))}
             </div>
             
+            {nextCursor && (
+              <div className="flex justify-center mt-8">
+                <button
+                  onClick={loadMoreProducts}
+                  disabled={loadingMore}
+                  className="px-6 py-3 bg-white border border-purple-600 text-purple-600 rounded-lg hover:bg-purple-50 transition-colors font-medium"
+                >
+                  {loadingMore ? 'Chargement...' : 'Voir plus de produits'}
+                </button>
+              </div>
+            )}
+            
             {products.length === 0 && (
               <div className="text-center py-20">
                 <p className="text-gray-500 text-lg">Aucun produit trouvé</p>
               </div>
             )}
+
+            {recentlyViewed.length > 0 && (
+              <div className="mt-12">
+                <h3 className="text-xl font-bold text-gray-900 mb-4">Récemment consultés</h3>
+                <div className="flex space-x-4 overflow-x-auto pb-2">
+                  {recentlyViewed.map((product) => (
+                    <button
+                      key={product.id}
+                      onClick={() => viewProduct(product)}
+                      className="flex-shrink-0 w-40 bg-white rounded-lg shadow-md p-3 text-left hover:shadow-lg transition-shadow"
+                    >
+                      <ProductImage product={product} sizes="136px" className="w-full h-24 object-cover rounded mb-2" />
+                      <p className="text-sm font-medium text-gray-900 truncate">{product.name}</p>
+                      <p className="text-sm text-purple-600 font-bold">{product.price.toFixed(2)}€</p>
+                    </button>
+                  ))}
+                </div>
+              </div>
+            )}
           </>
         )}
       </div>